@@ -3,8 +3,8 @@ from PyQt5 import QtCore
 from PyQt5.QtWidgets import QWidget, QFileSystemModel, QGridLayout, QTreeView, QPushButton, QMessageBox
 from PyQt5.QtCore import QDir, Qt
 from PyQt5.QtGui import QTextCursor
-from old_permissions import check_permission, add_permission
-from encrypt_file import decrypt_file
+from permissions import check_permission, add_permission
+from encrypt_file import read_note
 
 
 # The window for opening a file
@@ -98,6 +98,4 @@ class AppOpenWindow(QWidget):
 
     # Opens file and reads the text to QTextEdit
     def openFile(self, filePath):
-        f = open(filePath, 'rb')
-        self.textEdit.setHtml(decrypt_file(f.read()))
-        f.close()
+        self.textEdit.setHtml(read_note(filePath))
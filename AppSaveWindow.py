@@ -2,8 +2,9 @@ from PyQt5.QtWidgets import (QApplication, QWidget, QMessageBox, QGridLayout,
                              QLabel, QLineEdit, QPushButton, QCheckBox, QComboBox)
 from PyQt5 import QtGui, QtCore
 from PyQt5.QtPrintSupport import QPrinter
-from old_permissions import check_permission, add_permission
-from encrypt_file import encrypt_file
+from permissions import check_permission, add_permission
+from encrypt_file import write_note
+import image_store
 import os
 
 
@@ -174,10 +175,9 @@ class AppSaveWindow(QWidget):
 
     # Creates a new file or opens an existing one and saves the QTextEdit text
     def saveFile(self, filePath):
-        f = open(filePath, 'wb')
-        encrypted = encrypt_file(self.textEdit.toHtml())
-        f.write(encrypted)
-        f.close()
+        html = self.textEdit.toHtml()
+        write_note(filePath, html)
+        image_store.note_saved(filePath, html)
 
     # Saves the file as a PDF
     def savePDF(self, filePath):
@@ -0,0 +1,61 @@
+"""Runs account checks on a worker thread so the GUI keeps painting"""
+
+import threading
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+# bcrypt releases the GIL while it hashes, so worker threads are enough to
+# keep it off the GUI thread
+pool = QThreadPool()
+pool.setMaxThreadCount(2)
+
+
+class JobSignals(QObject):
+    """Signals sent back to the GUI thread by an AccountJob"""
+
+    progress = pyqtSignal(str)
+    finished = pyqtSignal(object)
+
+
+class AccountJob(QRunnable):
+    """Calls fn(*args, job=self) on the pool; fn can call job.report() and
+    should return early once job.cancelled() is true"""
+
+    def __init__(self, fn, *args):
+        super().__init__()
+
+        self.fn = fn
+        self.args = args
+        self.signals = JobSignals()
+        self.stopped = threading.Event()
+
+    # stop the job, its result will not be reported
+    def cancel(self):
+        self.stopped.set()
+
+    def cancelled(self):
+        return self.stopped.is_set()
+
+    # send a progress message to the GUI thread
+    def report(self, text):
+        if not self.cancelled():
+            self.signals.progress.emit(text)
+
+    def run(self):
+        try:
+            result = self.fn(*self.args, job=self)
+        except Exception:
+            result = 'Error'
+
+        if not self.cancelled():
+            self.signals.finished.emit(result)
+
+
+# run fn(*args) on the pool, calling onFinished(result) and onProgress(text)
+# on the GUI thread
+def start_job(fn, args, onFinished, onProgress=None):
+    job = AccountJob(fn, *args)
+    job.signals.finished.connect(onFinished)
+    if onProgress is not None:
+        job.signals.progress.connect(onProgress)
+    pool.start(job)
+    return job
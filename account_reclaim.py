@@ -0,0 +1,131 @@
+"""Deletes accounts without blocking the GUI
+
+Deleting an account first writes a tombstone to .trash/, then removes the
+account row and its permissions and moves users/<name> into .trash/ with a
+single rename, so the account stops working at once. A background thread
+then deletes the moved directory. Tombstones left by a crash are picked up
+again by start(), so a deletion always either finishes or resumes.
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+import durable
+from account_store import remove_account
+from permissions import remove_permissions, forget_directory
+
+TRASH_DIR = '.trash'
+USERS_DIR = 'users'
+
+
+class Reclaimer:
+    """Tombstones of deleted accounts, reclaimed on a background thread"""
+
+    def __init__(self, directory=TRASH_DIR, users=USERS_DIR):
+        self.directory = directory
+        self.users = users
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.working = threading.Lock()
+        self.reclaimed = 0
+
+    # finish any deletion cut short by a crash and start the reclaim thread
+    def start(self):
+        for name in self.tombstones():
+            tombstone = self.read(name)
+            if tombstone is not None and tombstone['stage'] == 'metadata':
+                self.tombstone(name, tombstone)
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.wakeup.set()
+
+    # file names of tombstones, oldest first
+    def tombstones(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+
+        return sorted(name for name in names if name.endswith('.json'))
+
+    def read(self, name):
+        try:
+            f = open(os.path.join(self.directory, name), 'rb')
+            tombstone = json.loads(f.read().decode('utf-8'))
+            f.close()
+        except (IOError, ValueError):
+            return None
+
+        return tombstone
+
+    def write(self, name, tombstone):
+        durable.atomic_write(os.path.join(self.directory, name),
+                             json.dumps(tombstone).encode('utf-8'))
+
+    # where a tombstone's user directory is moved to
+    def trash_path(self, name):
+        return os.path.join(self.directory, name[:-len('.json')])
+
+    # remove the account's row and permissions and move its directory to the
+    # trash; every step can be repeated if a crash interrupts it
+    def tombstone(self, name, tombstone):
+        user = tombstone['user']
+
+        remove_account(user)
+        remove_permissions(user)
+        forget_directory(self.users + '/' + user)
+
+        userDir = os.path.join(self.users, user)
+        if os.path.isdir(userDir):
+            os.replace(userDir, self.trash_path(name))
+
+        tombstone['stage'] = 'reclaim'
+        self.write(name, tombstone)
+
+    # mark user deleted right away and leave their files to the background thread
+    def delete_account(self, user):
+        os.makedirs(self.directory, exist_ok=True)
+
+        name = '%d-%s.json' % (time.time() * 1000, uuid.uuid4().hex)
+        tombstone = {'user': user, 'stage': 'metadata'}
+        self.write(name, tombstone)
+
+        self.tombstone(name, tombstone)
+        self.start()
+
+    # delete the trashed directories of every tombstone that is ready for it
+    def reclaim(self):
+        with self.working:
+            for name in self.tombstones():
+                tombstone = self.read(name)
+                if tombstone is None or tombstone['stage'] != 'reclaim':
+                    continue
+
+                trash = self.trash_path(name)
+                if os.path.exists(trash):
+                    shutil.rmtree(trash, ignore_errors=True)
+                if os.path.exists(trash):
+                    continue
+
+                os.remove(os.path.join(self.directory, name))
+                self.reclaimed += 1
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.reclaim()
+
+
+# shared reclaimer used by the delete account window
+reclaimer = Reclaimer()
+
+
+# delete user's account, their files are removed in the background
+def delete_account(user):
+    reclaimer.delete_account(user)
@@ -0,0 +1,514 @@
+"""Keyed account store for .note_accounts
+
+With the SQLite store turned on (see metadata_db) the rows live in its
+accounts table instead; the record functions below switch to it, so the
+functions built on them work the same with either.
+"""
+
+import os
+import hmac
+import hashlib
+import durable
+import metadata_db
+import metadata_lock
+from encrypt_account import encrypt, decrypt, policy
+
+ACCOUNTS_FILE = '.note_accounts'
+INDEX_KEY_FILE = '.account_key'
+
+# length of a hex username tag, used to tell indexed rows from legacy rows
+TAG_LENGTH = 64
+
+_index_key = None
+
+
+# get the secret used to key the username index, creating it on first use
+def get_index_key():
+    global _index_key
+
+    if _index_key is not None and os.path.exists(INDEX_KEY_FILE):
+        return _index_key
+
+    # every process must key the index the same way, so only one creates the key
+    if not os.path.exists(INDEX_KEY_FILE):
+        durable.create_once(INDEX_KEY_FILE, os.urandom(32))
+
+    f = open(INDEX_KEY_FILE, 'rb')
+    _index_key = f.read()
+    f.close()
+
+    return _index_key
+
+
+# keyed hash of a username, lets a record be found without any bcrypt checks
+def username_tag(username):
+    return hmac.new(get_index_key(), username.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+# keyed hash stored for the username and email fields; they are never read
+# back, so they don't need a slow password hash
+def lookup_digest(kind, value):
+    return hmac.new(get_index_key(), (kind + ':' + value).encode('utf-8'),
+                    hashlib.sha256).hexdigest()
+
+
+# true if a field holds a bcrypt hash (rows written before lookup digests)
+def is_bcrypt(field):
+    return field.startswith('$2')
+
+
+# true if a row starts with a username tag (rows written before the index have 3 fields)
+def is_indexed(fields):
+    return len(fields) == 4 and len(fields[0]) == TAG_LENGTH
+
+
+# blanked (deleted) rows are compacted away once they take up this many bytes
+# and at least half of .note_accounts
+COMPACT_SLACK = 64 * 1024
+
+# byte offsets of the rows in .note_accounts, reloaded only when the file on
+# disk changes, so a row can be read or replaced without touching the others
+#   records: tag -> (offset, length), legacy: [(offset, length)] of untagged rows
+_index = {'stamp': None, 'records': {}, 'legacy': [], 'size': 0, 'dead': 0}
+
+# account checks run on worker threads and other copies of the app may share
+# the directory; the lock covers the index as well as the file
+lock = metadata_lock.FileLock(ACCOUNTS_FILE)
+
+
+
+# read every row of .note_accounts as a list of fields
+def read_rows():
+    rows = []
+
+    try:
+        f = open(ACCOUNTS_FILE, 'r')
+    except IOError:
+        return rows
+
+    for line in f:
+        fields = line.split()
+        if fields:
+            rows.append(fields)
+
+    f.close()
+
+    return rows
+
+
+# rewrite .note_accounts with the given rows
+def write_rows(rows):
+    with lock:
+        data = ''.join(' '.join(fields) + '\n' for fields in rows)
+        durable.atomic_write(ACCOUNTS_FILE, data.encode('utf-8'))
+        lock.changed(rewritten=True)
+        invalidate_index()
+
+
+# get the row offsets of .note_accounts, rescanning it only if it changed
+def load_index():
+    with lock:
+        stamp = lock.stamp()
+
+        if stamp == _index['stamp']:
+            return _index
+
+        records = {}
+        legacy = []
+        dead = 0
+        data = b''
+
+        if stamp is not None:
+            f = open(ACCOUNTS_FILE, 'rb')
+            data = f.read()
+            f.close()
+
+        pos = 0
+        while pos < len(data):
+            end = data.find(b'\n', pos)
+            end = len(data) if end == -1 else end + 1
+
+            fields = data[pos:end].split()
+            if not fields:
+                dead += end - pos
+            elif is_indexed(fields):
+                records[fields[0].decode('utf-8')] = (pos, end - pos)
+            else:
+                legacy.append((pos, end - pos))
+            pos = end
+
+        _index.update(stamp=stamp, records=records, legacy=legacy,
+                      size=len(data), dead=dead)
+
+        return _index
+
+
+# forget the cached offsets so the next lookup scans .note_accounts again
+def invalidate_index():
+    with lock:
+        _index.update(stamp=None, records={}, legacy=[], size=0, dead=0)
+
+
+# (offset, length) of the row with the given username tag, or None
+def find_place(tag):
+    if metadata_db.enabled():
+        return metadata_db.account_place(tag)
+    return load_index()['records'].get(tag)
+
+
+# (offset, length) of every row written before the username index
+def legacy_places():
+    if metadata_db.enabled():
+        return metadata_db.legacy_places()
+    return list(load_index()['legacy'])
+
+
+# read the fields of the row at offset
+def read_record(offset, length):
+    if metadata_db.enabled():
+        return metadata_db.read_account(offset)
+
+    f = open(ACCOUNTS_FILE, 'rb')
+    f.seek(offset)
+    fields = f.read(length).decode('utf-8').split()
+    f.close()
+
+    return fields
+
+
+# run a write to .note_accounts, keeping the cached offsets in step with it
+# update(index) is called after the write to record what it changed
+def write_record(write, update):
+    with lock:
+        in_step = lock.stamp() == _index['stamp']
+
+        write()
+        lock.changed()
+
+        if in_step:
+            update(_index)
+            _index['stamp'] = lock.stamp()
+        else:
+            invalidate_index()
+
+
+# blank out the row at offset in place; blank lines are skipped by readers
+# tag: the row's username tag, None for a legacy row
+def blank_record(offset, length, tag=None):
+    if metadata_db.enabled():
+        with lock:
+            metadata_db.delete_account(offset)
+            lock.changed()
+        return
+
+    def update(index):
+        if tag is not None:
+            index['records'].pop(tag, None)
+        else:
+            index['legacy'] = [place for place in index['legacy'] if place[0] != offset]
+        index['dead'] += length
+
+    write_record(lambda: durable.write_at(ACCOUNTS_FILE, offset, b' ' * (length - 1) + b'\n'),
+                 update)
+
+
+# append a row to the end of .note_accounts
+def append_record(fields):
+    if metadata_db.enabled():
+        with lock:
+            metadata_db.insert_accounts([fields])
+            lock.changed()
+        return
+
+    line = (' '.join(fields) + '\n').encode('utf-8')
+
+    with lock:
+        load_index()
+        offset = _index['size']
+
+        def update(index):
+            index['records'][fields[0]] = (offset, len(line))
+            index['size'] += len(line)
+
+        write_record(lambda: durable.append(ACCOUNTS_FILE, line), update)
+
+
+# replace the row at offset with fields, in place when it is the same size,
+# otherwise by blanking it and appending the new row
+# old_tag: the replaced row's username tag, None for a legacy row
+def replace_record(offset, length, fields, old_tag=None):
+    if metadata_db.enabled():
+        with lock:
+            metadata_db.update_account(offset, fields)
+            lock.changed()
+        return
+
+    line = (' '.join(fields) + '\n').encode('utf-8')
+
+    with lock:
+        if len(line) == length:
+            def update(index):
+                index['records'][fields[0]] = (offset, length)
+
+            write_record(lambda: durable.write_at(ACCOUNTS_FILE, offset, line), update)
+        else:
+            blank_record(offset, length, old_tag)
+            append_record(fields)
+
+
+# rewrite .note_accounts without its blanked rows once they waste enough space
+def compact():
+    if metadata_db.enabled():
+        return
+
+    with lock:
+        index = load_index()
+        if index['dead'] > COMPACT_SLACK and index['dead'] * 2 > index['size']:
+            write_rows(read_rows())
+
+
+# find the row for username; returns (offset, length, fields) or None
+# indexed rows are matched by tag, only legacy rows fall back to bcrypt
+# job: an account_jobs.AccountJob to report progress to and check for cancelling
+def locate(username, job=None):
+    tag = username_tag(username)
+
+    # the bcrypt scan of legacy rows runs without the lock, so other copies of
+    # the app aren't held up by it; a match is upgraded only if nothing was
+    # written in the meantime (see metadata_lock.FileLock.update)
+    # returns (indexed row, matching legacy row), either may be None
+    def check():
+        with lock:
+            place = find_place(tag)
+            if place is not None:
+                return place + (read_record(*place),), None
+
+            legacy = [(place, read_record(*place)) for place in legacy_places()]
+
+        for checked, ((offset, length), fields) in enumerate(legacy):
+            if job is not None:
+                if job.cancelled():
+                    break
+                job.report('Checking account %d of %d' % (checked + 1, len(legacy)))
+
+            if decrypt(username, fields[0]):
+                return None, (offset, length, fields)
+
+        return None, None
+
+    def commit(found):
+        row, match = found
+        if match is None:
+            return row
+
+        # upgrade the legacy row so the next lookup is a keyed one
+        offset, length, fields = match
+        fields = [tag, lookup_digest('user', username)] + fields[1:3]
+        replace_record(offset, length, fields)
+        offset, length = find_place(tag)
+        return offset, length, fields
+
+    return lock.update(check, commit)
+
+
+# get the [tag, user, password, email] row for username, or None
+def find_account(username, job=None):
+    found = locate(username, job)
+    if found is None:
+        return None
+    return found[2]
+
+
+# characters not allowed in any signup field
+ILLEGAL_CHARS = [' ', '`', '~', '[', ']', '{', '}', '(', ')', ';', ':',
+                 '\'', '"', ',', '<', '>', '/', '?', '\\', '|']
+
+
+# check signup fields, returns a dict of 'user'/'password'/'email' -> error message
+# (empty if they are all legal); a later check's message replaces an earlier one
+def field_errors(username, password, email):
+    errors = {}
+
+    # no field can be left blank
+    if username == '':
+        errors['user'] = 'Username cannot be blank'
+    if password == '':
+        errors['password'] = 'Password cannot be blank'
+    if email == '':
+        errors['email'] = 'Email cannnot be blank'
+
+    # check each field against illegal characters
+    for c in ILLEGAL_CHARS:
+        if username.find(c) != -1:
+            errors['user'] = 'Username cannot contain "' + c + '"'
+        if password.find(c) != -1:
+            errors['password'] = 'Password cannot contain "' + c + '"'
+        if email.find(c) != -1:
+            errors['email'] = 'Email cannot contain "' + c + '"'
+
+    # check email format
+    if email.find('@') <= 0 or (email.find('.com') == -1 and email.find('.gov') ==
+                                -1 and email.find('.edu') == -1 and email.find('.net') == -1):
+        errors['email'] = 'Email must have format: user@address.xxx'
+
+    return errors
+
+
+# true if an account already uses this username
+def username_taken(username, job=None):
+    return find_account(username, job) is not None
+
+
+# check a username/password pair with a single password verification
+def verify_login(username, password, job=None):
+    account = find_account(username, job)
+
+    if account is None:
+        return 'False'
+
+    if job is not None:
+        if job.cancelled():
+            return 'False'
+        job.report('Checking password')
+
+    if not decrypt(password, account[2]):
+        return 'Wrong pass'
+
+    upgrade_account(username, password, account)
+
+    return 'True'
+
+
+# after a successful login, rehash the password if the hashing policy changed
+# and replace a bcrypt hashed username with its lookup digest
+def upgrade_account(username, password, account):
+    changes = {}
+
+    if policy.needs_rehash(account[2]):
+        changes[2] = encrypt(password)
+    if is_bcrypt(account[1]):
+        changes[1] = lookup_digest('user', username)
+
+    if changes:
+        update_fields(username, changes)
+
+
+# the fields of a new account's row, from an already hashed password
+def new_record(username, password_hash, email):
+    return [username_tag(username), lookup_digest('user', username),
+            password_hash, lookup_digest('email', email)]
+
+
+# add a new account to the end of .note_accounts
+def add_account(username, password, email):
+    append_record(new_record(username, encrypt(password), email))
+
+
+# add many new rows (from new_record) in one atomic rewrite of .note_accounts,
+# so either all of them are stored or none are; rows whose username was
+# taken since it was checked are left out, returns those rows
+def add_accounts(records):
+    with lock:
+        taken = [fields for fields in records if find_place(fields[0]) is not None]
+        records = [fields for fields in records if fields not in taken]
+
+        if metadata_db.enabled():
+            metadata_db.insert_accounts(records)
+            lock.changed()
+            return taken
+
+        try:
+            f = open(ACCOUNTS_FILE, 'rb')
+            data = f.read()
+            f.close()
+        except IOError:
+            data = b''
+
+        if data and not data.endswith(b'\n'):
+            data += b'\n'
+
+        with durable.atomic_open(ACCOUNTS_FILE) as f:
+            f.write(data)
+            f.write(''.join(' '.join(fields) + '\n' for fields in records).encode('utf-8'))
+
+        lock.changed(rewritten=True)
+        invalidate_index()
+
+    return taken
+
+
+# add a new account unless the username is taken; returns 'True' or 'Taken'
+# the slow checks run before taking the lock, and are redone if another
+# thread or process wrote an account in the meantime
+def create_account(username, password, email, job=None):
+    hashed = {}
+
+    # the password is hashed once, when the username is first found free
+    def check():
+        taken = username_taken(username, job)
+        if not taken and 'password' not in hashed and (job is None or not job.cancelled()):
+            hashed['password'] = encrypt(password)
+        return taken
+
+    def add(taken):
+        if taken:
+            return 'Taken'
+        if job is not None and job.cancelled():
+            return 'False'
+
+        append_record(new_record(username, hashed['password'], email))
+        return 'True'
+
+    return lock.update(check, add)
+
+
+# change username's password if old is their current one; returns the
+# verify_login result
+def change_password(username, old, new, job=None):
+    result = verify_login(username, old, job)
+
+    if result == 'True' and (job is None or not job.cancelled()):
+        set_password(username, new)
+
+    return result
+
+
+# replace fields of username's row (1 user, 2 password, 3 email) without
+# rewriting the rest of .note_accounts; returns False if there is no such account
+# changes: field number -> new value
+def update_fields(username, changes):
+    with lock:
+        found = locate(username)
+        if found is None:
+            return False
+
+        offset, length, fields = found
+        for field, value in changes.items():
+            fields[field] = value
+        replace_record(offset, length, fields, fields[0])
+
+        return True
+
+
+# replace one field of username's row
+def update_account(username, field, value):
+    return update_fields(username, {field: value})
+
+
+# replace the password stored for username, returns False if there is no such account
+def set_password(username, password):
+    return update_account(username, 2, encrypt(password))
+
+
+# remove the account for username, returns False if there is no such account
+def remove_account(username):
+    with lock:
+        found = locate(username)
+        if found is None:
+            return False
+
+        offset, length, fields = found
+        blank_record(offset, length, fields[0])
+        compact()
+
+        return True
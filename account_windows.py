@@ -3,10 +3,11 @@
 
 import sys
 import os
-import shutil
-from encrypt_account import encrypt, decrypt
-from encrypt_file import encrypt_file, decrypt_file
-from email_server import send_email
+import account_store
+from account_store import verify_login
+from account_reclaim import delete_account
+from account_jobs import start_job
+from email_server import queue_email
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QPushButton, QLabel, QLineEdit, QGridLayout, QMessageBox)
 
@@ -15,11 +16,10 @@ from PyQt5.QtWidgets import (
 # creating an account
 class SignupWindow(QWidget):
     # for checking if signup info is valid, sets label text for each error
-    def legal_account(self, username, password, match, email):
-        illegal_chars = [' ', '`', '~', '[', ']',
-                         '{', '}', '(', ')', ';', ':', '\'', '"', ',', '<', '>', '/', '?', '\\', '|']
+    # the username is only looked up in the account store if check_taken is set,
+    # create_account leaves that to its background job
+    def legal_account(self, username, password, match, email, check_taken=True):
         legal = True
-        empty = False
 
         user_error = self.label_userError
         password_error = self.label_passwordError
@@ -34,32 +34,19 @@ class SignupWindow(QWidget):
         email_error.setText('')
 
         # for checking if username is already taken
-        try:
-            f = open('.note_accounts', 'r')
-        except IOError:
-            empty = True
-
-        if not empty:
-            for line in f:
-                account_info = line.split()
-
-                if not account_info:
-                    continue
-
-                if decrypt(username, account_info[0]):
-                    user_error.setText('Username already taken')
-                    legal = False
-                    break
-
-        # no field can be left blank
-        if username == '':
-            user_error.setText('Username cannot be blank')
-            legal = False
-        if password == '':
-            password_error.setText('Password cannot be blank')
+        if check_taken and username != '' and account_store.username_taken(username):
+            user_error.setText('Username already taken')
             legal = False
-        if email == '':
-            email_error.setText('Email cannnot be blank')
+
+        # blank fields, illegal characters and email format
+        errors = account_store.field_errors(username, password, email)
+        if 'user' in errors:
+            user_error.setText(errors['user'])
+        if 'password' in errors:
+            password_error.setText(errors['password'])
+        if 'email' in errors:
+            email_error.setText(errors['email'])
+        if errors:
             legal = False
 
         # passwords must match
@@ -67,54 +54,42 @@ class SignupWindow(QWidget):
             match_error.setText('Passwords do not match')
             legal = False
 
-        # check each field against illegal characters
-        for c in illegal_chars:
-            if username.find(c) != -1:
-                user_error.setText('Username cannot contain "' + c + '"')
-                legal = False
-            if password.find(c) != -1:
-                password_error.setText('Password cannot contain "' + c + '"')
-                legal = False
-            if email.find(c) != -1:
-                email_error.setText('Email cannot contain "' + c + '"')
-                legal = False
-
-        # check email format
-        if email.find('@') <= 0 or (email.find('.com') == -1 and email.find('.gov') ==
-                                    -1 and email.find('.edu') == -1 and email.find('.net') == -1):
-            email_error.setText('Email must have format: user@address.xxx')
-            legal = False
-
         return legal
 
-    # reads in all currently existing accounts, encrypts user/pass, writes new
-    # file
+    # encrypts user/pass/email and adds the new account to the account store
     def create_account(self):
         username = self.lineEdit_newuser.text()
         password = self.lineEdit_newpassword.text()
         match = self.lineEdit_matchpassword.text()
         email = self.lineEdit_email.text()
 
-        if not self.legal_account(username, password, match, email):
+        if not self.legal_account(username, password, match, email, check_taken=False):
             return
 
-        all_file = ''
-        try:
-            f = open('.note_accounts', 'r+')
-            all_file = f.read()
-        except IOError:
-            f = open('.note_accounts', 'w')
-
-        f.seek(0)
-
-        # does encryption on new username, password, and email
-        e_user = encrypt(username)
-        e_pass = encrypt(password)
-        e_email = encrypt(email)
-
-        f.write(all_file + e_user + ' ' + e_pass + ' ' + e_email + '\n')
-
-        f.close()
+        # checks the username is free, then encrypts new username, password,
+        # and email and appends the account, all off the GUI thread
+        self.button_create_account.setEnabled(False)
+        self.label_status.setText('Creating account...')
+        # the fields can be edited while the job runs, keep what was submitted
+        self.pending = (username, email)
+        self.job = start_job(account_store.create_account, (username, password, email),
+                             self.account_created, self.label_status.setText)
+
+    # handles the result of the create_account job
+    def account_created(self, result):
+        username, email = self.pending
+
+        self.pending = None
+        self.job = None
+        self.button_create_account.setEnabled(True)
+        self.label_status.setText('')
+
+        if result == 'Taken':
+            self.label_userError.setText('Username already taken')
+            return
+        if result != 'True':
+            self.label_status.setText('Could not create account')
+            return
 
         msg = QMessageBox()
         msg.setText(
@@ -123,8 +98,9 @@ class SignupWindow(QWidget):
         msg.setStandardButtons(QMessageBox.Ok)
         msg.exec_()
 
-        # sends a confirmation email to the email used to sign up
-        send_email(email)
+        # queues a confirmation email to the email used to sign up, it is sent
+        # in the background
+        queue_email(email)
 
         # Make directory for user
         if not os.path.exists('users/' + username):
@@ -178,9 +154,15 @@ class SignupWindow(QWidget):
         layout.addWidget(self.lineEdit_email, 6, 1)
         layout.addWidget(self.label_emailError, 7, 1)
 
-        button_create_account = QPushButton('Create account')
-        button_create_account.clicked.connect(self.create_account)
-        layout.addWidget(button_create_account, 8, 1)
+        self.label_status = QLabel('')
+        layout.addWidget(self.label_status, 8, 0)
+
+        self.button_create_account = QPushButton('Create account')
+        self.button_create_account.clicked.connect(self.create_account)
+        layout.addWidget(self.button_create_account, 8, 1)
+
+        self.job = None
+        self.pending = None
 
         self.setLayout(layout)
 
@@ -188,50 +170,65 @@ class SignupWindow(QWidget):
 # class containing functions that open and operate first window when
 # starting app, for logging in
 class LoginWindow(QWidget):
-    # reads in accounts from file and checks if entered user/pass pair matches
-    # any existing
+    # looks up the entered username in the account store and checks if the
+    # entered user/pass pair matches
     def check_credentials(self):
-        try:
-            f = open('.note_accounts', 'r')
-        except IOError:
-            return 'False'
-
-        # check every account until a matching username is found or entire file
-        # is searched
-        for line in f:
-            cur_user = line.split()
+        # the account is looked up by its username tag, so only its password
+        # is checked with bcrypt
+        result = verify_login(self.lineEdit_username.text(),
+                              self.lineEdit_password.text())
 
-            username = decrypt(self.lineEdit_username.text(), cur_user[0])
-            password = decrypt(self.lineEdit_password.text(), cur_user[1])
-
-            # checks for account's existence as well as correct password for
-            # outputting appropriate message
-            if username and password:
-                self.user = self.lineEdit_username.text()
-
-                # Create user directory
-                if not os.path.exists('users/' + self.user):
-                    os.makedirs('users/' + self.user)
-
-                f.close()
-                return 'True'
+        if result == 'True':
+            self.accept_login()
 
-            elif username and not password:
-                f.close()
-                return 'Wrong pass'
+        return result
 
-        f.close()
+    # sets the logged in user and makes sure they have a directory
+    def accept_login(self):
+        self.user = self.lineEdit_username.text()
 
-        return 'False'
+        # Create user directory
+        if not os.path.exists('users/' + self.user):
+            os.makedirs('users/' + self.user)
 
-    # handles actual output message based on results of check_credentials()
+    # checks the entered credentials on a background job so the window keeps
+    # responding, login_finished() handles the result
     def login_result(self):
+        if self.job is not None:
+            return
+
+        self.set_busy(True)
+        self.label_status.setText('Logging in...')
+        self.job = start_job(verify_login,
+                             (self.lineEdit_username.text(), self.lineEdit_password.text()),
+                             self.login_finished, self.label_status.setText)
+
+    # stop waiting for a login check, its result is ignored
+    def cancel_login(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+        self.set_busy(False)
+
+    # disable the inputs while a login is being checked
+    def set_busy(self, busy):
+        self.lineEdit_username.setEnabled(not busy)
+        self.lineEdit_password.setEnabled(not busy)
+        self.button_login.setEnabled(not busy)
+        self.button_cancel.setVisible(busy)
+        if not busy:
+            self.label_status.setText('')
+
+    # handles actual output message based on the result of the login job
+    def login_finished(self, result):
         msg = QMessageBox()
 
-        result = self.check_credentials()
+        self.job = None
+        self.set_busy(False)
 
         # opens note app and closes login window
         if result == 'True':
+            self.accept_login()
             self.main_window.show()
             self.main_window.user = self.user
             self.close()
@@ -246,6 +243,10 @@ class LoginWindow(QWidget):
             msg.setText('Username not found')
             msg.exec_()
 
+        else:
+            msg.setText('Could not check login')
+            msg.exec_()
+
     def create_account_window(self):
         self.dialog = SignupWindow()
         self.dialog.show()
@@ -283,9 +284,9 @@ class LoginWindow(QWidget):
         layout.addWidget(label_password, 1, 0)
         layout.addWidget(self.lineEdit_password, 1, 1)
 
-        button_login = QPushButton('Login')
-        button_login.clicked.connect(self.login_result)
-        layout.addWidget(button_login, 2, 1)
+        self.button_login = QPushButton('Login')
+        self.button_login.clicked.connect(self.login_result)
+        layout.addWidget(self.button_login, 2, 1)
 
         button_signup = QPushButton('Sign up')
         button_signup.clicked.connect(self.create_account_window)
@@ -295,6 +296,17 @@ class LoginWindow(QWidget):
         button_noaccount.clicked.connect(self.bypass)
         layout.addWidget(button_noaccount, 3, 0, 3, 0)
 
+        # shown while a login is being checked
+        self.label_status = QLabel('')
+        layout.addWidget(self.label_status, 6, 0)
+
+        self.button_cancel = QPushButton('Cancel')
+        self.button_cancel.clicked.connect(self.cancel_login)
+        self.button_cancel.setVisible(False)
+        layout.addWidget(self.button_cancel, 6, 1)
+
+        self.job = None
+
         self.setLayout(layout)
 
 
@@ -338,14 +350,19 @@ class ChangePasswordWindow(QWidget):
         layout.addWidget(self.lineEdit_reenterpassword, 4, 1)
         layout.addWidget(self.label_nomatch, 5, 1)
 
-        button_confirm = QPushButton('Confirm')
-        button_confirm.clicked.connect(self.change_password)
-        layout.addWidget(button_confirm, 6, 1)
+        self.button_confirm = QPushButton('Confirm')
+        self.button_confirm.clicked.connect(self.change_password)
+        layout.addWidget(self.button_confirm, 6, 1)
 
         button_cancel = QPushButton('Cancel')
         button_cancel.clicked.connect(self.close)
         layout.addWidget(button_cancel, 6, 0)
 
+        self.label_status = QLabel('')
+        layout.addWidget(self.label_status, 7, 0)
+
+        self.job = None
+
         self.setLayout(layout)
 
     # ask user for current password and new password, change saved password
@@ -354,7 +371,6 @@ class ChangePasswordWindow(QWidget):
                          '{', '}', '(', ')', ';', ':', '\'', '"', ',', '<', '>', '/', '?', '\\', '|']
 
         legal = True
-        can_change = True
 
         # outputting errors for incorrect password, new password requirements, and new password matching
         old_error = self.label_badold
@@ -365,38 +381,11 @@ class ChangePasswordWindow(QWidget):
         new_error.setText('')
         match_error.setText('')
 
-        try:
-            f = open('.note_accounts', 'r')
-        except IOError:
-            old_error.setText('No accounts exist')
-            return
-
         old = self.lineEdit_oldpassword.text()
         new = self.lineEdit_newpassword.text()
         match = self.lineEdit_reenterpassword.text()
 
-        found = False
-
-        # find the account and save the old information
-        for line in f:
-            cur_account = line.split()
-
-            if decrypt(self.user, cur_account[0]):
-                found = True
-                email = cur_account[2]
-                break
-
-        f.close()
-
         # do error checking
-        if found:
-            if not decrypt(old, cur_account[1]):
-                old_error.setText('Incorrect password')
-                can_change = False
-        else:
-            old_error.setText('Account does not exist')
-            can_change = False
-
         if new == '':
             new_error.setText('Password cannot be blank')
             legal = False
@@ -410,29 +399,28 @@ class ChangePasswordWindow(QWidget):
             match_error.setText('Passwords do not match')
             legal = False
 
-        # if all entered info passes all the checks, change the saved data
-        if legal:
-            f = open('.note_accounts', 'r+')
-
-            all_file = f.read()
-
-            f.seek(0)
+        # if the new password passes all the checks, check the old password and
+        # change the saved data on a background job
+        if legal and self.job is None:
+            self.button_confirm.setEnabled(False)
+            self.job = start_job(account_store.change_password, (self.user, old, new),
+                                 self.password_changed, self.label_status.setText)
 
-            # write all other accounts back to file, unchanged
-            for line in all_file.splitlines():
-                cur_account = line.split()
-
-                # skip account being changed
-                if not decrypt(self.user, cur_account[0]):
-                    f.write(line + '\n')
-
-            # write new info at the end of the file
-            f.write(encrypt(self.user) + ' ' +
-                    encrypt(new) + ' ' + email + '\n')
-
-            f.close()
+    # handles the result of the change_password job
+    def password_changed(self, result):
+        self.job = None
+        self.button_confirm.setEnabled(True)
+        self.label_status.setText('')
+        self.label_badold.setText('')
 
+        if result == 'True':
             self.close()
+        elif result == 'Wrong pass':
+            self.label_badold.setText('Incorrect password')
+        elif result == 'False':
+            self.label_badold.setText('Account does not exist')
+        else:
+            self.label_badold.setText('Could not change password')
 
 
 # create window to allow user to delete their account
@@ -454,44 +442,48 @@ class DeleteAccountWindow(QWidget):
         layout.addWidget(self.lineEdit_password, 0, 1)
         layout.addWidget(self.label_incorrectpass, 1, 1)
 
-        button_confirm = QPushButton('Confirm')
-        button_confirm.clicked.connect(self.prompt_delete_account)
-        layout.addWidget(button_confirm, 2, 1)
+        self.button_confirm = QPushButton('Confirm')
+        self.button_confirm.clicked.connect(self.prompt_delete_account)
+        layout.addWidget(self.button_confirm, 2, 1)
 
         button_cancel = QPushButton('Cancel')
         button_cancel.clicked.connect(self.close)
         layout.addWidget(button_cancel, 2, 0)
 
+        self.label_status = QLabel('')
+        layout.addWidget(self.label_status, 3, 0)
+
+        self.job = None
+
         self.setLayout(layout)
 
     # prompt for verifying person trying to delete the account is the owner
     # also double-check that the person actually wants to delete their account
     def prompt_delete_account(self):
-        password = self.lineEdit_password.text()
+        if self.job is not None:
+            return
 
-        # error checking password
-        legal = True
         self.label_incorrectpass.setText('')
+        self.button_confirm.setEnabled(False)
 
-        try:
-            f = open('.note_accounts', 'r')
-        except IOError:
-            return
-
-        # verify credentials
-        for line in f:
-            cur_account = line.split()
+        # verify credentials on a background job
+        self.job = start_job(verify_login, (self.user, self.lineEdit_password.text()),
+                             self.password_checked, self.label_status.setText)
 
-            if decrypt(self.user, cur_account[0]):
-                if not decrypt(password, cur_account[1]):
-                    self.label_incorrectpass.setText('Incorrect password')
-                    legal = False
-                    break
+    # handles the result of the password check, asking for confirmation if it passed
+    def password_checked(self, result):
+        self.job = None
+        self.button_confirm.setEnabled(True)
+        self.label_status.setText('')
+        self.label_incorrectpass.setText('')
 
-        f.close()
+        if result == 'Wrong pass':
+            self.label_incorrectpass.setText('Incorrect password')
+        elif result == 'Error':
+            self.label_incorrectpass.setText('Could not check password')
 
         # output final warning box
-        if legal:
+        else:
             msg = QMessageBox()
             msg.setWindowTitle('Warning!')
             msg.setText(
@@ -505,56 +497,10 @@ class DeleteAccountWindow(QWidget):
         password = self.lineEdit_password.text()
 
         if button.text() == '&Yes':
-            try:
-                f = open('.note_accounts', 'r+')
-            except IOError:
-                return
-
-            all_file = f.read()
-
-            f.seek(0)
-
-            f.truncate(0)
-
-            # rewrite all accounts except for the one to be deleted
-            for line in all_file.splitlines():
-                cur_account = line.split()
-
-                if not decrypt(self.user, cur_account[0]):
-                    f.write(line + '\n')
-
-            f.close()
-
-            # check if .permissions exists and needs to be checked and modified
-
-            exists = True
-
-            try:
-                f = open('.permissions', 'rb+')
-            except IOError:
-                exists = False
-
-            if exists:
-                all_permissions = decrypt_file(f.read())
-                new_file = ''
-
-                f.seek(0)
-
-                f.truncate(0)
-
-                # rewrite all permissions except the account to be deleted's
-                for line in all_permissions.splitlines():
-                    cur_account = line.split()
-
-                    if cur_account[0] != self.user:
-                        new_file += (line + '\n')
-
-                f.write(encrypt_file(new_file))
-
-                f.close()
-
-            # delete the user's directory and all of its contents, then close the app
-            shutil.rmtree('users/' + self.user)
+            # tombstone the account, removing its row and permissions and moving
+            # its directory out of users/; the files are deleted in the background
+            delete_account(self.user)
 
+            # then close the app
             self.close()
             self.main_window.close()
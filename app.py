@@ -9,7 +9,7 @@ from PyQt5.QtCore import *
 from PyQt5.QtPrintSupport import QPrintDialog, QPrinter
 from find_window import FindWindow
 from account_windows import LoginWindow
-from shutil import copyfile
+import image_store
 from permissions import check_permission, add_permission
 import os
 import time
@@ -670,14 +670,7 @@ class MainWindow(QtWidgets.QMainWindow, Ui_MainWindow):
             self, 'Select an Image', '', 'PNG (*.png);;JPEG (*.jpg *.jpeg)')
 
         if filePath:
-
-            # Create image directory
-            if not os.path.exists('users/' + self.textBox_1.mainWindow.user + '/images'):
-                os.makedirs(
-                    'users/' + self.textBox_1.mainWindow.user + '/images')
-
-            dest = copyfile(filePath, 'users/' + self.textBox_1.mainWindow.user +
-                            '/images/' + os.path.basename(filePath))
+            dest = image_store.add_image(self.textBox_1.mainWindow.user, filePath)
             self.textBox_1.textCursor().insertImage(dest)
 
     # Creaes a new file or opens an existing and saves the QTextEdit text
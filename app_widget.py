@@ -6,7 +6,7 @@ from PyQt5.QtWidgets import QFileDialog
 from find_window import FindWindow
 import os
 import uuid
-from shutil import copyfile
+import image_store
 
 IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp']
 HTML_EXTENSIONS = ['.htm', '.html']
@@ -35,14 +35,7 @@ class AppWidget(QWidget):
             self, 'Select an Image', '', 'PNG (*.png);;JPEG (*.jpg *.jpeg)')
 
         if filePath:
-
-            # Create image directory
-            if not os.path.exists('users/' + self.textBox.mainWindow.user + '/images'):
-                os.makedirs(
-                    'users/' + self.textBox.mainWindow.user + '/images')
-
-            dest = copyfile(filePath, 'users/' + self.textBox.mainWindow.user +
-                            '/images/' + os.path.basename(filePath))
+            dest = image_store.add_image(self.textBox.mainWindow.user, filePath)
             self.textBox.textCursor().insertImage(dest)
 
 
@@ -76,13 +69,7 @@ class TextEdit(QTextEdit):
                     image = QImage(u.toLocalFile())
                     document.addResource(QTextDocument.ImageResource, u, image)
 
-                    # Create image directory
-                    if not os.path.exists('users/' + self.mainWindow.user + '/images'):
-                        os.makedirs(
-                            'users/' + self.mainWindow.user + '/images')
-
-                    dest = copyfile(u.toLocalFile(
-                    ), 'users/' + self.mainWindow.user + '/images/' + os.path.basename(u.toLocalFile()))
+                    dest = image_store.add_image(self.mainWindow.user, u.toLocalFile())
                     cursor.insertImage(dest)
                 else:
                     break
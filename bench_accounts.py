@@ -0,0 +1,90 @@
+"""Benchmark changing and deleting one account in a large .note_accounts
+
+Builds a throwaway .note_accounts with ACCOUNTS rows in a temporary directory
+and times a password change and an account deletion done as record-level
+updates against the whole-file rewrite they replaced. The other rows hold
+random stand-ins for password hashes, and the new password hash is computed
+once up front, so only the cost of the store itself is measured.
+
+    $ python bench_accounts.py [ACCOUNTS ...]
+"""
+
+import sys
+import string
+import random
+
+import account_store
+from bench_util import timed, temp_dir
+from encrypt_account import encrypt
+
+# characters used by bcrypt's base64
+HASH_CHARS = string.ascii_letters + string.digits + './'
+
+
+# a random string shaped like a bcrypt hash
+def fake_hash():
+    return '$2b$12$' + ''.join(random.choice(HASH_CHARS) for _ in range(53))
+
+
+# write a .note_accounts with accounts rows, user0 has real hashes
+def build_accounts(accounts):
+    rows = []
+    for i in range(accounts):
+        username = 'user%d' % i
+        rows.append([account_store.username_tag(username),
+                     account_store.lookup_digest('user', username),
+                     encrypt('password') if i == 0 else fake_hash(),
+                     account_store.lookup_digest('email', username + '@test.com')])
+    account_store.write_rows(rows)
+
+
+# the old way of changing one field: read, edit and rewrite every row
+def rewrite_update(username, field, value):
+    rows = account_store.read_rows()
+    tag = account_store.username_tag(username)
+    for fields in rows:
+        if fields[0] == tag:
+            fields[field] = value
+    account_store.write_rows(rows)
+
+
+# the old way of deleting a row
+def rewrite_delete(username):
+    tag = account_store.username_tag(username)
+    account_store.write_rows([fields for fields in account_store.read_rows() if fields[0] != tag])
+
+
+def run(accounts):
+    build_accounts(accounts)
+    hashed = encrypt('newpassword')
+    repeat = 20
+
+    # the first call also scans .note_accounts to build the offset index
+    account_store.invalidate_index()
+    cold = timed(lambda: account_store.update_account('user0', 2, hashed), 1)
+    update = timed(lambda: account_store.update_account('user0', 2, hashed), repeat)
+    old_update = timed(lambda: rewrite_update('user0', 2, hashed), min(repeat, 5))
+
+    account_store.load_index()
+    users = iter(range(1, accounts))
+    delete = timed(lambda: account_store.remove_account('user%d' % next(users)), repeat)
+    old_delete = timed(lambda: rewrite_delete('user%d' % next(users)), min(repeat, 5))
+
+    print('accounts: %d' % accounts)
+    print('  update, first call:  %8.3f ms' % (cold * 1000))
+    print('  update, record:      %8.3f ms' % (update * 1000))
+    print('  update, rewrite:     %8.3f ms' % (old_update * 1000))
+    print('  delete, record:      %8.3f ms' % (delete * 1000))
+    print('  delete, rewrite:     %8.3f ms' % (old_delete * 1000))
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+
+    with temp_dir():
+        for accounts in counts:
+            run(accounts)
+
+
+if __name__ == '__main__':
+    main()
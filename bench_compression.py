@@ -0,0 +1,91 @@
+"""Benchmark compressing notes before encrypting them
+
+Builds a note the way the editor saves it (QTextEdit.toHtml() of PARAGRAPHS
+formatted paragraphs) and, for every codec and level, reports the size on
+disk against a Fernet token (what encrypt_file used to write) and the
+uncompressed note, and the time to encrypt and to decrypt it (in memory, so
+disk syncs don't hide the codec's cost).
+
+    $ python bench_compression.py [PARAGRAPHS]
+"""
+
+import io
+import os
+import sys
+import random
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt5.QtWidgets import QApplication, QTextEdit
+from bench_util import timed, temp_dir
+from encrypt_file import key_manager, encrypt_stream, decrypt_stream, text_chunks
+
+# timed calls per codec and level, the best one is reported
+REPEAT = 5
+
+SETTINGS = [('none', None), ('zlib', 1), ('zlib', 6), ('zlib', 9), ('lzma', 0), ('lzma', 6)]
+
+SNIPPETS = [
+    '<p>%s <b>%s</b> %s</p>',
+    '<p style="color:#aa0000">%s <u>%s</u> %s</p>',
+    '<ul><li>%s</li><li>%s</li><li>%s</li></ul>',
+    '<p><span style="font-size:14pt">%s</span> <i>%s</i> %s</p>',
+]
+
+WORDS = ('the release team meeting note action item follow up with draft review '
+         'budget schedule design server client bug fix test plan owner date').split()
+
+
+# random words, the same every run
+def sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 16)))
+
+
+# the HTML the editor would save for a note of paragraphs paragraphs
+def editor_html(paragraphs):
+    rng = random.Random(0)
+    edit = QTextEdit()
+    edit.setHtml(''.join(SNIPPETS[rng.randrange(len(SNIPPETS))] %
+                         (sentence(rng), sentence(rng), sentence(rng))
+                         for _ in range(paragraphs)))
+    return edit.toHtml()
+
+
+def encrypted(html, codec, level):
+    dst = io.BytesIO()
+    if codec == 'none':
+        encrypt_stream(text_chunks(html), dst)
+    else:
+        encrypt_stream(text_chunks(html), dst, codec=codec, level=level)
+    return dst.getvalue()
+
+
+def run(paragraphs):
+    html = editor_html(paragraphs)
+    fernet = len(key_manager.fernet(create=True).encrypt(html.encode('utf8')))
+
+    print('note: %d paragraphs, %.1f KB of HTML, %.1f KB as a Fernet file' %
+          (paragraphs, len(html.encode('utf8')) / 1000, fernet / 1000))
+    print('  %-8s %8s %10s %10s %10s %10s' %
+          ('codec', 'level', 'KB', 'vs Fernet', 'save ms', 'open ms'))
+
+    for codec, level in SETTINGS:
+        data = encrypted(html, codec, level)
+        save = timed(lambda: encrypted(html, codec, level), REPEAT)
+        load = timed(lambda: b''.join(decrypt_stream(io.BytesIO(data))).decode('utf8'), REPEAT)
+
+        print('  %-8s %8s %10.1f %9.1fx %10.2f %10.2f' %
+              (codec, '-' if level is None else level, len(data) / 1000,
+               fernet / len(data), save * 1000, load * 1000))
+
+
+def main():
+    paragraphs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    app = QApplication(sys.argv[:1])
+
+    with temp_dir():
+        run(paragraphs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Stress test several copies of the app sharing one data directory
+
+Starts PROCESSES worker processes on a throwaway directory, all at once.
+Each grants itself GRANTS notes of its own plus one of a few notes every
+worker grants, and creates ACCOUNTS accounts of its own while racing the
+others for ACCOUNTS shared usernames. The logs are compacted far more often
+than usual, so rewrites race with appends as well.
+
+Reports the throughput and then checks the directory from a fresh process
+state: every grant and account any worker made must be there (no lost
+updates), each note must have one catalog ID, and each shared username must
+have been created by exactly one worker. Passwords are hashed at bcrypt cost
+4 so the locking, not bcrypt, is what gets measured.
+
+    $ python bench_concurrency.py [PROCESSES] [GRANTS] [ACCOUNTS]
+"""
+
+import os
+import sys
+import time
+import multiprocessing
+
+import account_store
+from bench_util import temp_dir
+import note_catalog
+import permissions
+from encrypt_account import policy
+
+# number of notes every worker grants itself
+SHARED_NOTES = 10
+
+# records past a compacted log before it is compacted again
+COMPACT_SLACK = 50
+
+HASH_COST = 4
+
+
+def own_note(worker, i):
+    return 'users/shared/w%d-%d.txt' % (worker, i)
+
+
+def shared_note(i):
+    return 'users/shared/common%d.txt' % (i % SHARED_NOTES)
+
+
+def worker(directory, number, grants, accounts, start, results):
+    os.chdir(directory)
+    permissions.COMPACT_SLACK = COMPACT_SLACK
+    note_catalog.COMPACT_SLACK = COMPACT_SLACK
+    policy.cost = HASH_COST
+    user = 'worker%d' % number
+
+    start.wait()
+    began = time.perf_counter()
+
+    for i in range(grants):
+        permissions.add_permission(user, own_note(number, i))
+        permissions.add_permission(user, shared_note(i))
+    granted = time.perf_counter()
+
+    won = []
+    for i in range(accounts):
+        account_store.create_account('w%d-%d' % (number, i), 'password', 'w@test.com')
+        if account_store.create_account('everyone%d' % i, 'password', 'e@test.com') == 'True':
+            won.append(i)
+    created = time.perf_counter()
+
+    results.put((number, granted - began, created - granted, won))
+
+
+# check the directory against what the workers did, returns a list of problems
+def verify(processes, grants, accounts, won):
+    permissions.invalidate_index()
+    note_catalog.invalidate_catalog()
+    account_store.invalidate_index()
+    problems = []
+
+    for number in range(processes):
+        user = 'worker%d' % number
+        for i in range(grants):
+            if user not in permissions.users_with_access(own_note(number, i)):
+                problems.append('lost grant: %s on %s' % (user, own_note(number, i)))
+
+    everyone = {'worker%d' % number for number in range(processes)}
+    for i in range(min(grants, SHARED_NOTES)):
+        missing = everyone - permissions.users_with_access(shared_note(i))
+        if missing:
+            problems.append('lost grants on %s: %s' % (shared_note(i), ', '.join(sorted(missing))))
+
+    notes = len(note_catalog.ids_under('users/shared'))
+    expected = processes * grants + min(grants, SHARED_NOTES)
+    if notes != expected:
+        problems.append('catalog holds %d notes, expected %d' % (notes, expected))
+
+    for number in range(processes):
+        for i in range(accounts):
+            if not account_store.username_taken('w%d-%d' % (number, i)):
+                problems.append('lost account: w%d-%d' % (number, i))
+
+    for i in range(accounts):
+        winners = sum(i in numbers for numbers in won)
+        if winners != 1:
+            problems.append('everyone%d created %d times' % (i, winners))
+
+    rows = account_store.read_rows()
+    if len(rows) != processes * accounts + accounts or len({row[0] for row in rows}) != len(rows):
+        problems.append('%d account rows, expected %d distinct' %
+                        (len(rows), processes * accounts + accounts))
+
+    return problems
+
+
+def run(processes, grants, accounts):
+    context = multiprocessing.get_context('spawn')
+
+    with temp_dir() as directory:
+        start = context.Event()
+        results = context.Queue()
+        workers = [context.Process(target=worker,
+                                   args=(directory, number, grants, accounts, start, results))
+                   for number in range(processes)]
+        for process in workers:
+            process.start()
+
+        # let every worker finish importing before any of them starts
+        time.sleep(1)
+        began = time.perf_counter()
+        start.set()
+
+        finished = [results.get() for _ in workers]
+        elapsed = time.perf_counter() - began
+        for process in workers:
+            process.join()
+
+        problems = verify(processes, grants, accounts, [won for *_, won in finished])
+
+    granting = max(result[1] for result in finished)
+    creating = max(result[2] for result in finished)
+
+    print('processes: %d, grants: %d, accounts: %d each' % (processes, grants, accounts))
+    print('  grants:    %8.1f per second' % (processes * grants * 2 / granting))
+    if accounts:
+        print('  accounts:  %8.1f per second' % (processes * accounts * 2 / creating))
+    print('  total:     %8.3f s' % elapsed)
+
+    for problem in problems:
+        print('  ' + problem)
+    print('  problems:  %d' % len(problems))
+
+    return problems
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    processes, grants, accounts = args + [8, 200, 20][len(args):]
+
+    return 1 if run(processes, grants, accounts) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
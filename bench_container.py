@@ -0,0 +1,50 @@
+"""Benchmark encrypt_file's binary container against Fernet tokens
+
+For a permissions record, a typical note and a large note, reports the size
+of each format and the time to encrypt and to decrypt it (in memory, with the
+key already loaded, so only the formats are compared).
+
+    $ python bench_container.py [REPEAT]
+"""
+
+import os
+import sys
+
+from bench_util import timed, temp_dir
+from encrypt_file import key_manager, seal, unseal
+
+PAYLOADS = [
+    ('record', b'grant user0 users/user0/some_note.txt'),
+    ('10 KB note', os.urandom(10 * 1000)),
+    ('1 MB note', os.urandom(1000 * 1000)),
+]
+
+
+def run(repeat):
+    fern = key_manager.fernet(create=True)
+    box = key_manager.box_cipher()
+
+    print('  %-12s %10s %12s %9s %12s %12s' %
+          ('payload', 'format', 'bytes', 'overhead', 'encrypt us', 'decrypt us'))
+
+    for name, data in PAYLOADS:
+        token = fern.encrypt(data)
+        sealed = seal(box, data)
+
+        for label, encrypted, encrypt in (('Fernet', token, lambda: fern.encrypt(data)),
+                                          ('container', sealed, lambda: seal(box, data))):
+            decrypt = timed(lambda: unseal(encrypted, fern, box), repeat)
+            print('  %-12s %10s %12d %8.1f%% %12.1f %12.1f' %
+                  (name, label, len(encrypted), 100 * (len(encrypted) - len(data)) / len(data),
+                   timed(encrypt, repeat) * 1e6, decrypt * 1e6))
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    with temp_dir():
+        run(repeat)
+
+
+if __name__ == '__main__':
+    main()
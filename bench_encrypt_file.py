@@ -0,0 +1,63 @@
+"""Micro-benchmark of encrypt_file/decrypt_file calls per second
+
+Compares the shared KeyManager against reading .key and building a new
+Fernet object on every call, in a temporary directory.
+
+    $ python bench_encrypt_file.py [CALLS]
+"""
+
+import sys
+import time
+
+from cryptography.fernet import Fernet
+from bench_util import temp_dir
+from encrypt_file import encrypt_file, decrypt_file
+
+# a permissions record sized payload
+PAYLOAD = 'grant user0 users/user0/some_note.txt'
+
+
+# the old encrypt_file: open .key and build a Fernet object per call
+def uncached_encrypt(original):
+    f = open('.key', 'rb')
+    key = f.read()
+    f.close()
+
+    return Fernet(key).encrypt(original.encode('utf8'))
+
+
+# the old decrypt_file
+def uncached_decrypt(encrypted):
+    f = open('.key', 'rb')
+    key = f.read()
+    f.close()
+
+    return Fernet(key).decrypt(encrypted).decode('utf8')
+
+
+# calls per second of an encrypt + decrypt round trip
+def rate(encrypt, decrypt, calls):
+    start = time.perf_counter()
+
+    for i in range(calls):
+        decrypt(encrypt(PAYLOAD))
+
+    return 2 * calls / (time.perf_counter() - start)
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    with temp_dir():
+        encrypt_file(PAYLOAD)
+
+        before = rate(uncached_encrypt, uncached_decrypt, calls)
+        after = rate(encrypt_file, decrypt_file, calls)
+
+        print('per-call key read:  %.0f calls/s' % before)
+        print('shared KeyManager:  %.0f calls/s' % after)
+        print('speedup:            %.2fx' % (after / before))
+
+
+if __name__ == '__main__':
+    main()
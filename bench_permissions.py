@@ -0,0 +1,80 @@
+"""Benchmark the cost of opening the permission window at a large user count
+
+Builds a throwaway .permissions with USERS accounts in a temporary directory
+and times building PermissionWindow's user list: the check_permission loop
+it used to run, with the cached index and with the index dropped before every
+call (the old behaviour of decrypting .permissions on every check), and the
+single users_with_access lookup it runs now.
+
+    $ python bench_permissions.py [USERS]
+"""
+
+import sys
+import time
+
+import permissions
+from bench_util import temp_dir
+from encrypt_file import encrypt_file
+
+
+# write a .permissions file with one note per user
+def build_permissions(users):
+    lines = ['user%d users/user%d/note.txt' % (i, i) for i in range(users)]
+
+    f = open(permissions.PERMISSIONS_FILE, 'wb')
+    f.write(encrypt_file('\n'.join(lines) + '\n'))
+    f.close()
+
+
+# time the old combo box loop from PermissionWindow.__init__
+def open_dialog(users, path, cached):
+    start = time.perf_counter()
+
+    for i in range(users):
+        if not cached:
+            permissions.invalidate_index()
+        permissions.check_permission('user%d' % i, path)
+
+    return time.perf_counter() - start
+
+
+# time the combo box list built from the reverse index
+def open_dialog_reverse(users, path):
+    start = time.perf_counter()
+
+    granted = permissions.users_with_access(path)
+    if 'guest' not in granted:
+        names = ['user%d' % i for i in range(users) if 'user%d' % i not in granted]
+
+    return time.perf_counter() - start
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    with temp_dir():
+        build_permissions(users)
+        path = 'users/user0/note.txt'
+
+        # give the notes catalog IDs and rewrite the log with them, as the
+        # first write after an upgrade does
+        permissions.compact()
+
+        permissions.invalidate_index()
+        cached = open_dialog(users, path, True)
+        reverse = open_dialog_reverse(users, path)
+
+        # decrypting the whole file per user is quadratic, so time a sample
+        sample = min(users, 200)
+        uncached = open_dialog(sample, path, False) * users / sample
+
+        print('users:            %d' % users)
+        print('uncached dialog:  %.3f s (estimated from %d checks)' % (uncached, sample))
+        print('cached dialog:    %.3f s' % cached)
+        print('reverse index:    %.3f s' % reverse)
+        print('speedup:          %.0fx cached, %.0fx reverse index' %
+              (uncached / cached, uncached / reverse))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Benchmark rotating the key over a large corpus of envelope notes
+
+Writes TOTAL_MB of notes, NOTE_MB each, into a throwaway users/ directory and
+times rotate_key's header-only rotation against re-encrypting every byte of
+every note (what rotation cost before notes had their own data keys), both
+on the same process pool.
+
+    $ python bench_rotation.py [TOTAL_MB] [NOTE_MB] [WORKERS]
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import durable
+import rotate_key
+from bench_util import temp_dir
+from encrypt_file import write_note, set_compression, encrypt_stream, decrypt_stream, SLOT_SIZE
+
+MB = 1000 * 1000
+
+
+# notes are written uncompressed, so the corpus takes up total MB on disk
+def build_corpus(total, size):
+    set_compression('none')
+    block = ''.join(chr(ord('a') + i % 26) for i in range(64 * 1024))
+    text = (block * (size * MB // len(block) + 1))[:size * MB]
+
+    paths = []
+    for i in range(max(1, total // size)):
+        path = os.path.join('users', 'user%d' % (i % 100), 'note%d.txt' % i)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_note(path, text)
+        paths.append(path)
+    durable.flush()
+
+    return paths
+
+
+# decrypt and re-encrypt a whole note under the same key
+def reencrypt(path):
+    f = open(path, 'rb')
+    with durable.atomic_open(path) as dst:
+        encrypt_stream(decrypt_stream(f), dst)
+    f.close()
+
+
+def run(total, size, workers):
+    paths = build_corpus(total, size)
+    data = sum(os.path.getsize(path) for path in paths)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(reencrypt, paths, chunksize=4))
+    full = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stats = rotate_key.rotate(workers)
+    header = time.perf_counter() - start
+
+    print('notes: %d of %d MB, %.2f GB in all' % (len(paths), size, data / 1e9))
+    print('  re-encrypt every byte: %9.2f s  %9.1f files/sec  %8.1f MB/sec  %9.1f MB written' %
+          (full, len(paths) / full, data / full / MB, data / MB))
+    print('  rewrap headers:        %9.2f s  %9.1f files/sec  %8.1f MB/sec  %9.3f MB written' %
+          (header, len(paths) / header, data / header / MB,
+           stats['rewrapped'] * 2 * SLOT_SIZE / MB))
+
+    if stats['failed'] or stats['rewrapped'] != len(paths):
+        print('  rotation failed: %r' % stats['failed'])
+        return 1
+    return 0
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    total, size, workers = args + [10 * 1024, 8, 0][len(args):]
+
+    with temp_dir():
+        return run(total, size, workers or None)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,37 @@
+"""Helpers shared by the bench_*.py scripts
+
+Every benchmark times its calls with timed() and builds its files in a
+throwaway directory with temp_dir(), so their numbers are measured the same
+way and none of them touches the real data directory.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import contextlib
+
+
+# seconds per call of fn, best of repeat calls
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# run the with block in a new temporary directory, removed afterwards
+@contextlib.contextmanager
+def temp_dir():
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+
+    try:
+        os.chdir(tmp)
+        yield tmp
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
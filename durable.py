@@ -0,0 +1,256 @@
+"""Crash-safe file writes
+
+Files are written to a temporary file in the same directory, fsynced and then
+renamed over the target, so a crash leaves either the old or the new version.
+With group commit turned on, writes that ask for it have their fsync and
+rename deferred to a background thread for a short window; several saves of
+the same file in that window are coalesced into one, and every file touched
+in the window is synced once.
+"""
+
+import atexit
+import os
+import stat
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# fsyncs done and writes dropped because a newer version replaced them
+stats = {'fsyncs': 0, 'coalesced': 0}
+
+# temporary files are private, new files get the permissions open() would give
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+# fsync an open file or a path
+def fsync(f):
+    os.fsync(f if isinstance(f, int) else f.fileno())
+    stats['fsyncs'] += 1
+
+
+# fsync a directory so a rename in it survives a crash (not possible on Windows)
+def fsync_dir(directory):
+    try:
+        fd = os.open(directory or '.', os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class GroupCommitter:
+    """Collects pending renames and fsyncs and flushes them together"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.commitLock = threading.Lock()
+        self.renames = {}
+        self.syncs = set()
+        # paths a running flush has taken but not yet renamed into place
+        self.inflight = set()
+        self.thread = None
+
+    # rename tmp over path at the next flush, replacing any older pending version
+    def rename_later(self, tmp, path):
+        with self.cond:
+            older = self.renames.pop(path, None)
+            if older is not None:
+                os.unlink(older)
+                stats['coalesced'] += 1
+            self.renames[path] = tmp
+            self.wake()
+
+    # fsync path at the next flush
+    def sync_later(self, path):
+        with self.cond:
+            if path in self.syncs:
+                stats['coalesced'] += 1
+            self.syncs.add(path)
+            self.wake()
+
+    # true if path has a write that hasn't been renamed into place yet
+    def pending(self, path):
+        with self.cond:
+            return path in self.renames or path in self.inflight
+
+    def wake(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.renames and not self.syncs:
+                    self.cond.wait()
+
+            # let more writes join this batch
+            time.sleep(self.delay)
+            self.flush()
+
+    # fsync and rename everything pending now
+    def flush(self):
+        with self.commitLock:
+            with self.cond:
+                renames, self.renames = self.renames, {}
+                syncs, self.syncs = self.syncs, set()
+                self.inflight = set(renames)
+
+            directories = set()
+
+            try:
+                for path, tmp in renames.items():
+                    f = open(tmp, 'rb')
+                    fsync(f)
+                    f.close()
+                    os.replace(tmp, path)
+                    directories.add(os.path.dirname(path))
+            finally:
+                with self.cond:
+                    self.inflight = set()
+
+            for path in syncs:
+                try:
+                    f = open(path, 'rb')
+                except IOError:
+                    continue
+                fsync(f)
+                f.close()
+
+            for directory in directories:
+                fsync_dir(directory)
+
+
+_committer = {'group': None}
+
+
+# turn group commit on with a window of delay seconds, or off with 0
+def set_group_commit(delay):
+    flush()
+    _committer['group'] = GroupCommitter(delay) if delay > 0 else None
+
+
+# commit everything group commit is holding back
+def flush():
+    group = _committer['group']
+    if group is not None:
+        group.flush()
+
+
+# make sure a deferred write to path is in place before reading it; a write
+# a flush is renaming right now counts as pending, and flushing again waits
+# for that flush to finish
+def wait(path):
+    group = _committer['group']
+    if group is not None and group.pending(path):
+        group.flush()
+
+
+atexit.register(flush)
+
+
+# open a temporary file to write path's new contents into; it replaces path
+# only once the block finishes without an exception
+# group: let group commit defer the fsync and rename, if it is turned on
+@contextmanager
+def atomic_open(path, group=False):
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                               suffix='.tmp', dir=directory or '.')
+    f = os.fdopen(fd, 'wb')
+
+    try:
+        if os.path.exists(path):
+            os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        else:
+            os.chmod(tmp, 0o666 & ~_umask)
+
+        yield f
+        f.flush()
+    except BaseException:
+        f.close()
+        os.unlink(tmp)
+        raise
+
+    committer = _committer['group'] if group else None
+
+    if committer is not None:
+        f.close()
+        committer.rename_later(tmp, path)
+        return
+
+    try:
+        fsync(f)
+    finally:
+        f.close()
+    os.replace(tmp, path)
+    fsync_dir(directory)
+
+
+# atomically replace path's contents with data
+def atomic_write(path, data, group=False):
+    with atomic_open(path, group) as f:
+        f.write(data)
+
+
+# append data to path, syncing it now or at the next group commit
+def append(path, data, group=False):
+    f = open(path, 'ab')
+    try:
+        f.write(data)
+        f.flush()
+
+        committer = _committer['group'] if group else None
+        if committer is not None:
+            committer.sync_later(path)
+        else:
+            fsync(f)
+    finally:
+        f.close()
+
+
+# overwrite the bytes of path at offset with data in place and sync them
+def write_at(path, offset, data):
+    f = open(path, 'r+b')
+    try:
+        f.seek(offset)
+        f.write(data)
+        f.flush()
+        fsync(f)
+    finally:
+        f.close()
+
+
+# create path holding data unless it already exists; when several processes
+# race to create it, exactly one wins and the others leave its data in place
+# returns True if this call created it
+def create_once(path, data):
+    directory = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                               suffix='.tmp', dir=directory or '.')
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            fsync(f)
+        finally:
+            f.close()
+
+        try:
+            os.link(tmp, path)
+        except FileExistsError:
+            return False
+        fsync_dir(directory)
+        return True
+    finally:
+        os.unlink(tmp)
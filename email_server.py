@@ -1,22 +1,186 @@
-"""Email server"""
+"""Email server
+
+Signup emails are queued in a local outbox (one file per message in
+.outbox/) and sent by a background thread, so signing up never waits on
+the mail server and works offline. The thread reuses one SMTP connection
+while there is mail to send and retries failed messages with backoff.
+"""
 
 # from realpython.com tutorial
 import smtplib
 import ssl
+import os
+import json
+import time
+import uuid
+import threading
+import durable
 
 message = """\
 Subject: Note App Signup
 
 Thank you for signing up!"""
 
+OUTBOX_DIR = '.outbox'
+
+# where signup emails are sent from, can be pointed at a local test server
+config = {
+    'host': os.environ.get('NOTEAPP_SMTP_HOST', 'smtp.gmail.com'),
+    'port': int(os.environ.get('NOTEAPP_SMTP_PORT', '465')),
+    'ssl': os.environ.get('NOTEAPP_SMTP_SSL', '1') == '1',
+    'sender': "sltsapp20@gmail.com",
+    'password': "slts2020",
+}
+
+# seconds before the first retry, doubled for every failed attempt
+RETRY_BASE = 30
+RETRY_MAX = 3600
+
+# messages that still fail after this many attempts are moved to .outbox/failed
+MAX_ATTEMPTS = 10
+
+# close the SMTP connection after this many idle seconds
+IDLE_SECONDS = 30
+
+
+# open a logged in connection to the configured mail server
+def connect():
+    if config['ssl']:
+        context = ssl.create_default_context()
+        server = smtplib.SMTP_SSL(config['host'], config['port'], context=context, timeout=30)
+    else:
+        server = smtplib.SMTP(config['host'], config['port'], timeout=30)
+
+    if config['password']:
+        server.login(config['sender'], config['password'])
+
+    return server
 
+
+# send an email right away on a new connection
 def send_email(user):
-    sender = "sltsapp20@gmail.com"
-    password = "slts2020"
+    with connect() as server:
+        server.sendmail(config['sender'], user, message)
+
+
+class Outbox:
+    """Spool of queued emails, sent on a background thread"""
+
+    def __init__(self, directory=OUTBOX_DIR):
+        self.directory = directory
+        self.server = None
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.sending = threading.Lock()
+        self.sent = 0
+        self.connections = 0
+
+    # start the sending thread if needed and have it look at the spool
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        self.wakeup.set()
+
+    # add a message to the spool, it survives restarts until it is sent
+    # start: wake the sending thread, otherwise the message waits for the next start()
+    def queue(self, to, text=message, start=True):
+        os.makedirs(self.directory, exist_ok=True)
+
+        name = '%d-%s.json' % (time.time() * 1000, uuid.uuid4().hex)
+        record = {'to': to, 'message': text, 'attempts': 0, 'next': 0}
+        durable.atomic_write(os.path.join(self.directory, name),
+                             json.dumps(record).encode('utf-8'))
+
+        if start:
+            self.start()
+
+    # file names of queued messages, oldest first
+    def pending(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+
+        return sorted(name for name in names if name.endswith('.json'))
+
+    def disconnect(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    # move a message that can't be delivered out of the way
+    def fail(self, path):
+        failed = os.path.join(self.directory, 'failed')
+        os.makedirs(failed, exist_ok=True)
+        os.replace(path, os.path.join(failed, os.path.basename(path)))
+
+    # send every message that is due; returns the seconds until the next
+    # retry, or None if nothing is left waiting
+    def send_due(self):
+        with self.sending:
+            wait = None
+
+            for name in self.pending():
+                path = os.path.join(self.directory, name)
+                try:
+                    f = open(path, 'rb')
+                    record = json.loads(f.read().decode('utf-8'))
+                    f.close()
+                except (IOError, ValueError):
+                    continue
+
+                now = time.time()
+                if record['next'] > now:
+                    wait = min(wait or RETRY_MAX, record['next'] - now)
+                    continue
+
+                try:
+                    if self.server is None:
+                        self.server = connect()
+                        self.connections += 1
+                    self.server.sendmail(config['sender'], record['to'], record['message'])
+                except smtplib.SMTPRecipientsRefused:
+                    self.fail(path)
+                    continue
+                except (smtplib.SMTPException, OSError):
+                    self.disconnect()
+
+                    record['attempts'] += 1
+                    if record['attempts'] >= MAX_ATTEMPTS:
+                        self.fail(path)
+                        continue
+
+                    delay = min(RETRY_BASE * 2 ** (record['attempts'] - 1), RETRY_MAX)
+                    record['next'] = now + delay
+                    durable.atomic_write(path, json.dumps(record).encode('utf-8'))
+
+                    # the server is unreachable, leave the rest for the retry
+                    return min(wait or delay, delay)
+
+                os.remove(path)
+                self.sent += 1
+
+            return wait
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            wait = self.send_due()
+
+            timeout = IDLE_SECONDS if wait is None else wait
+            if not self.wakeup.wait(timeout) and wait is None:
+                with self.sending:
+                    self.disconnect()
+
+
+# shared outbox used by the signup window
+outbox = Outbox()
 
-    port = 465
 
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL("smtp.gmail.com", port, context=context) as server:
-        server.login(sender, password)
-        server.sendmail(sender, user, message)
+# queue a signup confirmation email to user
+def queue_email(user):
+    outbox.queue(user)
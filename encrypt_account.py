@@ -1,13 +1,122 @@
 """Encrypt and decrypt strings"""
 
+import os
+import json
+import math
+import time
 import bcrypt
+import threading
+
+POLICY_FILE = '.hash_policy'
+
+# bcrypt cost limits: below MIN_COST hashes are too cheap to guess against,
+# above MAX_COST a login would take minutes
+MIN_COST = 10
+MAX_COST = 16
+
+# how long checking one password should take on this host, in seconds
+TARGET_SECONDS = 0.25
+
+# cost used to time this host's bcrypt speed while calibrating
+PROBE_COST = 8
+
+
+class PasswordPolicy:
+    """The bcrypt cost used for new password hashes, calibrated once per host
+    so a check takes about target seconds and kept in POLICY_FILE
+
+    Every hash carries its own cost, so hashes made under an older policy
+    still verify and can be replaced with needs_rehash() on the next login.
+    """
+
+    def __init__(self, path=POLICY_FILE, target=TARGET_SECONDS):
+        self.path = path
+        self.target = target
+        self.cost = None
+        self.lock = threading.Lock()
+
+    # time one bcrypt hash at PROBE_COST and pick the cost that takes target seconds
+    def calibrate(self):
+        salt = bcrypt.gensalt(PROBE_COST)
+        start = time.perf_counter()
+        for _ in range(3):
+            bcrypt.hashpw(b'calibration', salt)
+        probe = (time.perf_counter() - start) / 3
+
+        # every extra cost step doubles the work
+        cost = PROBE_COST + int(round(math.log2(self.target / probe)))
+        return max(MIN_COST, min(MAX_COST, cost))
+
+    # get the cost for new hashes, calibrating and saving it on first use
+    def get_cost(self):
+        with self.lock:
+            if self.cost is not None:
+                return self.cost
+
+            try:
+                f = open(self.path, 'r')
+                saved = json.load(f)
+                f.close()
+
+                if saved['target'] == self.target:
+                    self.cost = max(MIN_COST, min(MAX_COST, int(saved['cost'])))
+                    return self.cost
+            except (IOError, ValueError, KeyError, TypeError):
+                pass
+
+            self.cost = self.calibrate()
+
+            f = open(self.path, 'w')
+            json.dump({'cost': self.cost, 'target': self.target}, f)
+            f.close()
+
+            return self.cost
+
+    # change the target latency and recalibrate
+    def set_target(self, target):
+        with self.lock:
+            self.target = target
+            self.cost = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        return self.get_cost()
+
+    # hash a password at the current cost
+    def hash(self, password):
+        return hash_at_cost(password, self.get_cost())
+
+    # check a password against a hash made at any cost
+    def verify(self, password, hashed):
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+    # true if hashed was made at a different cost than new hashes use
+    def needs_rehash(self, hashed):
+        return hash_cost(hashed) != self.get_cost()
+
+
+# hash a password at the given bcrypt cost; used directly by worker processes,
+# which get the cost from the policy of the process that started them
+def hash_at_cost(password, cost):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(cost)).decode('utf-8')
+
+
+# the cost a bcrypt hash was made with ('$2b$12$...' -> 12), None if unknown
+def hash_cost(hashed):
+    parts = hashed.split('$')
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+# shared by everything that hashes passwords
+policy = PasswordPolicy()
 
 
 # encrypt string s
 def encrypt(s):
-    return bcrypt.hashpw(s.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return policy.hash(s)
 
 
 # decrypt string s
 def decrypt(s, hashed):
-    return bcrypt.checkpw(s.encode('utf-8'), hashed.encode('utf-8'))
+    return policy.verify(s, hashed)
@@ -1,44 +1,505 @@
 """Encrypt and decrypt files"""
 
 
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import base64
+import codecs
+import io
+import lzma
+import os
+import struct
 import sys
+import threading
+import uuid
+import zlib
+import durable
 
+KEY_FILE = '.key'
 
-def generate_key():
-    key = Fernet.generate_key()
+# Notes are written as a stream of separately authenticated chunks so a large
+# document is never encrypted or decrypted in one piece:
+#   NOTE_MAGIC, 16 byte note ID, 8 byte random nonce prefix, then frames of
+#   (4 byte big-endian length, AES-GCM ciphertext of one chunk)
+# Each chunk's nonce is the prefix plus its counter, and the header and
+# whether it is the last chunk are bound into its associated data, so chunks
+# can't be reordered, dropped or truncated, or moved to another note, without
+# failing authentication. The note ID stays the same across saves, renames
+# and moves. Notes written before IDs start with STREAM_MAGIC and no ID.
+#
+# Notes are now written with ENVELOPE_MAGIC: each note's chunks are encrypted
+# with its own random data key, kept in the header wrapped by a key derived
+# from .key. The header is ENVELOPE_MAGIC, note ID, two key slots, nonce
+# prefix; a slot is (12 byte nonce, AES-GCM of the data key) with the magic
+# and ID as associated data, and the other slot is random. Changing .key only
+# rewraps the data key into the other slot and scrubs the old one (see
+# rewrap_note), without touching the chunks.
+#
+# Notes saved by write_note are compressed first and start with
+# COMPRESSED_MAGIC; they are laid out like ENVELOPE_MAGIC notes, and their
+# decrypted content is one byte naming the codec (see CODECS) followed by the
+# compressed text. Notes of every earlier version are still read as they are.
+STREAM_MAGIC = b'NOTESTR1'
+NOTE_MAGIC = b'NOTESTR2'
+ENVELOPE_MAGIC = b'NOTESTR3'
+COMPRESSED_MAGIC = b'NOTESTR4'
+ENVELOPE_MAGICS = (ENVELOPE_MAGIC, COMPRESSED_MAGIC)
+STREAM_MAGICS = (STREAM_MAGIC, NOTE_MAGIC) + ENVELOPE_MAGICS
+ID_SIZE = 16
+SLOT_NONCE = 12
+SLOT_SIZE = SLOT_NONCE + 32 + 16
+SLOTS_OFFSET = len(ENVELOPE_MAGIC) + ID_SIZE
+CHUNK_SIZE = 64 * 1024
+FRAME_LENGTH = struct.Struct('>I')
 
-    f = open('.key', 'wb')
-    f.write(key)
-    f.close()
+# encrypt_file writes a binary container rather than a Fernet token (which
+# is base64, a third larger than its ciphertext):
+#   BOX_MAGIC, version byte, 12 byte nonce, AES-GCM ciphertext and tag
+# with the magic and version as associated data, under a key derived from
+# .key. Files and records written as Fernet tokens are still read.
+BOX_MAGIC = b'NOTEBOX'
+BOX_VERSION = 1
+BOX_HEADER = BOX_MAGIC + bytes([BOX_VERSION])
+BOX_NONCE = 12
+
+# codec byte of compressed notes -> name; the byte is never reused
+CODECS = {0: 'none', 1: 'zlib', 2: 'lzma'}
+
+# how write_note compresses notes, changed with set_compression
+compression = {'codec': 'zlib', 'level': 6}
+
+
+# create the key file, unless another process got there first
+def generate_key(path=KEY_FILE):
+    durable.create_once(path, Fernet.generate_key())
+
+
+# derive the key used for streamed notes (or, with another info, the key
+# that wraps notes' data keys) from the Fernet key
+def derive_stream_key(key, info=b'note stream'):
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32,
+                salt=None, info=info)
+    return hkdf.derive(base64.urlsafe_b64decode(key))
+
+
+# the Fernet object, the cipher for notes written before envelopes, the
+# cipher that wraps data keys and the cipher for encrypt_file's containers,
+# for the contents of a key file
+def make_ciphers(key):
+    return (Fernet(key), AESGCM(derive_stream_key(key)),
+            AESGCM(derive_stream_key(key, b'note key wrap')),
+            AESGCM(derive_stream_key(key, b'note box')))
+
+
+class KeyManager:
+    """Reads the key file once and keeps the ciphers made from it, reloading
+    them if the key file is replaced (key rotation) or removed"""
+
+    def __init__(self, path=KEY_FILE):
+        self.path = path
+        self.stamp = None
+        self.fern = None
+        self.aead = None
+        self.kek = None
+        self.box = None
+        self.loads = 0
+
+        # notes are encrypted on the background save thread as well
+        self.lock = threading.RLock()
+
+    # identifies the key file currently on disk, None if there is none
+    def file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    # get the Fernet object for the current key, or None if there is no key
+    # a new key is generated when create is set and none exists
+    def fernet(self, create=False):
+        with self.lock:
+            stamp = self.file_stamp()
+
+            if stamp is None:
+                if not create:
+                    self.stamp = None
+                    self.fern = None
+                    return None
+                generate_key(self.path)
+                stamp = self.file_stamp()
+
+            if stamp != self.stamp:
+                f = open(self.path, 'rb')
+                key = f.read()
+                f.close()
+
+                self.fern, self.aead, self.kek, self.box = make_ciphers(key)
+                self.stamp = stamp
+                self.loads += 1
+
+            return self.fern
+
+    # get the AES-GCM cipher used for notes written before envelopes, or None
+    # if there is no key
+    def stream_cipher(self, create=False):
+        with self.lock:
+            if self.fernet(create) is None:
+                return None
+            return self.aead
+
+    # get the AES-GCM cipher that wraps notes' data keys, or None if there is no key
+    def wrap_cipher(self, create=False):
+        with self.lock:
+            if self.fernet(create) is None:
+                return None
+            return self.kek
+
+    # get the AES-GCM cipher for encrypt_file's containers, or None if there is no key
+    def box_cipher(self, create=False):
+        with self.lock:
+            if self.fernet(create) is None:
+                return None
+            return self.box
+
+
+# shared by everything that encrypts notes or metadata
+key_manager = KeyManager()
+
+
+# encrypt data into a container with box
+def seal(box, data):
+    nonce = os.urandom(BOX_NONCE)
+    return BOX_HEADER + nonce + box.encrypt(nonce, data, BOX_HEADER)
+
+
+# decrypt a container, or a Fernet token written before containers, with the
+# ciphers of one key; raises InvalidTag or InvalidToken if it isn't theirs
+def unseal(encrypted, fern, box):
+    if not encrypted.startswith(BOX_MAGIC):
+        return fern.decrypt(encrypted)
+
+    header = encrypted[:len(BOX_HEADER)]
+    if header != BOX_HEADER:
+        raise ValueError('unsupported container version %d' % header[-1])
+
+    nonce = encrypted[len(BOX_HEADER):len(BOX_HEADER) + BOX_NONCE]
+    return box.decrypt(nonce, encrypted[len(BOX_HEADER) + BOX_NONCE:], header)
 
 
 def encrypt_file(original):
+    box = key_manager.box_cipher(create=True)
+
+    original = original.encode('utf8')
+
+    return seal(box, original)
+
+
+def decrypt_file(encrypted):
+    # whole streamed notes can also be passed in as bytes
+    if encrypted.startswith(STREAM_MAGICS):
+        return b''.join(decrypt_stream(io.BytesIO(encrypted))).decode('utf8')
+
+    with key_manager.lock:
+        fern = key_manager.fernet()
+        box = key_manager.box
+
+    if fern is None:
+        print('error: no key')
+        sys.exit()
+
+    return unseal(encrypted, fern, box).decode('utf8')
+
+
+# nonce and associated data for chunk number counter of a stream
+# header: the stream's magic and note ID
+def chunk_params(prefix, counter, final, header=STREAM_MAGIC):
+    nonce = prefix + struct.pack('>I', counter)
+    return nonce, header + nonce + (b'\x01' if final else b'\x00')
+
+
+# a new random note ID, as hex
+def new_note_id():
+    return uuid.uuid4().hex
+
+
+# wrap a note's data key with kek into a key slot
+def wrap_key(kek, dataKey, header):
+    nonce = os.urandom(SLOT_NONCE)
+    return nonce + kek.encrypt(nonce, dataKey, header)
+
+
+# get (data key, slot number) from the first of slots kek opens, (None, None)
+# if it opens neither
+def unwrap_key(kek, slots, header):
+    for number, slot in enumerate(slots):
+        try:
+            return kek.decrypt(slot[:SLOT_NONCE], slot[SLOT_NONCE:], header), number
+        except InvalidTag:
+            pass
+
+    return None, None
+
+
+# choose how write_note compresses notes: codec is 'none', 'zlib' (level
+# 0-9) or 'lzma' (preset 0-9); level None keeps the codec's default
+def set_compression(codec, level=None):
+    if codec not in CODECS.values():
+        raise ValueError('unknown codec: ' + codec)
+    compression.update(codec=codec, level=level)
+
+
+def make_compressor(codec, level):
+    if codec == 'zlib':
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level)
+    if codec == 'lzma':
+        return lzma.LZMACompressor(preset=level)
+    return None
+
+
+def make_decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    if codec == 'lzma':
+        return lzma.LZMADecompressor()
+    return None
+
+
+# compress byte chunks into CHUNK_SIZE blocks, the first starting with the codec byte
+def compress_chunks(chunks, codec, level):
+    compressor = make_compressor(codec, level)
+    pending = bytes([next(number for number, name in CODECS.items() if name == codec)])
+
+    for chunk in chunks:
+        pending += compressor.compress(chunk) if compressor is not None else chunk
+        while len(pending) >= CHUNK_SIZE:
+            yield pending[:CHUNK_SIZE]
+            pending = pending[CHUNK_SIZE:]
+
+    if compressor is not None:
+        pending += compressor.flush()
+    while pending:
+        yield pending[:CHUNK_SIZE]
+        pending = pending[CHUNK_SIZE:]
+
+
+# undo compress_chunks
+def decompress_chunks(chunks):
+    codec = None
+    decompressor = None
+
+    for chunk in chunks:
+        if codec is None:
+            if chunk[0] not in CODECS:
+                raise ValueError('unknown codec %d' % chunk[0])
+            codec = CODECS[chunk[0]]
+            decompressor = make_decompressor(codec)
+            chunk = chunk[1:]
+
+        yield decompressor.decompress(chunk) if decompressor is not None else chunk
+
+    if codec == 'zlib':
+        yield decompressor.flush()
+
+
+# encrypt an iterable of byte chunks into the file object dst under a new
+# data key
+# noteId: the note's ID as hex, a new one is made if it is None
+# kek: the cipher to wrap the data key with instead of the one from the key file
+# codec, level: compress the chunks first (see set_compression)
+def encrypt_stream(chunks, dst, noteId=None, kek=None, codec=None, level=None):
+    if kek is None:
+        kek = key_manager.wrap_cipher(create=True)
+    dataKey = AESGCM.generate_key(bit_length=256)
+    aead = AESGCM(dataKey)
+    prefix = os.urandom(8)
+
+    magic = ENVELOPE_MAGIC
+    if codec is not None:
+        magic = COMPRESSED_MAGIC
+        chunks = compress_chunks(chunks, codec, level)
+    header = magic + bytes.fromhex(noteId or new_note_id())
+
+    dst.write(header + wrap_key(kek, dataKey, header) + os.urandom(SLOT_SIZE) + prefix)
+
+    counter = 0
+    pending = b''
+    for chunk in chunks:
+        if not chunk:
+            continue
+
+        # hold one chunk back so the last one can be marked as final
+        if pending:
+            nonce, ad = chunk_params(prefix, counter, False, header)
+            encrypted = aead.encrypt(nonce, pending, ad)
+            dst.write(FRAME_LENGTH.pack(len(encrypted)) + encrypted)
+            counter += 1
+        pending = chunk
+
+    nonce, ad = chunk_params(prefix, counter, True, header)
+    encrypted = aead.encrypt(nonce, pending, ad)
+    dst.write(FRAME_LENGTH.pack(len(encrypted)) + encrypted)
+
+
+# read one frame from src, returns None at the end of the stream
+def read_frame(src):
+    header = src.read(FRAME_LENGTH.size)
+    if not header:
+        return None
+    if len(header) < FRAME_LENGTH.size:
+        raise ValueError('truncated note')
+
+    length, = FRAME_LENGTH.unpack(header)
+    encrypted = src.read(length)
+    if len(encrypted) < length:
+        raise ValueError('truncated note')
+
+    return encrypted
+
+
+# decrypt a streamed note from the file object src, yielding byte chunks as
+# soon as each one is authenticated (and decompressed)
+# aead, kek: the ciphers to use instead of the ones from the key file
+def decrypt_stream(src, aead=None, kek=None):
+    header = src.read(len(STREAM_MAGIC))
+    if header in (NOTE_MAGIC,) + ENVELOPE_MAGICS:
+        header += src.read(ID_SIZE)
+    elif header != STREAM_MAGIC:
+        raise ValueError('not a streamed note')
+
+    if header.startswith(ENVELOPE_MAGICS):
+        if kek is None:
+            kek = key_manager.wrap_cipher()
+        if kek is None:
+            print('error: no key')
+            sys.exit()
+
+        slots = src.read(SLOT_SIZE), src.read(SLOT_SIZE)
+        dataKey, _ = unwrap_key(kek, slots, header)
+        if dataKey is None:
+            raise InvalidTag()
+        aead = AESGCM(dataKey)
+    elif aead is None:
+        aead = key_manager.stream_cipher()
+
+    if aead is None:
+        print('error: no key')
+        sys.exit()
+
+    prefix = src.read(8)
+
+    chunks = decrypt_frames(src, aead, prefix, header)
+    if header.startswith(COMPRESSED_MAGIC):
+        chunks = decompress_chunks(chunks)
+
+    for chunk in chunks:
+        yield chunk
+
+
+# decrypt the frames following a streamed note's header
+def decrypt_frames(src, aead, prefix, header):
+    counter = 0
+    frame = read_frame(src)
+    # every stream ends with a final frame, even an empty note's
+    if frame is None:
+        raise ValueError('truncated note')
+    while frame is not None:
+        following = read_frame(src)
+        nonce, ad = chunk_params(prefix, counter, following is None, header)
+        yield aead.decrypt(nonce, frame, ad)
+        frame = following
+        counter += 1
+
+
+# split text into encoded chunks without encoding all of it at once
+def text_chunks(text):
+    for i in range(0, len(text), CHUNK_SIZE):
+        yield text[i:i + CHUNK_SIZE].encode('utf8')
+
+
+# get the ID stored in a note's header, None for notes written before IDs
+def read_note_id(filePath):
+    durable.wait(filePath)
+
     try:
-        f = open('.key', 'rb')
+        f = open(filePath, 'rb')
     except IOError:
-        generate_key()
-        f = open('.key', 'rb')
+        return None
 
-    key = f.read()
+    header = f.read(len(NOTE_MAGIC) + ID_SIZE)
     f.close()
 
-    original = original.encode('utf8')
-    fern = Fernet(key)
+    if header.startswith((NOTE_MAGIC,) + ENVELOPE_MAGICS) and len(header) == len(NOTE_MAGIC) + ID_SIZE:
+        return header[len(NOTE_MAGIC):].hex()
+    return None
 
-    return fern.encrypt(original)
 
+# compress and encrypt a note's text into filePath, replacing it only once
+# fully written
+# noteId: the note's ID, by default the one already in filePath's header
+def write_note(filePath, text, noteId=None):
+    if noteId is None:
+        noteId = read_note_id(filePath)
 
-def decrypt_file(encrypted):
+    with durable.atomic_open(filePath, group=True) as f:
+        encrypt_stream(text_chunks(text), f, noteId,
+                       codec=compression['codec'], level=compression['level'])
+
+
+# read and decrypt a note, streamed or written by encrypt_file
+def read_note(filePath):
+    durable.wait(filePath)
+
+    f = open(filePath, 'rb')
     try:
-        f = open('.key', 'rb')
-    except IOError:
-        print('error: no key')
-        sys.exit()
+        if f.read(len(STREAM_MAGIC)) not in STREAM_MAGICS:
+            f.seek(0)
+            return decrypt_file(f.read())
 
-    key = f.read()
+        f.seek(0)
+        decoder = codecs.getincrementaldecoder('utf8')()
+        parts = [decoder.decode(chunk) for chunk in decrypt_stream(f)]
+        parts.append(decoder.decode(b'', final=True))
+        return ''.join(parts)
+    finally:
+        f.close()
+
+
+# move an envelope note's data key from the slot oldKek opens to the other
+# slot, wrapped by newKek, then scrub the old slot; only the header is
+# written, and each slot is synced before the next, so after a crash one of
+# the two keys still opens the note
+# returns False if newKek already opened it
+def rewrap_note(filePath, oldKek, newKek):
+    durable.wait(filePath)
+
+    f = open(filePath, 'rb')
+    head = f.read(SLOTS_OFFSET + 2 * SLOT_SIZE)
     f.close()
 
-    fern = Fernet(key)
+    if not head.startswith(ENVELOPE_MAGICS) or len(head) < SLOTS_OFFSET + 2 * SLOT_SIZE:
+        raise ValueError('not an envelope note')
+
+    header = head[:SLOTS_OFFSET]
+    slots = [head[SLOTS_OFFSET + i * SLOT_SIZE:SLOTS_OFFSET + (i + 1) * SLOT_SIZE] for i in range(2)]
+
+    dataKey, current = unwrap_key(newKek, slots, header)
+    if dataKey is not None:
+        # finish the scrub an interrupted rewrap may have left undone
+        other = 1 - current
+        if unwrap_key(oldKek, [slots[other]], header)[0] is not None:
+            durable.write_at(filePath, SLOTS_OFFSET + other * SLOT_SIZE, os.urandom(SLOT_SIZE))
+        return False
+
+    dataKey, current = unwrap_key(oldKek, slots, header)
+    if dataKey is None:
+        raise InvalidTag()
 
-    return fern.decrypt(encrypted).decode('utf8')
+    other = 1 - current
+    durable.write_at(filePath, SLOTS_OFFSET + other * SLOT_SIZE, wrap_key(newKek, dataKey, header))
+    durable.write_at(filePath, SLOTS_OFFSET + current * SLOT_SIZE, os.urandom(SLOT_SIZE))
+    return True
@@ -2,6 +2,7 @@ from PyQt5.QtWidgets import (QApplication, QWidget, QMessageBox, QGridLayout, QF
                              QLabel, QLineEdit, QPushButton, QCheckBox, QComboBox, QFileSystemModel, QTreeView, QSizePolicy)
 from PyQt5 import QtGui, QtCore
 from PyQt5.QtCore import QDir
+from permissions import add_folder_permission
 import os
 import re
 import shutil
@@ -37,6 +38,10 @@ class GroupWindow(QWidget):
         self.fnLineEdit = QLineEdit()
         layout.addRow('Folder Name: ', self.fnLineEdit)
 
+        self.shareLineEdit = QLineEdit()
+        self.shareLineEdit.setPlaceholderText('Usernames separated by commas')
+        layout.addRow('Share With: ', self.shareLineEdit)
+
         gridLayout = QGridLayout()
         saveButton = QPushButton('Create')
         saveButton.clicked.connect(self.createEvent)
@@ -126,14 +131,30 @@ class GroupWindow(QWidget):
             if not self.confirmResponse:
                 return
 
+        # Check the users to share the folder with
+        members = [name.strip() for name in self.shareLineEdit.text().split(',') if name.strip()]
+        unknown = [name for name in members if not os.path.isdir('users/' + name)]
+        if unknown:
+            self.createMessageBox('Unknown user: ' + ', '.join(unknown))
+            return
+
         # Attempt to save file
         if not self.createFolder(filePath):
             self.createMessageBox('Invalid file path.')
             return
 
+        # One folder grant each covers every note in the folder, including
+        # notes saved there later
+        self.shareFolder(filePath, [self.mainWindow.user] + members)
+
         # Close save window
         self.close()
 
+    # Gives each user access to everything in the folder
+    def shareFolder(self, filePath, members):
+        for name in members:
+            add_folder_permission(name, filePath)
+
     # Creates a new folder
     def createFolder(self, filePath):
         try:
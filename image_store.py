@@ -0,0 +1,193 @@
+"""Content-addressed store for images inserted into notes
+
+A user's images are kept in users/<user>/images/ named by the SHA-256 of
+their contents (plus their extension), so inserting an image that is already
+stored, under any name, writes nothing, and two different images with the
+same file name no longer overwrite each other.
+
+REFS_FILE counts the saved notes using each stored image. Every save of a
+note passes its HTML to note_saved(), which compares the images it uses with
+the ones the note used at its previous save. Saving never removes an image,
+since an unsaved note (or an undo) may still use it; sweep() reclaims images
+no saved note uses when the app starts.
+"""
+
+import os
+import re
+import json
+import hashlib
+import time
+import durable
+import metadata_lock
+import note_catalog
+from encrypt_file import encrypt_file, decrypt_file
+
+IMAGES_DIR = 'images'
+
+# encrypted JSON: {'notes': {note ID: [image paths]}, 'refs': {image path: notes using it}}
+REFS_FILE = '.image_refs'
+
+# image sources in a note's HTML, and the stored images among them
+IMAGE_SRC = re.compile(r'<img[^>]*\ssrc="([^"]+)"')
+STORED_IMAGE = re.compile(r'(?:^|/)(users/[^/]+/' + IMAGES_DIR + r'/[0-9a-f]{64}[^/]*)$')
+STORED_NAME = re.compile(r'[0-9a-f]{64}[^/]*$')
+
+# images inserted or reused this recently are never swept, so one another
+# running copy of the app just put into an unsaved note is kept
+SWEEP_GRACE = 24 * 60 * 60
+
+# (path, mtime_ns, size) of inserted files -> stored name, so inserting the
+# same file again doesn't even read it
+_known = {}
+
+# stored images inserted by this process, which sweep() leaves alone
+_inserted = set()
+
+# held while storing an image and for every read and write of REFS_FILE
+lock = metadata_lock.FileLock(REFS_FILE)
+
+
+# directory holding user's images
+def store_dir(user):
+    return 'users/' + user + '/' + IMAGES_DIR
+
+
+def read_refs():
+    try:
+        f = open(REFS_FILE, 'rb')
+    except IOError:
+        return {'notes': {}, 'refs': {}}
+
+    data = f.read()
+    f.close()
+    return json.loads(decrypt_file(data))
+
+
+def write_refs(refs):
+    durable.atomic_write(REFS_FILE, encrypt_file(json.dumps(refs, sort_keys=True)))
+    lock.changed(rewritten=True)
+
+
+def read_file(filePath):
+    f = open(filePath, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+
+# the stored name of filePath's contents, and the contents if they had to be read
+def image_name(filePath):
+    st = os.stat(filePath)
+    stamp = (os.path.abspath(filePath), st.st_mtime_ns, st.st_size)
+    if stamp in _known:
+        return _known[stamp], None
+
+    data = read_file(filePath)
+
+    name = hashlib.sha256(data).hexdigest() + os.path.splitext(filePath)[1].lower()
+    _known[stamp] = name
+    return name, data
+
+
+# store the image at filePath for user, copying it only if its contents
+# aren't stored yet; returns the stored image's path for the note to use
+def add_image(user, filePath):
+    directory = store_dir(user)
+    os.makedirs(directory, exist_ok=True)
+
+    name, data = image_name(filePath)
+    path = directory + '/' + name
+
+    with lock:
+        if os.path.exists(path):
+            # restart its grace period for sweeps by other copies of the app
+            os.utime(path)
+        else:
+            # known from an earlier insert, but swept since
+            if data is None:
+                data = read_file(filePath)
+            durable.create_once(path, data)
+        _inserted.add(path)
+
+    return path
+
+
+# paths of the stored images a note's HTML uses
+def note_images(html):
+    found = set()
+    for src in IMAGE_SRC.findall(html):
+        match = STORED_IMAGE.search(src)
+        if match:
+            found.add(match.group(1))
+    return found
+
+
+# record which stored images the note at filePath uses now that it was saved as html
+def note_saved(filePath, html):
+    images = note_images(html)
+
+    with lock:
+        noteId = note_catalog.note_id(filePath, create=True)
+        refs = read_refs()
+        before = set(refs['notes'].get(noteId, ()))
+        if images == before:
+            return
+
+        for path in images - before:
+            refs['refs'][path] = refs['refs'].get(path, 0) + 1
+
+        for path in before - images:
+            refs['refs'][path] = refs['refs'].get(path, 1) - 1
+            if refs['refs'][path] <= 0:
+                del refs['refs'][path]
+
+        if images:
+            refs['notes'][noteId] = sorted(images)
+        else:
+            refs['notes'].pop(noteId, None)
+
+        write_refs(refs)
+
+
+# stored image path -> number of saved notes using it
+def image_refs():
+    with lock:
+        return read_refs()['refs']
+
+
+# remove stored images no saved note uses, except those inserted by this
+# process or within grace seconds; returns the number removed
+# users: the stores to sweep, every user's by default
+def sweep(grace=SWEEP_GRACE, users=None):
+    if users is None:
+        try:
+            users = os.listdir('users')
+        except OSError:
+            return 0
+
+    removed = 0
+    with lock:
+        used = read_refs()['refs']
+        now = time.time()
+
+        for user in users:
+            directory = store_dir(user)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+
+            for name in names:
+                path = directory + '/' + name
+                if not STORED_NAME.match(name) or path in used or path in _inserted:
+                    continue
+
+                try:
+                    if now - os.stat(path).st_mtime < grace:
+                        continue
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+
+    return removed
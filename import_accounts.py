@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+"""Create many accounts at once from a CSV file, without the GUI
+
+Each row of the CSV is 'username,password,email' (a header row with those
+names is skipped). Rows are checked like the signup window checks them;
+passwords are hashed on a process pool across all cores, every new account
+is written in one atomic update of .note_accounts, then each user gets a
+users/<name> directory and a queued welcome email (sent by the app's
+outbox, or right away with --send).
+
+    $ python import_accounts.py [--workers N] [--send] users.csv
+"""
+
+import os
+import csv
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import account_store
+from encrypt_account import policy, hash_at_cost
+from email_server import outbox
+
+HEADER = ['username', 'password', 'email']
+
+
+# read (line number, username, password, email) rows from a CSV file
+def read_csv(path):
+    rows = []
+
+    f = open(path, 'r', newline='')
+    for number, fields in enumerate(csv.reader(f), 1):
+        fields = [field.strip() for field in fields]
+        if not any(fields):
+            continue
+        if number == 1 and [field.lower() for field in fields] == HEADER:
+            continue
+        if len(fields) != 3:
+            rows.append((number, None, None, None))
+            continue
+        rows.append((number,) + tuple(fields))
+    f.close()
+
+    return rows
+
+
+# split rows into accounts that can be created and (line number, error) pairs
+def check_rows(rows):
+    accounts = []
+    errors = []
+    seen = set()
+
+    for number, username, password, email in rows:
+        if username is None:
+            errors.append((number, 'expected username,password,email'))
+            continue
+
+        problems = account_store.field_errors(username, password, email)
+        if problems:
+            errors.append((number, '; '.join(problems.values())))
+            continue
+
+        # tagged rows are checked without bcrypt, only legacy rows need the slow scan
+        if username in seen or account_store.username_taken(username):
+            errors.append((number, 'Username already taken'))
+            continue
+
+        seen.add(username)
+        accounts.append((username, password, email))
+
+    return accounts, errors
+
+
+# hash every password on a process pool, in the order given
+def hash_passwords(passwords, workers):
+    cost = policy.get_cost()
+    chunk = max(1, len(passwords) // ((workers or os.cpu_count() or 1) * 4))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(hash_at_cost, passwords, [cost] * len(passwords),
+                             chunksize=chunk))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create accounts from a CSV file.')
+    parser.add_argument('csv', help='file of username,password,email rows')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='hashing processes (default: one per core)')
+    parser.add_argument('--send', action='store_true',
+                        help='send the welcome emails now instead of leaving them queued')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+
+    accounts, errors = check_rows(read_csv(args.csv))
+    for number, error in errors:
+        print('line %d skipped: %s' % (number, error), file=sys.stderr)
+
+    if not accounts:
+        print('no accounts to create')
+        return 1 if errors else 0
+
+    hashing = time.perf_counter()
+    hashes = hash_passwords([password for _, password, _ in accounts], args.workers)
+    hashed = time.perf_counter()
+
+    records = [account_store.new_record(username, password_hash, email)
+               for (username, _, email), password_hash in zip(accounts, hashes)]
+
+    # another copy of the app may have taken a username while hashing
+    taken = account_store.add_accounts(records)
+    for (username, _, _), fields in zip(accounts, records):
+        if fields in taken:
+            print('%s skipped: Username already taken' % username, file=sys.stderr)
+    accounts = [account for account, fields in zip(accounts, records) if fields not in taken]
+
+    for username, _, email in accounts:
+        os.makedirs(os.path.join('users', username), exist_ok=True)
+        outbox.queue(email, start=False)
+
+    if args.send:
+        outbox.send_due()
+        outbox.disconnect()
+
+    elapsed = time.perf_counter() - start
+
+    print('created:  %d accounts (%d skipped)' % (len(accounts), len(errors) + len(taken)))
+    print('hashing:  %.1f accounts/sec at cost %d' %
+          (len(hashes) / (hashed - hashing), policy.get_cost()))
+    print('total:    %.1f accounts/sec' % (len(accounts) / elapsed))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
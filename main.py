@@ -4,6 +4,9 @@ import sys
 import os
 from main_window import MainWindow
 from account_windows import LoginWindow
+from email_server import outbox
+from account_reclaim import reclaimer
+import image_store
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtGui import *
 
@@ -33,6 +36,15 @@ def main():
     if not os.path.exists('users/guest'):
         os.makedirs('users/guest')
 
+    # Send any emails still queued from the last run
+    outbox.start()
+
+    # Finish deleting any accounts a crash interrupted
+    reclaimer.start()
+
+    # Remove inserted images no saved note uses
+    image_store.sweep()
+
     login_window = LoginWindow()
     login_window.show()
 
@@ -11,6 +11,7 @@ from PyQt5.QtPrintSupport import QPrintDialog, QPrinter
 from app_widget import AppWidget
 from permissions import check_permission, add_permission
 from save_window import SaveWindow
+import save_worker
 from open_window import OpenWindow
 from account_windows import ChangePasswordWindow, DeleteAccountWindow
 from permission_window import PermissionWindow
@@ -115,6 +116,10 @@ class MainWindow(QMainWindow):
         self.currentFile = ''
         fileMenu.addAction(saveButton)
 
+        # File the user is known to have access to, so saving it again
+        # doesn't need to look at .permissions
+        self.permittedFile = ''
+
         saveAsButton = QAction(saveIcon, 'Save As...', self)
         saveAsButton.setShortcut('Ctrl+Shift+S')
         saveAsButton.triggered.connect(self.saveAsEvent)
@@ -542,6 +547,10 @@ class MainWindow(QMainWindow):
                 self.saveWindow.closeOnSave = True
                 event.ignore()
 
+        # Let a save still running in the background finish before closing
+        if event.isAccepted():
+            save_worker.pool.waitForDone()
+
     # Called when any key is pressed
     def keyPressEvent(self, e):
         self.statusBar().clearMessage()
@@ -618,6 +627,19 @@ class MainWindow(QMainWindow):
             self.saveWindow = SaveWindow(self)
             self.saveWindow.initSaveEvent()
 
+    # Called on the GUI thread when a background save finishes
+    def saveFinishedEvent(self, filePath, ok):
+        if ok:
+            self.statusBar().showMessage('File saved.')
+            return
+
+        # Access to the file may not have been granted, check it on the next save
+        if self.permittedFile == filePath:
+            self.permittedFile = ''
+        self.needsSave = True
+        self.statusBar().showMessage(
+            'Could not save ' + os.path.basename(filePath))
+
     # Opens the file dialog even if a file is already open.
     def saveAsEvent(self):
 
@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+"""Optional SQLite store for accounts and permissions
+
+Once .notes.db exists, account_store and permissions keep their data in it
+instead of .note_accounts and .permissions: lookups go through indexes,
+updates are transactions, and WAL mode lets other copies of the app read
+while one writes. Passwords stay bcrypt hashed and usernames and emails
+stay keyed digests, as in .note_accounts. Grants are stored under the same
+username digests, with each username kept encrypted once in grant_users so
+the users holding a note can still be listed; their keys are the catalog's
+random IDs, which mean nothing without the encrypted .note_catalog.
+
+Create it from the existing files with:
+
+    $ python metadata_db.py migrate
+"""
+
+import os
+import sys
+import sqlite3
+import threading
+from encrypt_file import encrypt_file, decrypt_file
+
+DB_FILE = '.notes.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY,
+    tag TEXT UNIQUE,
+    user TEXT NOT NULL,
+    password TEXT NOT NULL,
+    email TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS grants (
+    user TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (user, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS grants_by_key ON grants (key, user);
+CREATE TABLE IF NOT EXISTS grant_users (
+    tag TEXT PRIMARY KEY,
+    name BLOB NOT NULL
+) WITHOUT ROWID;
+"""
+
+# one connection per thread, sqlite3 connections can't be shared between them
+_local = threading.local()
+
+# username digest -> username, for the users this process has seen
+_names = {}
+
+
+# true if the SQLite store is in use
+def enabled():
+    return os.path.exists(DB_FILE)
+
+
+# open a connection to path set up for the store
+def open_db(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=FULL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# this thread's connection to .notes.db, reopened if the file was replaced
+def connection():
+    st = os.stat(DB_FILE)
+    conn = getattr(_local, 'conn', None)
+
+    if conn is None or _local.inode != st.st_ino:
+        if conn is not None:
+            conn.close()
+        conn = open_db(DB_FILE)
+        _local.conn = conn
+        _local.inode = st.st_ino
+
+    return conn
+
+
+# close this thread's connection
+def close():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+# accounts
+
+# (row id, None) of the account with the given username tag, or None
+def account_place(tag):
+    row = connection().execute('SELECT id FROM accounts WHERE tag = ?', (tag,)).fetchone()
+    return (row[0], None) if row else None
+
+
+# (row id, None) of every account stored before the username index
+def legacy_places():
+    rows = connection().execute('SELECT id FROM accounts WHERE tag IS NULL ORDER BY id')
+    return [(row[0], None) for row in rows]
+
+
+# the fields of the account in the given row, as .note_accounts would hold them
+def read_account(rowid):
+    row = connection().execute('SELECT tag, user, password, email FROM accounts WHERE id = ?',
+                               (rowid,)).fetchone()
+    if row is None:
+        return []
+    return [field for field in row if field is not None]
+
+
+# split .note_accounts style fields into (tag, user, password, email)
+def account_values(fields):
+    if len(fields) == 4:
+        return tuple(fields)
+    return (None,) + tuple(fields[:3])
+
+
+def insert_accounts(records):
+    conn = connection()
+    with conn:
+        conn.executemany('INSERT INTO accounts (tag, user, password, email) VALUES (?, ?, ?, ?)',
+                         [account_values(fields) for fields in records])
+
+
+def update_account(rowid, fields):
+    conn = connection()
+    with conn:
+        conn.execute('UPDATE accounts SET tag = ?, user = ?, password = ?, email = ? WHERE id = ?',
+                     account_values(fields) + (rowid,))
+
+
+def delete_account(rowid):
+    conn = connection()
+    with conn:
+        conn.execute('DELETE FROM accounts WHERE id = ?', (rowid,))
+
+
+# permissions
+
+# the digest grants are stored under for user
+def user_tag(user):
+    import account_store
+
+    tag = account_store.username_tag(user)
+    _names[tag] = user
+    return tag
+
+
+# the username behind a digest, decrypting its grant_users entry if needed
+def user_name(tag, name):
+    if tag not in _names:
+        _names[tag] = decrypt_file(name)
+    return _names[tag]
+
+
+# store grants of keys to user, in an open transaction
+def insert_grants(conn, user, keys):
+    tag = user_tag(user)
+    conn.execute('INSERT OR IGNORE INTO grant_users (tag, name) VALUES (?, ?)',
+                 (tag, encrypt_file(user)))
+    conn.executemany('INSERT OR IGNORE INTO grants (user, key) VALUES (?, ?)',
+                     [(tag, key) for key in keys])
+
+
+# apply a .permissions log record ('grant <user> <key> ...' or 'drop <user>')
+def apply_permission_record(record):
+    fields = record.split()
+    conn = connection()
+
+    with conn:
+        if fields[0] == 'grant':
+            insert_grants(conn, fields[1], fields[2:])
+        elif fields[0] == 'drop':
+            tag = user_tag(fields[1])
+            conn.execute('DELETE FROM grants WHERE user = ?', (tag,))
+            conn.execute('DELETE FROM grant_users WHERE tag = ?', (tag,))
+
+
+# true if the user holds any grant
+def has_grants(user):
+    return connection().execute('SELECT 1 FROM grants WHERE user = ? LIMIT 1',
+                                (user_tag(user),)).fetchone() is not None
+
+
+# keys granted to any of users
+def keys_of(users):
+    tags = [user_tag(user) for user in users]
+    rows = connection().execute(
+        'SELECT key FROM grants WHERE user IN (%s)' % ','.join('?' * len(tags)), tags)
+    return [row[0] for row in rows]
+
+
+# users granted any of keys
+def users_of(keys):
+    if not keys:
+        return set()
+    rows = connection().execute(
+        'SELECT DISTINCT grant_users.tag, grant_users.name FROM grants '
+        'JOIN grant_users ON grant_users.tag = grants.user '
+        'WHERE grants.key IN (%s)' % ','.join('?' * len(keys)), keys)
+    return {user_name(tag, name) for tag, name in rows}
+
+
+# replace every encrypted username with reencrypt(name), or keep it where
+# that returns None, in one transaction (see rotate_key)
+def reencrypt_names(reencrypt):
+    conn = connection()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        rows = conn.execute('SELECT tag, name FROM grant_users').fetchall()
+        updates = [(reencrypt(name), tag) for tag, name in rows]
+        conn.executemany('UPDATE grant_users SET name = ? WHERE tag = ?',
+                         [(name, tag) for name, tag in updates if name is not None])
+
+
+# drop grants whose key fails keep(key)
+def prune_grants(keep):
+    conn = connection()
+    with conn:
+        gone = [(key,) for key, in conn.execute('SELECT DISTINCT key FROM grants') if not keep(key)]
+        conn.executemany('DELETE FROM grants WHERE key = ?', gone)
+
+
+# move everything in .note_accounts and .permissions into a new .notes.db in
+# one transaction; the old files are kept with a '.migrated' suffix
+def migrate():
+    import account_store
+    import permissions
+
+    if enabled():
+        return False
+
+    with account_store.lock, permissions.lock:
+        rows = account_store.read_rows()
+        users = permissions.load_index()
+
+        tmp = DB_FILE + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+        conn = open_db(tmp)
+        with conn:
+            conn.executemany('INSERT INTO accounts (tag, user, password, email) VALUES (?, ?, ?, ?)',
+                             [account_values(fields) for fields in rows])
+            for user, keys in users.items():
+                insert_grants(conn, user, keys)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.close()
+
+        # switching to the store is the rename, a crash before it leaves the files in use
+        os.replace(tmp, DB_FILE)
+
+        for path in (account_store.ACCOUNTS_FILE, permissions.PERMISSIONS_FILE):
+            if os.path.exists(path):
+                os.replace(path, path + '.migrated')
+
+        account_store.invalidate_index()
+        permissions.invalidate_index()
+
+    return True
+
+
+def main():
+    if sys.argv[1:] != ['migrate']:
+        print('usage: python metadata_db.py migrate')
+        return 1
+
+    if not migrate():
+        print(DB_FILE + ' already exists')
+        return 1
+
+    print('moved accounts and permissions into ' + DB_FILE)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
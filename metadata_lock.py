@@ -0,0 +1,149 @@
+"""Locks shared by every copy of the app using the same data directory
+
+Each metadata file (.note_accounts, .permissions, .note_catalog) has a lock
+file next to it. Holding the lock means holding an advisory fcntl lock on
+that file as well as a thread lock, so reads and writes of the metadata file
+are serialized across processes and threads alike.
+
+The lock file also holds a version counter, bumped by every write to the
+metadata file, and a generation counter, bumped when the file is rewritten
+rather than appended to. Cached indexes include both in their file stamps,
+so a change made by another process is always noticed (an inode number can
+be reused by a later rewrite, a generation can't), and update() uses the
+version to check a slow decision made without the lock before committing it
+(compare and swap).
+"""
+
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # no fcntl on Windows: the lock only covers this process's threads
+    fcntl = None
+
+# lock file contents: version, generation
+COUNTERS = struct.Struct('>QQ')
+
+# how many times update() rechecks before it holds the lock for the check too
+RETRIES = 3
+
+
+class FileLock:
+    """Reentrant lock on a metadata file, shared by threads and processes
+
+    Use it as a context manager; nested blocks in the same thread only take
+    the process lock once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.RLock()
+        self.depth = 0
+        self.owner = None
+        self.fd = None
+        self.retries = 0
+
+    # the lock file's path, relative to the directory in use when it is taken
+    def lock_path(self):
+        return self.path + '.lock'
+
+    def acquire(self):
+        self.local.acquire()
+
+        if self.depth == 0:
+            try:
+                # opened on every acquire, so a forked process never shares a lock
+                fd = os.open(self.lock_path(), os.O_RDWR | os.O_CREAT, 0o666)
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+            except BaseException:
+                self.local.release()
+                raise
+            self.fd = fd
+            self.owner = threading.get_ident()
+
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+
+        if self.depth == 0:
+            fd, self.fd = self.fd, None
+            self.owner = None
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+        self.local.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    # (version, generation), both 0 before the first write; doesn't need the lock
+    def counters(self):
+        if self.owner == threading.get_ident():
+            return read_counters(self.fd)
+
+        try:
+            fd = os.open(self.lock_path(), os.O_RDONLY)
+        except OSError:
+            return (0, 0)
+
+        try:
+            return read_counters(fd)
+        finally:
+            os.close(fd)
+
+    def version(self):
+        return self.counters()[0]
+
+    # identifies the current version of the metadata file on disk, None if it
+    # doesn't exist; the file's identity is its inode and how many times it
+    # was rewritten
+    def stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+
+        version, generation = self.counters()
+        return (st.st_mtime_ns, st.st_size, (st.st_ino, generation), version)
+
+    # record a write to the metadata file; must be called holding the lock
+    # rewritten: the file was replaced, not appended to or written in place
+    def changed(self, rewritten=False):
+        version, generation = read_counters(self.fd)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, COUNTERS.pack(version + 1, generation + rewritten))
+
+    # run check() and then, holding the lock, commit(its result) if nothing
+    # was written in between; otherwise check again, and after RETRIES
+    # attempts run both holding the lock. Returns commit's result.
+    def update(self, check, commit):
+        for _ in range(RETRIES):
+            seen = self.version()
+            result = check()
+
+            with self:
+                if self.version() == seen:
+                    return commit(result)
+
+            self.retries += 1
+
+        with self:
+            return commit(check())
+
+
+def read_counters(fd):
+    os.lseek(fd, 0, os.SEEK_SET)
+    data = os.read(fd, COUNTERS.size)
+    if len(data) < COUNTERS.size:
+        return (0, 0)
+    return COUNTERS.unpack(data)
@@ -0,0 +1,332 @@
+"""Catalog of note and folder IDs
+
+Every note and folder under users/ gets a persistent ID; permissions and
+caches are keyed by it instead of by path. The catalog stores each entry as
+(ID, parent folder's ID, name), so a path is found by walking its components
+and renaming or moving a folder is one record, however many notes it holds.
+A note's ID is also kept in its header (see encrypt_file), so a note moved
+outside the app is linked back to its entry the next time it is seen.
+"""
+
+import os
+import durable
+import record_log
+import metadata_lock
+from contextlib import contextmanager
+from encrypt_file import read_note_id, new_note_id
+
+CATALOG_FILE = '.note_catalog'
+
+# .note_catalog is a log of individually encrypted records (see record_log)
+# after MAGIC
+# a record is 'put <id> <parent id> <name>' (add or move an entry; the name
+# is the rest of the line) or 'remove <id>' (an entry and everything in it)
+MAGIC = b'NOTECAT1\n'
+
+# ID of the folder paths are relative to
+ROOT = 'root'
+
+# the log is compacted once it holds this many more records than entries
+COMPACT_SLACK = 1000
+
+# parsed copy of .note_catalog, reloaded only when the file on disk changes
+#   entries: id -> (parent id, name), children: parent id -> {name: id}
+_catalog = {'stamp': None, 'entries': {}, 'children': {}, 'offset': 0, 'records': 0}
+
+# framed records held back by batch() to be written with one append
+_batch = {'depth': 0, 'frames': []}
+
+# held for every read and write of .note_catalog and the cached catalog
+lock = metadata_lock.FileLock(CATALOG_FILE)
+
+
+
+# catalog paths start at 'users', whatever directory the app was started from
+def relative_path(fullpath):
+    short = fullpath.find('users')
+    if short > 0:
+        fullpath = fullpath[short:]
+
+    return fullpath.rstrip('/')
+
+
+# take id and everything in it out of the catalog
+def drop_entry(entries, children, noteId):
+    stack = [noteId]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.pop(current, {}).values())
+
+        entry = entries.pop(current, None)
+        if entry is not None:
+            siblings = children.get(entry[0])
+            if siblings is not None and siblings.get(entry[1]) == current:
+                del siblings[entry[1]]
+
+
+# apply one decrypted log record to the catalog
+def apply_record(entries, children, record):
+    fields = record.split(' ', 3)
+
+    if fields[0] == 'put' and len(fields) == 4:
+        noteId, parent, name = fields[1:]
+
+        old = entries.get(noteId)
+        if old is not None and children.get(old[0], {}).get(old[1]) == noteId:
+            del children[old[0]][old[1]]
+
+        # an entry moved over another replaces it
+        replaced = children.get(parent, {}).get(name)
+        if replaced is not None and replaced != noteId:
+            drop_entry(entries, children, replaced)
+
+        entries[noteId] = (parent, name)
+        children.setdefault(parent, {})[name] = noteId
+    elif fields[0] == 'remove':
+        drop_entry(entries, children, fields[1])
+
+
+# get the catalog, reading only what changed in .note_catalog
+def load_catalog():
+    with lock:
+        stamp = lock.stamp()
+
+        if stamp is not None and stamp == _catalog['stamp']:
+            return _catalog
+
+        # the log only grew: read just the new records
+        old = _catalog['stamp']
+        if (stamp is not None and old is not None and
+                stamp[2] == old[2] and stamp[1] > _catalog['offset']):
+            start = _catalog['offset']
+            entries = _catalog['entries']
+            children = _catalog['children']
+            records = _catalog['records']
+        else:
+            start = len(MAGIC)
+            entries = {}
+            children = {}
+            records = 0
+
+        offset = start
+        if stamp is not None:
+            f = open(CATALOG_FILE, 'rb')
+            f.seek(start)
+            data = f.read()
+            f.close()
+
+            read, used = record_log.read_records(data)
+            for record in read:
+                apply_record(entries, children, record)
+            records += len(read)
+
+            offset = start + used
+
+        _catalog.update(stamp=stamp, entries=entries, children=children,
+                        offset=offset, records=records)
+
+        return _catalog
+
+
+# forget the cached catalog so the next lookup reads .note_catalog again
+def invalidate_catalog():
+    with lock:
+        _catalog.update(stamp=None, entries={}, children={}, offset=0, records=0)
+
+
+# rewrite .note_catalog with one record per entry
+def compact():
+    with lock:
+        catalog = load_catalog()
+        children = catalog['children']
+
+        with durable.atomic_open(CATALOG_FILE) as f:
+            f.write(MAGIC)
+            records = 0
+
+            # parents are written before the entries inside them
+            stack = [ROOT]
+            while stack:
+                parent = stack.pop()
+                for name, noteId in children.get(parent, {}).items():
+                    f.write(record_log.frame('put %s %s %s' % (noteId, parent, name)))
+                    records += 1
+                    stack.append(noteId)
+            offset = f.tell()
+
+        lock.changed(rewritten=True)
+        _catalog.update(stamp=lock.stamp(), offset=offset, records=records)
+
+
+# write the records of the block in one append (and one fsync) at its end
+@contextmanager
+def batch():
+    with lock:
+        _batch['depth'] += 1
+        try:
+            yield
+        finally:
+            _batch['depth'] -= 1
+            if _batch['depth'] == 0 and _batch['frames']:
+                data = b''.join(_batch['frames'])
+                _batch['frames'] = []
+                write_frames(data)
+
+
+# append framed records to the log; they must already be applied to the
+# cached catalog, which is kept in step with the file
+def write_frames(data):
+    with lock:
+        in_step = lock.stamp() == _catalog['stamp']
+
+        durable.append(CATALOG_FILE, data, group=True)
+        lock.changed()
+
+        if in_step:
+            _catalog['offset'] += len(data)
+            _catalog['stamp'] = lock.stamp()
+        else:
+            invalidate_catalog()
+
+        if _catalog['records'] > len(load_catalog()['entries']) + COMPACT_SLACK:
+            compact()
+
+
+# add one record to the log and the cached catalog
+def append_record(record):
+    with lock:
+        load_catalog()
+
+        if lock.stamp() is None:
+            compact()
+
+        apply_record(_catalog['entries'], _catalog['children'], record)
+        _catalog['records'] += 1
+
+        if _batch['depth']:
+            _batch['frames'].append(record_log.frame(record))
+        else:
+            write_frames(record_log.frame(record))
+
+
+# IDs of the entries along path, from its top folder down; shorter than the
+# path if part of it isn't in the catalog
+def ids_along(fullpath):
+    with lock:
+        children = load_catalog()['children']
+
+        found = []
+        parent = ROOT
+        for name in relative_path(fullpath).split('/'):
+            parent = children.get(parent, {}).get(name)
+            if parent is None:
+                break
+            found.append(parent)
+
+        return found
+
+
+# get the ID of the note or folder at path, None if it has none
+# create: give it an ID (and the folders holding it) if it has none; a note
+# that already has an ID in its header keeps it
+def note_id(fullpath, create=False):
+    with lock:
+        path = relative_path(fullpath)
+        names = path.split('/')
+
+        found = ids_along(path)
+        if len(found) == len(names):
+            return found[-1]
+        if not create:
+            return None
+
+        parent = found[-1] if found else ROOT
+        for depth in range(len(found), len(names)):
+            noteId = None
+            if depth == len(names) - 1:
+                noteId = adopt_id(path)
+
+            noteId = noteId or new_note_id()
+            append_record('put %s %s %s' % (noteId, parent, names[depth]))
+            parent = noteId
+
+        return parent
+
+
+# the ID in the header of the note at path, if the catalog can take it:
+# it is new to the catalog, or its entry's path is gone (the note was moved
+# outside the app); a copy of a note that is still in place gets a new ID
+def adopt_id(path):
+    if not os.path.isfile(path):
+        return None
+
+    noteId = read_note_id(path)
+    if noteId is None or noteId not in load_catalog()['entries']:
+        return noteId
+
+    old = path_of(noteId)
+    if old is not None and os.path.exists(old):
+        return None
+    return noteId
+
+
+# get the path of the entry with the given ID, None if it isn't in the catalog
+def path_of(noteId):
+    with lock:
+        entries = load_catalog()['entries']
+
+        names = []
+        while noteId != ROOT:
+            entry = entries.get(noteId)
+            if entry is None:
+                return None
+            names.append(entry[1])
+            noteId = entry[0]
+
+        return '/'.join(reversed(names))
+
+
+# IDs of every entry inside the folder at path
+def ids_under(fullpath):
+    with lock:
+        children = load_catalog()['children']
+
+        top = note_id(fullpath)
+        if top is None:
+            return []
+
+        found = []
+        stack = [top]
+        while stack:
+            for noteId in children.get(stack.pop(), {}).values():
+                found.append(noteId)
+                stack.append(noteId)
+
+        return found
+
+
+# rename or move the note or folder at oldPath to newPath, on disk and in the
+# catalog; everything keyed by its ID (and by the IDs inside a folder) follows
+# it with a single record
+def move(oldPath, newPath):
+    with lock:
+        noteId = note_id(oldPath, create=os.path.exists(oldPath))
+
+        newParent = os.path.dirname(relative_path(newPath))
+        parent = note_id(newParent, create=True) if newParent else ROOT
+
+        if os.path.exists(oldPath):
+            durable.wait(oldPath)
+            os.replace(oldPath, newPath)
+
+        if noteId is not None:
+            append_record('put %s %s %s' % (noteId, parent, os.path.basename(relative_path(newPath))))
+
+
+# take the note or folder at path and everything in it out of the catalog;
+# whatever was keyed by their IDs no longer applies to anything
+def remove(fullpath):
+    with lock:
+        noteId = note_id(fullpath)
+        if noteId is not None:
+            append_record('remove ' + noteId)
@@ -1,11 +1,147 @@
 import os
-import re
+from collections import OrderedDict
 from PyQt5 import QtCore
-from PyQt5.QtWidgets import QWidget, QFileSystemModel, QGridLayout, QFormLayout, QSizePolicy, QTreeView, QPushButton, QMessageBox
-from PyQt5.QtCore import QDir, Qt
-from PyQt5.QtGui import QTextCursor
-from permissions import check_permission, add_permission
-from encrypt_file import decrypt_file
+from PyQt5.QtWidgets import (QWidget, QGridLayout, QFormLayout, QSizePolicy, QTreeView,
+                             QPushButton, QMessageBox, QFileIconProvider)
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QTextCursor, QStandardItemModel, QStandardItem
+from permissions import check_permission, add_permission, get_permissions
+from note_catalog import note_id, relative_path
+from encrypt_file import read_note
+import durable
+
+# item data roles used by PermittedFileModel
+PATH_ROLE = Qt.UserRole
+LOADED_ROLE = Qt.UserRole + 1
+
+
+class DocumentCache:
+    """Keeps recently opened notes decrypted, keyed by note ID and checked
+    against the file's version on disk, so a renamed or moved note stays cached"""
+
+    def __init__(self, maxDocuments=16, maxChars=64 * 1024 * 1024):
+        self.maxDocuments = maxDocuments
+        self.maxChars = maxChars
+        self.chars = 0
+        self.documents = OrderedDict()
+        self.hits = 0
+
+    # identifies the version of filePath on disk
+    def fileStamp(self, filePath):
+        durable.wait(filePath)
+        st = os.stat(filePath)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    # get the decrypted text of filePath, only decrypting it if it isn't cached
+    def load(self, filePath):
+        stamp = self.fileStamp(filePath)
+        noteId = note_id(filePath, create=True)
+        entry = self.documents.get(noteId)
+
+        if entry is not None and entry[0] == stamp:
+            self.documents.move_to_end(noteId)
+            self.hits += 1
+            return entry[1]
+
+        html = read_note(filePath)
+        self.put(noteId, stamp, html)
+        return html
+
+    def put(self, noteId, stamp, html):
+        old = self.documents.pop(noteId, None)
+        if old is not None:
+            self.chars -= len(old[1])
+
+        if len(html) > self.maxChars:
+            return
+
+        self.documents[noteId] = (stamp, html)
+        self.chars += len(html)
+
+        # drop the least recently opened notes
+        while len(self.documents) > self.maxDocuments or self.chars > self.maxChars:
+            _, (_, dropped) = self.documents.popitem(last=False)
+            self.chars -= len(dropped)
+
+
+# shared by every open window, so it outlives the window itself
+documentCache = DocumentCache()
+
+
+class PermittedFileModel(QStandardItemModel):
+    """Lists only the notes a user may open, reading each folder when it is first expanded"""
+
+    def __init__(self, user, root='users'):
+        super().__init__()
+
+        self.setHorizontalHeaderLabels(['Name'])
+        self.iconProvider = QFileIconProvider()
+
+        # one permissions lookup for the whole listing; paths ending in '/'
+        # are shared folders, everything inside them is permitted
+        self.permitted = set(get_permissions(user))
+
+        # folders holding at least one permitted note or shared folder
+        self.folders = set()
+        for path in self.permitted:
+            parts = path.split('/')
+            for i in range(1, len(parts)):
+                self.folders.add('/'.join(parts[:i]))
+
+        self.populate(self.invisibleRootItem(), root)
+
+    # true if path is inside a shared folder
+    def shared(self, path):
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            if '/'.join(parts[:i]) + '/' in self.permitted:
+                return True
+        return False
+
+    # add the permitted notes and folders inside directory under parent
+    def populate(self, parent, directory):
+        try:
+            entries = sorted(os.scandir(directory),
+                             key=lambda e: (not e.is_dir(), e.name.lower()))
+        except OSError:
+            return
+
+        for entry in entries:
+            path = directory + '/' + entry.name
+
+            if entry.is_dir():
+                if relative_path(path) not in self.folders and not self.shared(relative_path(path)):
+                    continue
+                item = QStandardItem(self.iconProvider.icon(QFileIconProvider.Folder), entry.name)
+                item.setData(False, LOADED_ROLE)
+                # placeholder so the folder can be expanded before it is read
+                item.appendRow(QStandardItem())
+            elif entry.name.endswith('.txt') and (relative_path(path) in self.permitted or
+                                                  self.shared(relative_path(path))):
+                item = QStandardItem(self.iconProvider.icon(QFileIconProvider.File), entry.name)
+            else:
+                continue
+
+            item.setData(path, PATH_ROLE)
+            item.setEditable(False)
+            parent.appendRow(item)
+
+    # read a folder the first time it is expanded
+    def expandEvent(self, index):
+        item = self.itemFromIndex(index)
+        if item is None or item.data(LOADED_ROLE) is not False:
+            return
+
+        item.setData(True, LOADED_ROLE)
+        item.removeRows(0, item.rowCount())
+        self.populate(item, item.data(PATH_ROLE))
+
+    # path of the item at index, relative to the working directory
+    def filePath(self, index):
+        return self.data(index.siblingAtColumn(0), PATH_ROLE) or ''
+
+    def isDir(self, index):
+        return self.data(index.siblingAtColumn(0), LOADED_ROLE) is not None
 
 
 class OpenWindow(QWidget):
@@ -22,16 +158,12 @@ class OpenWindow(QWidget):
 
         self.openPath = ''
 
-        self.fileModel = QFileSystemModel()
-        self.fileModel.setRootPath(QDir.currentPath() + '/users/')
-        filters = ['*.txt']
-        self.fileModel.setNameFilters(filters)
+        self.fileModel = PermittedFileModel(self.mainWindow.user)
 
         self.fileTree = QTreeView()
         self.fileTree.setModel(self.fileModel)
-        self.fileTree.setRootIndex(
-            self.fileModel.index(QDir.currentPath() + '/users/'))
         self.fileTree.setColumnWidth(0, 500)
+        self.fileTree.expanded.connect(self.fileModel.expandEvent)
         self.fileTree.doubleClicked.connect(self.openEvent)
         self.layout.addRow(self.fileTree)
 
@@ -56,15 +188,10 @@ class OpenWindow(QWidget):
     # Opens the file selected in the QTreeView
     def openEvent(self):
 
-        indexItem = self.fileModel.index(self.fileTree.currentIndex(
-        ).row(), 0, self.fileTree.currentIndex().parent())
-        filePath = self.fileModel.filePath(indexItem)
-        removePath = QDir.currentPath() + '/'
-        redata = re.compile(re.escape(removePath), re.IGNORECASE)
-        filePath = redata.sub('', filePath)
+        filePath = self.fileModel.filePath(self.fileTree.currentIndex())
 
         # Cannot open directories
-        if self.fileModel.isDir(self.fileTree.currentIndex()):
+        if filePath == '' or self.fileModel.isDir(self.fileTree.currentIndex()):
             return
 
         # Open file dialog
@@ -80,6 +207,7 @@ class OpenWindow(QWidget):
             if not self.mainWindow.needsSave or self.mainWindow.saveMessageSuccess:
                 self.openFile(filePath)
                 self.mainWindow.currentFile = filePath
+                self.mainWindow.permittedFile = filePath
                 self.mainWindow.window_title = f"Notepad App - {os.path.basename(filePath)}"
                 self.mainWindow.setWindowTitle(self.mainWindow.window_title)
 
@@ -106,8 +234,6 @@ class OpenWindow(QWidget):
                     'Sign into account to open private file: ' + os.path.basename(filePath))
             msg.exec_()
 
-    # Opens file and reads the text to QTextEdit
+    # Opens file and reads the text to QTextEdit, reusing a recently decrypted copy
     def openFile(self, filePath):
-        f = open(filePath, 'rb')
-        self.textEdit.setHtml(decrypt_file(f.read()))
-        f.close()
+        self.textEdit.setHtml(documentCache.load(filePath))
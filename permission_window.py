@@ -2,7 +2,7 @@ from PyQt5.QtWidgets import (QApplication, QWidget, QMessageBox, QFormLayout, QG
                              QLabel, QComboBox, QLineEdit, QPushButton, QCheckBox)
 from PyQt5 import QtGui
 from PyQt5 import QtCore
-from permissions import check_permission, add_permission
+from permissions import users_with_access, add_permission
 import os
 
 
@@ -19,9 +19,13 @@ class PermissionWindow(QWidget):
 
         self.userBox = QComboBox()
 
-        for name in os.listdir('users/'):
-            if name != self.mainWindow.user and not check_permission(name, self.mainWindow.currentFile):
-                self.userBox.addItem(name)
+        # users who can already see the file, everyone if guest can
+        granted = users_with_access(self.mainWindow.currentFile)
+
+        if 'guest' not in granted:
+            for name in os.listdir('users/'):
+                if name != self.mainWindow.user and name not in granted:
+                    self.userBox.addItem(name)
 
         layout.addRow('Choose User:', self.userBox)
 
@@ -1,5 +1,10 @@
 import os
-from encrypt_file import encrypt_file, decrypt_file
+import durable
+import record_log
+import note_catalog
+import metadata_db
+import metadata_lock
+from encrypt_file import decrypt_file
 
 
 class dictionary(dict):
@@ -10,113 +15,371 @@ class dictionary(dict):
         self[key] = value
 
 
-# get permissions for the user
-def get_permissions(user):
-    account_permissions = []
+PERMISSIONS_FILE = '.permissions'
+
+# .permissions is a log of individually encrypted records (see record_log)
+# after MAGIC
+# a record is 'grant <user> <key> [<key> ...]' or 'drop <user>'
+# a key is a note's ID from note_catalog, or a folder's ID followed by '/',
+# which covers everything inside the folder, including notes saved there
+# later; grants follow their notes and folders when they are renamed or moved
+# logs written before note IDs hold paths in place of keys (with spaces
+# replaced by underscores) and 'forget <prefix>' records, and files written
+# before the log format are a single encrypted blob of '<user> <path> ...'
+# lines; paths are looked up in the catalog as they are read, and both are
+# rewritten with keys when the log is next compacted
+# with the SQLite store turned on (see metadata_db) records are applied to
+# its grants table instead of being appended here
+MAGIC = b'NOTEPERM1\n'
+
+# compaction groups each user's keys into records of this many keys
+RECORD_PATHS = 512
+
+# the log is compacted once it holds this many more records than a freshly
+# compacted copy would
+COMPACT_SLACK = 1000
+
+
+# parsed copy of .permissions (user -> set of keys, and the reverse, key ->
+# set of users), reloaded only when the file on disk changes; for the log
+# format only new records are read
+_index = {'stamp': None, 'users': {}, 'keys': {}, 'log': False, 'offset': 0, 'records': 0}
+
+# number of times .permissions has been looked at on disk
+counters = {'reads': 0}
+
+# held for every read and write of .permissions and the cached index
+lock = metadata_lock.FileLock(PERMISSIONS_FILE)
+
+
+
+# true if a granted field is a key rather than a path from an older log
+def is_key(field):
+    noteId = field[:-1] if field.endswith('/') else field
+    return len(noteId) == 32 and all(c in '0123456789abcdef' for c in noteId)
+
+
+# find the real path of a path stored with spaces replaced by underscores
+def unmangle(path):
+    parts = []
+    for name in path.split('/'):
+        directory = '/'.join(parts) or '.'
+        if '_' in name and not os.path.exists(os.path.join(directory, name)):
+            try:
+                for entry in os.listdir(directory):
+                    if entry.replace(' ', '_') == name:
+                        name = entry
+                        break
+            except OSError:
+                pass
+        parts.append(name)
+
+    return '/'.join(parts)
+
+
+# the key for a granted field, looking paths from older logs up in the catalog
+def to_key(field):
+    if is_key(field):
+        return field
+
+    folder = field.endswith('/')
+    noteId = note_catalog.note_id(unmangle(normalize_path(field).rstrip('/')), create=True)
+    return noteId + '/' if folder else noteId
+
+
+# give user each of granted in both directions of the index
+def grant(users, keys, user, granted):
+    users.setdefault(user, set()).update(granted)
+    for key in granted:
+        keys.setdefault(key, set()).add(user)
 
-    try:
-        f = open('.permissions', 'rb')
-    except IOError:
-        return account_permissions
 
-    decrypted = decrypt_file(f.read())
+# take user's key away in both directions of the index
+def revoke(users, keys, user, key):
+    users[user].discard(key)
+    if not users[user]:
+        del users[user]
 
+    keys[key].discard(user)
+    if not keys[key]:
+        del keys[key]
+
+
+# apply one decrypted log record to the index
+def apply_record(users, keys, record):
+    fields = record.split()
+    if not fields:
+        return
+
+    if fields[0] == 'grant':
+        grant(users, keys, fields[1], [to_key(field) for field in fields[2:]])
+    elif fields[0] == 'drop':
+        for key in list(users.get(fields[1], ())):
+            revoke(users, keys, fields[1], key)
+    elif fields[0] == 'forget':
+        folder = unmangle(normalize_path(fields[1]).rstrip('/'))
+        top = note_catalog.note_id(folder)
+        if top is None:
+            return
+        for noteId in note_catalog.ids_under(folder) + [top]:
+            for key in (noteId, noteId + '/'):
+                for user in list(keys.get(key, ())):
+                    revoke(users, keys, user, key)
+
+
+# apply every complete record in data, returns (bytes consumed, records read)
+# a record cut short by a concurrent append is left for the next read
+def read_records(data, users, keys):
+    records, used = record_log.read_records(data)
+    for record in records:
+        apply_record(users, keys, record)
+
+    return used, len(records)
+
+
+# parse a .permissions file written before the log format
+def read_legacy(data, users, keys):
     # check every line in .permissions
-    for line in decrypted.splitlines():
+    for line in decrypt_file(data).splitlines():
         account = line.split()
         if not account:
             continue
-        cur_user = account[0]
-        if cur_user == user or cur_user == 'guest':
-            for permission in account[1:]:
-                account_permissions.append(permission)
+        grant(users, keys, account[0], [to_key(field) for field in account[1:]])
 
-    f.close()
 
-    return account_permissions
+# get the user -> set of keys index, reading only what changed in .permissions
+def load_index():
+    with lock:
+        counters['reads'] += 1
+        stamp = lock.stamp()
 
+        if stamp is not None and stamp == _index['stamp']:
+            return _index['users']
 
-# check all files that this account can access, compare to given filename
-def check_permission(account, fullpath):
-    permissions = get_permissions(account)
+        # the log only grew: read just the new records
+        old = _index['stamp']
+        if (stamp is not None and old is not None and _index['log'] and
+                stamp[2] == old[2] and stamp[1] > _index['offset']):
+            f = open(PERMISSIONS_FILE, 'rb')
+            f.seek(_index['offset'])
+            with note_catalog.batch():
+                used, records = read_records(f.read(), _index['users'], _index['keys'])
+            f.close()
+
+            _index['offset'] += used
+            _index['records'] += records
+            _index['stamp'] = stamp
+            return _index['users']
 
+        users = {}
+        keys = {}
+        log = False
+        offset = 0
+        records = 0
+
+        if stamp is not None:
+            f = open(PERMISSIONS_FILE, 'rb')
+            data = f.read()
+            f.close()
+
+            # paths from older files are given catalog IDs with one write
+            with note_catalog.batch():
+                if data.startswith(MAGIC):
+                    log = True
+                    used, records = read_records(data[len(MAGIC):], users, keys)
+                    offset = len(MAGIC) + used
+                elif data:
+                    read_legacy(data, users, keys)
+                    offset = len(data)
+
+        _index.update(stamp=stamp, users=users, keys=keys, log=log,
+                      offset=offset, records=records)
+
+        return users
+
+
+# forget the cached index so the next lookup reads .permissions again
+def invalidate_index():
+    with lock:
+        _index.update(stamp=None, users={}, keys={}, log=False, offset=0, records=0)
+
+
+# paths in logs written before note IDs are relative to 'users' with spaces
+# replaced by underscores
+def normalize_path(fullpath):
     short = fullpath.find('users')
-    shortpath = fullpath[short:]
+    if short > 0:
+        fullpath = fullpath[short:]
+
+    return fullpath.replace(' ', '_')
+
 
-    fix_path = ''
+# the path a key grants, ending in '/' for a folder; None if it is gone
+def key_path(key):
+    path = note_catalog.path_of(key.rstrip('/'))
+    if path is None:
+        return None
+    return path + '/' if key.endswith('/') else path
 
-    for c in shortpath:
-        if c == ' ':
-            new_c = '_'
-            fix_path += new_c
+
+# get permissions for the user, as paths (folders end in '/')
+def get_permissions(user):
+    with lock:
+        if metadata_db.enabled():
+            account_keys = metadata_db.keys_of([user, 'guest'])
         else:
-            fix_path += c
+            users = load_index()
+
+            account_keys = list(users.get(user, ()))
+            if user != 'guest':
+                account_keys += list(users.get('guest', ()))
+
+        account_permissions = []
+        for key in account_keys:
+            path = key_path(key)
+            if path is not None:
+                account_permissions.append(path)
+
+        return account_permissions
+
+
+# the users given fullpath itself or a folder holding it; the cost is the
+# depth of the path, not the number of grants
+def users_along(fullpath):
+    ids = note_catalog.ids_along(fullpath)
+    complete = len(ids) == len(note_catalog.relative_path(fullpath).split('/'))
+
+    along = [noteId + '/' for noteId in ids]
+    if complete:
+        along.append(ids[-1])
+
+    if metadata_db.enabled():
+        return metadata_db.users_of(along)
+
+    found = set()
+    for key in along:
+        found.update(_index['keys'].get(key, ()))
+
+    return found
+
+
+# check if this account (or guest) has been given access to the given filename,
+# directly or through a folder holding it
+def check_permission(account, fullpath):
+    with lock:
+        load_index()
+        granted = users_along(fullpath)
+
+        return account in granted or 'guest' in granted
+
+
+# get the set of users given access to the given filename, directly or through
+# a folder holding it ('guest' in it means everyone has access)
+def users_with_access(fullpath):
+    with lock:
+        load_index()
+
+        return users_along(fullpath)
+
 
-    for cur_path in permissions:
-        if cur_path == fix_path:
-            return True
+# number of records a freshly compacted log of users would hold
+def compacted_records(users):
+    return sum((len(keys) + RECORD_PATHS - 1) // RECORD_PATHS for keys in users.values())
 
-    return False
 
+# rewrite .permissions as the smallest log holding the current grants, leaving
+# out keys of notes and folders that are no longer in the catalog
+def compact():
+    with lock:
+        if metadata_db.enabled():
+            metadata_db.prune_grants(lambda key: key_path(key) is not None)
+            return
 
-# get all filenames this account can access
+        users = load_index()
+        with durable.atomic_open(PERMISSIONS_FILE) as f:
+            f.write(MAGIC)
+            records = 0
+            for user, keys in users.items():
+                keys = sorted(key for key in keys if key_path(key) is not None)
+                for i in range(0, len(keys), RECORD_PATHS):
+                    record = ' '.join(['grant', user] + keys[i:i + RECORD_PATHS])
+                    f.write(record_log.frame(record))
+                    records += 1
+            offset = f.tell()
+
+        lock.changed(rewritten=True)
+        _index.update(stamp=lock.stamp(), log=True, offset=offset, records=records)
+
+
+# append one record to the log, keeping the cached index in step with it
+def append_record(record):
+    with lock:
+        if metadata_db.enabled():
+            metadata_db.apply_permission_record(record)
+            return
+
+        load_index()
+
+        # create the log, or convert a file written before the log format
+        if not _index['log']:
+            compact()
+
+        users = _index['users']
+        keys = _index['keys']
+        in_step = lock.stamp() == _index['stamp']
+
+        data = record_log.frame(record)
+        durable.append(PERMISSIONS_FILE, data, group=True)
+        lock.changed()
+
+        if in_step:
+            apply_record(users, keys, record)
+            _index['offset'] += len(data)
+            _index['records'] += 1
+            _index['stamp'] = lock.stamp()
+        else:
+            invalidate_index()
+
+        if _index['records'] > compacted_records(load_index()) + COMPACT_SLACK:
+            compact()
+
+
+# give account access to filepath with a single appended record
 def add_permission(account, filepath):
-    permissions = get_permissions(account)
+    with lock:
+        load_index()
+        granted = users_along(filepath)
+
+        # if account doesn't already have access to file, add it to account's permissions
+        if account not in granted and 'guest' not in granted:
+            append_record('grant ' + account + ' ' + note_catalog.note_id(filepath, create=True))
+
+
+# give account access to everything in folder, including notes saved there later,
+# with a single record
+def add_folder_permission(account, folder):
+    with lock:
+        load_index()
+        granted = users_along(folder)
 
-    fix_path = ''
+        if account not in granted and 'guest' not in granted:
+            append_record('grant ' + account + ' ' + note_catalog.note_id(folder, create=True) + '/')
 
-    for c in filepath:
-        if c == ' ':
-            new_c = '_'
-            fix_path += new_c
+
+# remove every permission held by account
+def remove_permissions(account):
+    with lock:
+        if metadata_db.enabled():
+            held = metadata_db.has_grants(account)
         else:
-            fix_path += c
-
-    # if account doesn't already have access to file, add it to account's permissions
-    if fix_path not in permissions:
-        found_user = False
-        permissions.append(fix_path)
-
-        accounts = []
-
-        # if .permissions doesn't exist, create it
-        try:
-            f = open('.permissions', 'rb+')
-            accounts = decrypt_file(f.read()).splitlines()
-        except IOError:
-            f = open('.permissions', 'wb')
-
-        f.seek(0)
-
-        # for each account username, write all associated permissions
-        for cur_account in accounts:
-            permission_list = cur_account.split()
-            if not permission_list:
-                continue
-            byte = (permission_list[0] + ' ').encode('utf-8')
-            f.write(byte)
-            # if this account in the list is the current account, add permissions from permissions instead of permission_list
-            if permission_list[0] == account:
-                found_user = True
-                for add in permissions:
-                    byte = (add + ' ').encode('utf-8')
-                    f.write(byte)
-            else:
-                for permission in permission_list[1:]:
-                    byte = (permission + ' ').encode('utf-8')
-                    f.write(byte)
-            f.write('\n'.encode('utf-8'))
-
-        # if this account had no permissions, just add them and this permission to the end of the file
-        if not found_user:
-            byte = (account + ' ' + fix_path + '\n').encode('utf-8')
-            f.write(byte)
-
-        f.close()
-
-        f = open('.permissions', 'rb+')
-
-        encrypted = encrypt_file(f.read().decode('utf-8'))
-        f.seek(0)
-        f.write(encrypted)
-        f.close()
+            held = account in load_index()
+
+        if held:
+            append_record('drop ' + account)
+
+
+# remove every user's access to the files under directory (e.g. a deleted
+# account's 'users/<name>/') by taking it out of the note catalog
+def forget_directory(directory):
+    with lock:
+        note_catalog.remove(directory)
@@ -0,0 +1,45 @@
+"""Logs of individually encrypted records
+
+.permissions and .note_catalog are both a magic line followed by
+(4 byte big-endian length, encrypted record) frames, so a change is a single
+append and a reader only decrypts the records it hasn't seen yet.
+"""
+
+import struct
+from encrypt_file import encrypt_file, decrypt_file
+
+LENGTH = struct.Struct('>I')
+
+
+# frame an already encrypted record with its length
+def frame_encrypted(encrypted):
+    return LENGTH.pack(len(encrypted)) + encrypted
+
+
+# encrypt a record and frame it with its length
+def frame(record):
+    return frame_encrypted(encrypt_file(record))
+
+
+# the encrypted records of every complete frame in data, and the bytes they
+# take up; a frame cut short by a concurrent append is left for the next read
+def split_frames(data):
+    encrypted = []
+    pos = 0
+
+    while pos + LENGTH.size <= len(data):
+        size, = LENGTH.unpack_from(data, pos)
+        end = pos + LENGTH.size + size
+        if end > len(data):
+            break
+
+        encrypted.append(data[pos + LENGTH.size:end])
+        pos = end
+
+    return encrypted, pos
+
+
+# the decrypted records of every complete frame in data, and the bytes they take up
+def read_records(data):
+    encrypted, used = split_frames(data)
+    return [decrypt_file(record) for record in encrypted], used
@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+"""Replace .key with a new key, re-encrypting everything encrypted under it
+
+Every note under users/ is handled on a process pool across all cores.
+Envelope notes (see encrypt_file) only have their data key rewrapped in the
+header, a few small writes however large the note is. Older notes are
+decrypted with the old key and re-encrypted as envelope notes, chunk by
+chunk so a large note is never held in memory whole, keeping their note IDs.
+Then .permissions, .note_catalog and .image_refs are re-encrypted, as are
+the usernames in .notes.db when the SQLite store is in use, and the new key
+replaces the old one.
+
+Run it with the app closed. Finished files are recorded in a journal, so an
+interrupted rotation picks up where it stopped when it is run again, with the
+same new key; a file that was re-encrypted but not yet recorded is
+recognised by the new key decrypting it.
+
+    $ python rotate_key.py [--workers N]
+"""
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+
+import durable
+import note_catalog
+import permissions
+import record_log
+import image_store
+import metadata_db
+from encrypt_file import (KEY_FILE, STREAM_MAGIC, NOTE_MAGIC, ENVELOPE_MAGICS, BOX_MAGIC,
+                          make_ciphers, seal, unseal, encrypt_stream, decrypt_stream,
+                          read_note_id, rewrap_note)
+
+NEW_KEY_FILE = KEY_FILE + '.new'
+JOURNAL_FILE = '.key_rotation'
+USERS_DIR = 'users'
+
+# journal line written once everything is re-encrypted, before the key is replaced
+INSTALL = '*install'
+
+# the journal is synced after this many files
+JOURNAL_SYNC = 100
+
+# files written by encrypt_file start with BOX_MAGIC, or before containers
+# with a Fernet token's version byte
+SEALED_PREFIXES = (BOX_MAGIC, b'gAAAAA')
+
+
+# paths of every file under directory
+def note_paths(directory):
+    paths = []
+    for root, _, names in os.walk(directory):
+        paths.extend(os.path.join(root, name) for name in names)
+    return paths
+
+
+def read_key(path):
+    f = open(path, 'rb')
+    key = f.read()
+    f.close()
+    return key
+
+
+# re-encrypt encrypt_file output (or a Fernet token) as a container under the
+# new ciphers; returns None if the new key already opens it
+def reseal(encrypted, old, new):
+    try:
+        data = unseal(encrypted, old[0], old[3])
+    except (InvalidTag, InvalidToken):
+        unseal(encrypted, new[0], new[3])
+        return None
+
+    return seal(new[3], data)
+
+
+# move one note to the new key in place; runs in a worker process
+# noteId: the catalog's ID for a note written before notes carried one
+# returns ('rewrapped', 'rotated', 'already' or 'skipped', size in bytes)
+def rotate_file(path, noteId, oldKey, newKey):
+    old = make_ciphers(oldKey)
+    new = make_ciphers(newKey)
+    _, oldAead, oldKek, _ = old
+    newKek = new[2]
+    size = os.path.getsize(path)
+
+    f = open(path, 'rb')
+    try:
+        magic = f.read(len(STREAM_MAGIC))
+
+        if magic in (STREAM_MAGIC, NOTE_MAGIC):
+            noteId = read_note_id(path) or noteId
+            f.seek(0)
+            with durable.atomic_open(path) as dst:
+                encrypt_stream(decrypt_stream(f, oldAead), dst, noteId, newKek)
+            return 'rotated', size
+
+        f.seek(0)
+        data = f.read() if magic not in ENVELOPE_MAGICS else b''
+    finally:
+        f.close()
+
+    if magic in ENVELOPE_MAGICS:
+        # an interrupted run may already have rewrapped it
+        return ('rewrapped' if rewrap_note(path, oldKek, newKek) else 'already'), size
+
+    if not data.startswith(SEALED_PREFIXES):
+        return 'skipped', size
+
+    sealed = reseal(data, old, new)
+    if sealed is None:
+        return 'already', size
+
+    durable.atomic_write(path, sealed)
+    return 'rotated', size
+
+
+# re-encrypt every record of a metadata log holding its lock; a file written
+# as one encrypted blob (magic None, or a .permissions file written before the
+# log format) is re-encrypted whole
+def rotate_log(path, magic, lock, oldKey, newKey):
+    old = make_ciphers(oldKey)
+    new = make_ciphers(newKey)
+
+    def rotate(encrypted):
+        sealed = reseal(encrypted, old, new)
+        return encrypted if sealed is None else sealed
+
+    with lock:
+        try:
+            f = open(path, 'rb')
+            data = f.read()
+            f.close()
+        except IOError:
+            return
+
+        if magic is None or not data.startswith(magic):
+            durable.atomic_write(path, rotate(data))
+            lock.changed(rewritten=True)
+            return
+
+        encrypted, _ = record_log.split_frames(data[len(magic):])
+        with durable.atomic_open(path) as f:
+            f.write(magic)
+            for record in encrypted:
+                f.write(record_log.frame_encrypted(rotate(record)))
+
+        lock.changed(rewritten=True)
+
+
+def read_journal():
+    try:
+        f = open(JOURNAL_FILE, 'r')
+    except IOError:
+        return set()
+
+    done = set(line.rstrip('\n') for line in f)
+    f.close()
+    return done
+
+
+# rotate the key; returns counts of the files handled and the (path, error)
+# pairs of files that couldn't be re-encrypted, in which case the old key
+# stays in place and the rotation can be run again
+def rotate(workers=None, directory=USERS_DIR):
+    stats = {'rewrapped': 0, 'rotated': 0, 'already': 0, 'skipped': 0, 'bytes': 0, 'failed': []}
+
+    if not os.path.exists(KEY_FILE):
+        return stats
+
+    done = read_journal()
+    if INSTALL not in done:
+        # an interrupted rotation left its new key behind to be used again
+        durable.create_once(NEW_KEY_FILE, Fernet.generate_key())
+
+        oldKey = read_key(KEY_FILE)
+        newKey = read_key(NEW_KEY_FILE)
+
+        paths = [path for path in note_paths(directory) if path not in done]
+        ids = {path: note_catalog.note_id(path) for path in paths}
+
+        journal = open(JOURNAL_FILE, 'a')
+        journaled = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(rotate_file, path, ids[path], oldKey, newKey): path
+                       for path in paths}
+
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    status, size = future.result()
+                except Exception as e:
+                    stats['failed'].append((path, repr(e)))
+                    continue
+
+                stats[status] += 1
+                if status != 'skipped':
+                    stats['bytes'] += size
+
+                journal.write(path + '\n')
+                journaled += 1
+                if journaled % JOURNAL_SYNC == 0:
+                    journal.flush()
+                    durable.fsync(journal)
+
+        if stats['failed']:
+            journal.close()
+            return stats
+
+        for path, magic, lock in ((permissions.PERMISSIONS_FILE, permissions.MAGIC, permissions.lock),
+                                  (note_catalog.CATALOG_FILE, note_catalog.MAGIC, note_catalog.lock),
+                                  (image_store.REFS_FILE, None, image_store.lock)):
+            if path not in done:
+                rotate_log(path, magic, lock, oldKey, newKey)
+                journal.write(path + '\n')
+
+        if metadata_db.enabled() and metadata_db.DB_FILE not in done:
+            old = make_ciphers(oldKey)
+            new = make_ciphers(newKey)
+            with permissions.lock:
+                metadata_db.reencrypt_names(lambda name: reseal(name, old, new))
+            journal.write(metadata_db.DB_FILE + '\n')
+
+        journal.write(INSTALL + '\n')
+        journal.flush()
+        durable.fsync(journal)
+        journal.close()
+
+    if os.path.exists(NEW_KEY_FILE):
+        os.replace(NEW_KEY_FILE, KEY_FILE)
+        durable.fsync_dir('')
+
+    os.remove(JOURNAL_FILE)
+
+    permissions.invalidate_index()
+    note_catalog.invalidate_catalog()
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rotate the note encryption key.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='re-encrypting processes (default: one per core)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stats = rotate(args.workers)
+    elapsed = time.perf_counter() - start
+
+    for path, error in stats['failed']:
+        print('%s not re-encrypted: %s' % (path, error), file=sys.stderr)
+
+    files = stats['rewrapped'] + stats['rotated'] + stats['already']
+    print('files:    %d rewrapped, %d re-encrypted (%d already done, %d not encrypted)' %
+          (stats['rewrapped'], stats['rotated'], stats['already'], stats['skipped']))
+    print('speed:    %.1f files/sec, %.1f MB/sec' %
+          (files / elapsed, stats['bytes'] / elapsed / 1e6))
+
+    if stats['failed']:
+        print('the old key is still in use; run again to retry')
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
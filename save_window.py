@@ -4,7 +4,7 @@ from PyQt5 import QtGui, QtCore
 from PyQt5.QtCore import QDir
 from PyQt5.QtPrintSupport import QPrinter
 from permissions import check_permission, add_permission
-from encrypt_file import encrypt_file
+import save_worker
 import os
 import re
 
@@ -164,12 +164,11 @@ class SaveWindow(QWidget):
                     return
 
                 self.mainWindow.currentFile = filePath
-                self.mainWindow.statusBar().showMessage('File saved.')
+                self.mainWindow.statusBar().showMessage('Saving...')
                 self.mainWindow.needsSave = False
                 self.mainWindow.window_title = f'Notepad App - {os.path.basename(filePath)}'
                 self.mainWindow.setWindowTitle(self.mainWindow.window_title)
                 self.mainWindow.Edited = False
-                add_permission(self.mainWindow.user, filePath)
 
             # Save PDF
             else:
@@ -199,12 +198,11 @@ class SaveWindow(QWidget):
         # Save working file
         else:
             self.saveFile(self.mainWindow.currentFile)
-            self.mainWindow.statusBar().showMessage('File saved.')
+            self.mainWindow.statusBar().showMessage('Saving...')
             self.mainWindow.needsSave = False
             self.mainWindow.window_title = f'Notepad App - {os.path.basename(self.mainWindow.currentFile)}'
             self.mainWindow.setWindowTitle(self.mainWindow.window_title)
             self.mainWindow.Edited = False
-            add_permission(self.mainWindow.user, self.mainWindow.currentFile)
 
         # Save before adding a new user to the current file
         if self.mainWindow.addUserAfterSave:
@@ -213,6 +211,7 @@ class SaveWindow(QWidget):
 
         # Close the application after save if needed
         if self.closeOnSave:
+            save_worker.pool.waitForDone()
             QtCore.QCoreApplication.exit(0)
 
     # Called when the user clicks the 'Save As' button
@@ -229,18 +228,23 @@ class SaveWindow(QWidget):
             self.saveEvent()
             self.close()
 
-    # Creates a new file or opens an existing one and saves the QTextEdit text
+    # Snapshots the QTextEdit text and hands it to the background save thread,
+    # which encrypts and writes it and gives the user access to the file
     def saveFile(self, filePath):
-
-        try:
-            f = open(filePath, 'wb')
-            encrypted = encrypt_file(self.textEdit.toHtml())
-            f.write(encrypted)
-            f.close()
-            return True
-        except:
+        directory = os.path.dirname(filePath)
+        if directory != '' and not os.path.isdir(directory):
             return False
 
+        # only look at .permissions when the user's access to the file isn't known
+        user = None
+        if self.mainWindow.permittedFile != filePath:
+            user = self.mainWindow.user
+            self.mainWindow.permittedFile = filePath
+
+        save_worker.save_in_background(
+            filePath, self.textEdit.toHtml(), user, self.mainWindow.saveFinishedEvent)
+        return True
+
     # Saves the file as a PDF
 
     def savePDF(self, filePath):
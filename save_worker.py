@@ -0,0 +1,54 @@
+"""Saves notes on a background thread so the GUI keeps responding"""
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from encrypt_file import write_note
+from permissions import add_permission
+from note_catalog import note_id
+import image_store
+
+# a single worker keeps saves to the same file in the order they were made
+pool = QThreadPool()
+pool.setMaxThreadCount(1)
+
+
+class SaveSignals(QObject):
+    """Signals sent back to the GUI thread when a save finishes"""
+
+    # file path, whether the save succeeded
+    finished = pyqtSignal(str, bool)
+
+
+class SaveTask(QRunnable):
+    """Encrypts and writes a snapshot of a note, then gives its owner access"""
+
+    def __init__(self, filePath, html, user=None):
+        super().__init__()
+
+        self.filePath = filePath
+        self.html = html
+        self.user = user
+        self.signals = SaveSignals()
+
+    def run(self):
+        try:
+            # the note keeps the ID the catalog knows it by
+            write_note(self.filePath, self.html, note_id(self.filePath, create=True))
+            image_store.note_saved(self.filePath, self.html)
+
+            # no user means the owner already has access to this file
+            if self.user is not None:
+                add_permission(self.user, self.filePath)
+
+            ok = True
+        except Exception:
+            ok = False
+
+        self.signals.finished.emit(self.filePath, ok)
+
+
+# queue a save, calling onFinished(filePath, ok) on the GUI thread when done
+def save_in_background(filePath, html, user, onFinished):
+    task = SaveTask(filePath, html, user)
+    task.signals.finished.connect(onFinished)
+    pool.start(task)
+    return task
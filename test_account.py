@@ -1,5 +1,9 @@
 from main_window import*
 from account_windows import*
+from encrypt_account import encrypt, decrypt
+from encrypt_file import encrypt_file, decrypt_file
+import account_jobs
+import account_reclaim
 import sys
 import os
 import shutil
@@ -72,6 +76,9 @@ class TestPermission(unittest.TestCase):
         self.assertEqual(self.login_window.check_credentials(), 'True')
         # change password from what was set above
         self.password_window.change_password()
+        # the password is checked and changed on a background job
+        account_jobs.pool.waitForDone()
+        QApplication.processEvents()
         # password has changed, so username and password combo from above no longer works
         self.assertEqual(self.login_window.check_credentials(), 'Wrong pass')
 
@@ -92,6 +99,8 @@ class TestPermission(unittest.TestCase):
         self.delete_window.delete_account(choice)
         # directory no longer exists
         self.assertFalse(os.path.exists('users/test'))
+        # the account no longer logs in
+        self.assertEqual(verify_login('test', 'password'), 'False')
 
     # test encryption and decryption of file contents (string)
     def testEncryptDecryptFile(self):
@@ -107,18 +116,525 @@ class TestPermission(unittest.TestCase):
         # decrypted string should match the original
         self.assertEqual(original, decrypted)
 
+    # test that encrypt_file writes a binary container smaller than a Fernet
+    # token, and that Fernet tokens written before containers still decrypt
+    def testLegacyFernetFile(self):
+        from encrypt_file import key_manager, BOX_HEADER
+
+        original = 'grant first users/first/note.txt'
+        encrypted = encrypt_file(original)
+        token = key_manager.fernet().encrypt(original.encode('utf8'))
+        self.assertTrue(encrypted.startswith(BOX_HEADER))
+        self.assertLess(len(encrypted), len(token))
+
+        self.assertEqual(decrypt_file(token), original)
+
     # cleans up leftover files/directories from tests
     def tearDown(self):
+        # deleted accounts' files are removed in the background
+        account_reclaim.reclaimer.reclaim()
+        if os.path.exists('.trash'):
+            shutil.rmtree('.trash')
+
         if os.path.exists('users/test'):
             shutil.rmtree('users/test')
 
         if os.path.exists('.permissions'):
             os.remove('.permissions')
 
+        if os.path.exists('.note_catalog'):
+            os.remove('.note_catalog')
+
         if os.path.exists('.note_accounts'):
             os.remove('.note_accounts')
 
         if os.path.exists('.key'):
             os.remove('.key')
 
+        if os.path.exists('.hash_policy'):
+            os.remove('.hash_policy')
+
+        for path in ('.permissions.lock', '.note_catalog.lock', '.note_accounts.lock'):
+            if os.path.exists(path):
+                os.remove(path)
+
         return
+
+
+class TestAccountStore(unittest.TestCase):
+    # start every test from an empty account store
+    def setUp(self):
+        if os.path.exists('.note_accounts'):
+            os.remove('.note_accounts')
+
+    # test that a login only runs bcrypt on the matching account's password
+    def testSingleVerification(self):
+        import account_store
+
+        account_store.add_account('first', 'password', 'first@test.com')
+        account_store.add_account('second', 'password', 'second@test.com')
+
+        calls = []
+
+        def counting_decrypt(s, hashed):
+            calls.append(hashed)
+            return decrypt(s, hashed)
+
+        original = account_store.decrypt
+        account_store.decrypt = counting_decrypt
+        try:
+            self.assertEqual(account_store.verify_login(
+                'second', 'password'), 'True')
+            self.assertEqual(len(calls), 1)
+            self.assertTrue(account_store.username_taken('first'))
+            self.assertFalse(account_store.username_taken('third'))
+            self.assertEqual(len(calls), 1)
+        finally:
+            account_store.decrypt = original
+
+    # test that rows written before the username index are found and upgraded
+    def testLegacyRowUpgrade(self):
+        import account_store
+
+        f = open('.note_accounts', 'w')
+        f.write(encrypt('old') + ' ' + encrypt('password') +
+                ' ' + encrypt('old@test.com') + '\n')
+        f.close()
+
+        self.assertEqual(account_store.verify_login('old', 'wrong'), 'Wrong pass')
+        self.assertTrue(account_store.is_indexed(account_store.read_rows()[0]))
+        self.assertEqual(account_store.verify_login('old', 'password'), 'True')
+
+    # test that the legacy scan runs without the accounts lock and is redone
+    # when another write lands during it
+    def testLegacyScanUnlocked(self):
+        import account_store
+
+        f = open('.note_accounts', 'w')
+        f.write(encrypt('old') + ' ' + encrypt('password') +
+                ' ' + encrypt('old@test.com') + '\n')
+        f.close()
+
+        held = []
+
+        class Job:
+            def cancelled(self):
+                return False
+
+            def report(self, text):
+                held.append(account_store.lock.owner is not None)
+                if len(held) == 1:
+                    account_store.add_account('other', 'password', 'other@test.com')
+
+        self.assertEqual(account_store.verify_login('old', 'password', Job()), 'True')
+        self.assertGreater(len(held), 1)
+        self.assertNotIn(True, held)
+        self.assertTrue(all(account_store.is_indexed(row) for row in account_store.read_rows()))
+
+    # test that a login rehashes a password made under an older hashing policy
+    def testRehashOnLogin(self):
+        import account_store
+        from encrypt_account import policy, hash_cost
+
+        account_store.add_account('first', 'password', 'first@test.com')
+        account = account_store.find_account('first')
+        self.assertFalse(account_store.is_bcrypt(account[1]))
+        self.assertFalse(account_store.is_bcrypt(account[3]))
+
+        old = hash_cost(account[2])
+        original = policy.cost
+        policy.cost = old + 1 if old < 11 else 10
+        try:
+            self.assertEqual(account_store.verify_login('first', 'password'), 'True')
+            account = account_store.find_account('first')
+            self.assertEqual(hash_cost(account[2]), policy.cost)
+            self.assertEqual(account_store.verify_login('first', 'password'), 'True')
+        finally:
+            policy.cost = original
+
+    # test that a bulk import checks rows and stores the accounts in one write
+    def testBulkImport(self):
+        import account_store
+        import import_accounts
+
+        account_store.add_account('first', 'password', 'first@test.com')
+
+        rows = [(1, 'second', 'password', 'second@test.com'),
+                (2, 'first', 'password', 'first@test.com'),
+                (3, 'second', 'password', 'second@test.com'),
+                (4, 'bad name', 'password', 'bad@test.com')]
+        accounts, errors = import_accounts.check_rows(rows)
+        self.assertEqual([account[0] for account in accounts], ['second'])
+        self.assertEqual([number for number, _ in errors], [2, 3, 4])
+
+        hashes = import_accounts.hash_passwords(['password'], 1)
+        account_store.add_accounts([account_store.new_record('second', hashes[0],
+                                                             'second@test.com')])
+        self.assertEqual(account_store.verify_login('first', 'password'), 'True')
+        self.assertEqual(account_store.verify_login('second', 'password'), 'True')
+
+    # test that deleting an account tombstones it at once and that a deletion
+    # cut short by a crash is finished on the next start
+    def testTombstonedDelete(self):
+        import account_store
+        import permissions
+
+        account_store.add_account('first', 'password', 'first@test.com')
+        os.makedirs('users/first/images')
+        permissions.add_permission('other', 'users/first/note.txt')
+
+        reclaimer = account_reclaim.Reclaimer('.test_trash')
+        reclaimer.delete_account('first')
+        self.assertFalse(os.path.exists('users/first'))
+        self.assertEqual(account_store.verify_login('first', 'password'), 'False')
+        self.assertFalse(permissions.check_permission('other', 'users/first/note.txt'))
+
+        reclaimer.reclaim()
+        self.assertEqual(os.listdir('.test_trash'), [])
+
+        # a tombstone written just before a crash
+        account_store.add_account('second', 'password', 'second@test.com')
+        os.makedirs('users/second')
+        reclaimer.write('1-crashed.json', {'user': 'second', 'stage': 'metadata'})
+
+        reclaimer.start()
+        self.assertEqual(account_store.verify_login('second', 'password'), 'False')
+        self.assertFalse(os.path.exists('users/second'))
+        reclaimer.reclaim()
+        self.assertEqual(os.listdir('.test_trash'), [])
+
+        shutil.rmtree('.test_trash')
+
+    # test that changing or removing an account only touches its own row
+    def testRecordUpdate(self):
+        import account_store
+
+        account_store.add_account('first', 'password', 'first@test.com')
+        account_store.add_account('second', 'password', 'second@test.com')
+        size = os.path.getsize('.note_accounts')
+
+        self.assertTrue(account_store.set_password('first', 'changed'))
+        self.assertEqual(os.path.getsize('.note_accounts'), size)
+        self.assertEqual(account_store.verify_login('first', 'changed'), 'True')
+
+        self.assertTrue(account_store.remove_account('first'))
+        self.assertFalse(account_store.remove_account('first'))
+        self.assertEqual(account_store.verify_login('first', 'changed'), 'False')
+        self.assertEqual(len(account_store.read_rows()), 1)
+
+        # a cold index finds the remaining row past the blanked one
+        account_store.invalidate_index()
+        self.assertEqual(account_store.verify_login('second', 'password'), 'True')
+
+    # test that a cancelled job stops checking accounts and reports nothing
+    def testCancelledJob(self):
+        import account_store
+
+        f = open('.note_accounts', 'w')
+        f.write(encrypt('old') + ' ' + encrypt('password') +
+                ' ' + encrypt('old@test.com') + '\n')
+        f.close()
+
+        job = account_jobs.AccountJob(account_store.verify_login, 'old', 'password')
+        results = []
+        job.signals.finished.connect(results.append)
+        job.cancel()
+        job.run()
+        QApplication.processEvents()
+
+        self.assertEqual(results, [])
+        # the legacy row was never checked, so it wasn't upgraded either
+        self.assertFalse(account_store.is_indexed(account_store.read_rows()[0]))
+
+    # test that a decision made without the lock is rechecked if a write got in first
+    def testCompareAndSwap(self):
+        import metadata_lock
+
+        lock = metadata_lock.FileLock('.test')
+        checks = []
+
+        def check():
+            checks.append(lock.version())
+            if len(checks) == 1:
+                # another writer commits between the check and the commit
+                with lock:
+                    lock.changed()
+            return len(checks)
+
+        self.assertEqual(lock.update(check, lambda result: result), 2)
+        self.assertEqual(lock.retries, 1)
+        self.assertEqual(checks, [0, 1])
+
+    # test that accounts and grants work the same after moving them into SQLite
+    def testMigrateToDatabase(self):
+        import account_store
+        import permissions
+        import metadata_db
+
+        account_store.add_account('first', 'password', 'first@test.com')
+        account_store.add_account('second', 'password', 'second@test.com')
+        add_permission('second', 'users/first/a.txt')
+        permissions.add_folder_permission('third', 'users/first/group')
+
+        self.assertTrue(metadata_db.migrate())
+        self.assertFalse(os.path.exists('.note_accounts'))
+        self.assertFalse(metadata_db.migrate())
+
+        self.assertEqual(account_store.verify_login('first', 'password'), 'True')
+        self.assertTrue(account_store.set_password('first', 'changed'))
+        self.assertEqual(account_store.verify_login('first', 'changed'), 'True')
+        self.assertEqual(account_store.create_account('first', 'password', 'other@test.com'), 'Taken')
+        version = account_store.lock.version()
+        self.assertEqual(account_store.create_account('fourth', 'password', 'fourth@test.com'), 'True')
+        # inserts are seen by create_account's compare and swap, and a row
+        # whose username was taken meanwhile is left out
+        self.assertGreater(account_store.lock.version(), version)
+        record = account_store.new_record('fourth', account_store.encrypt('password'), 'f@test.com')
+        self.assertEqual(account_store.add_accounts([record]), [record])
+        self.assertTrue(account_store.remove_account('second'))
+        self.assertEqual(account_store.verify_login('second', 'password'), 'False')
+        self.assertFalse(os.path.exists('.note_accounts'))
+
+        self.assertEqual(permissions.users_with_access('users/first/a.txt'), {'second'})
+        self.assertTrue(check_permission('third', 'users/first/group/b.txt'))
+        add_permission('fourth', 'users/first/a.txt')
+        self.assertEqual(permissions.users_with_access('users/first/a.txt'), {'second', 'fourth'})
+
+        # usernames are stored as digests, and listed from their encrypted copies
+        granted = metadata_db.connection().execute('SELECT user FROM grants').fetchall()
+        self.assertFalse({'second', 'third', 'fourth'} & {user for user, in granted})
+        metadata_db._names.clear()
+        self.assertEqual(permissions.users_with_access('users/first/a.txt'), {'second', 'fourth'})
+        permissions.remove_permissions('second')
+        self.assertEqual(permissions.get_permissions('second'), [])
+        self.assertEqual(permissions.get_permissions('third'), ['users/first/group/'])
+        self.assertFalse(os.path.exists('.permissions'))
+
+    def tearDown(self):
+        import metadata_db
+        metadata_db.close()
+
+        for path in ('.note_accounts', '.account_key', '.hash_policy', '.permissions',
+                     '.note_catalog', '.key', '.note_accounts.migrated', '.permissions.migrated',
+                     '.notes.db', '.notes.db-wal', '.notes.db-shm', '.note_accounts.lock',
+                     '.permissions.lock', '.note_catalog.lock', '.test.lock'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class TestPermissionIndex(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists('.permissions'):
+            os.remove('.permissions')
+
+        if os.path.exists('.note_catalog'):
+            os.remove('.note_catalog')
+
+    # test that the cached index picks up changes made to .permissions on disk
+    def testIndexReloadsOnChange(self):
+        add_permission('first', 'users/first/note.txt')
+        self.assertTrue(check_permission('first', 'users/first/note.txt'))
+        self.assertFalse(check_permission('second', 'users/first/note.txt'))
+
+        # another process rewrites the file behind the cache's back
+        f = open('.permissions', 'wb')
+        f.write(encrypt_file('second users/first/note.txt\n'))
+        f.close()
+
+        self.assertTrue(check_permission('second', 'users/first/note.txt'))
+        self.assertFalse(check_permission('first', 'users/first/note.txt'))
+
+    # test that grants are single appended records and old files are converted
+    def testAppendLog(self):
+        import permissions
+
+        f = open('.permissions', 'wb')
+        f.write(encrypt_file('first users/first/a.txt\n'))
+        f.close()
+
+        add_permission('first', 'users/first/b.txt')
+        size = os.path.getsize('.permissions')
+        add_permission('second', 'users/first/b.txt')
+
+        # the second grant only appended to the converted log
+        f = open('.permissions', 'rb')
+        data = f.read()
+        f.close()
+        self.assertTrue(data.startswith(permissions.MAGIC))
+        self.assertGreater(len(data), size)
+
+        permissions.remove_permissions('first')
+        permissions.invalidate_index()
+        self.assertFalse(check_permission('first', 'users/first/a.txt'))
+        self.assertTrue(check_permission('second', 'users/first/b.txt'))
+
+        permissions.compact()
+        permissions.invalidate_index()
+        self.assertEqual(permissions.get_permissions('second'), ['users/first/b.txt'])
+
+    # test that the reverse index follows grants, dropped users and forgotten folders
+    def testUsersWithAccess(self):
+        import permissions
+
+        add_permission('first', 'users/first/a.txt')
+        add_permission('second', 'users/first/a.txt')
+        add_permission('second', 'users/second/b.txt')
+        self.assertEqual(permissions.users_with_access('users/first/a.txt'),
+                         {'first', 'second'})
+
+        permissions.remove_permissions('first')
+        self.assertEqual(permissions.users_with_access('users/first/a.txt'), {'second'})
+
+        permissions.forget_directory('users/first')
+        self.assertEqual(permissions.users_with_access('users/first/a.txt'), set())
+
+        # a cold index is built the same way from the log
+        permissions.invalidate_index()
+        self.assertEqual(permissions.users_with_access('users/second/b.txt'), {'second'})
+        self.assertEqual(permissions.users_with_access('users/first/a.txt'), set())
+
+    # test that one folder grant covers the notes inside it, even new ones
+    def testFolderPermission(self):
+        import permissions
+
+        permissions.add_folder_permission('second', 'users/first/group')
+        self.assertTrue(check_permission('second', 'users/first/group/a.txt'))
+        self.assertTrue(check_permission('second', 'users/first/group/sub/b.txt'))
+        self.assertFalse(check_permission('second', 'users/first/other.txt'))
+        self.assertFalse(check_permission('third', 'users/first/group/a.txt'))
+        self.assertEqual(permissions.users_with_access('users/first/group/a.txt'), {'second'})
+
+        # saving a note into the folder needs no record of its own
+        size = os.path.getsize('.permissions')
+        add_permission('second', 'users/first/group/c.txt')
+        self.assertEqual(os.path.getsize('.permissions'), size)
+
+        permissions.invalidate_index()
+        self.assertTrue(check_permission('second', 'users/first/group/c.txt'))
+
+        permissions.forget_directory('users/first')
+        self.assertFalse(check_permission('second', 'users/first/group/a.txt'))
+
+    # test that grants follow a folder when it is moved, with one catalog record
+    def testMoveKeepsPermissions(self):
+        import permissions
+        import note_catalog
+        from encrypt_file import write_note, read_note_id
+
+        os.makedirs('users/first/group')
+        write_note('users/first/group/a.txt', '<p>a</p>', note_catalog.note_id(
+            'users/first/group/a.txt', create=True))
+        add_permission('second', 'users/first/group/a.txt')
+        permissions.add_folder_permission('third', 'users/first/group')
+        noteId = read_note_id('users/first/group/a.txt')
+
+        records = note_catalog.load_catalog()['records']
+        note_catalog.move('users/first/group', 'users/first/moved')
+        self.assertEqual(note_catalog.load_catalog()['records'], records + 1)
+
+        self.assertTrue(check_permission('second', 'users/first/moved/a.txt'))
+        self.assertTrue(check_permission('third', 'users/first/moved/a.txt'))
+        self.assertFalse(check_permission('second', 'users/first/group/a.txt'))
+        self.assertEqual(note_catalog.note_id('users/first/moved/a.txt'), noteId)
+        self.assertEqual(read_note_id('users/first/moved/a.txt'), noteId)
+
+        # a note moved outside the app is linked back by the ID in its header
+        os.rename('users/first/moved/a.txt', 'users/first/b.txt')
+        self.assertEqual(note_catalog.note_id('users/first/b.txt', create=True), noteId)
+        self.assertTrue(check_permission('second', 'users/first/b.txt'))
+
+        shutil.rmtree('users/first')
+
+    # test that grants made by several processes at once are all kept
+    def testConcurrentProcesses(self):
+        import subprocess
+
+        result = subprocess.run([sys.executable, 'bench_concurrency.py', '4', '60', '3'],
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertIn('problems:  0', result.stdout)
+        self.assertEqual(result.returncode, 0)
+
+    def tearDown(self):
+        if os.path.exists('.permissions'):
+            os.remove('.permissions')
+
+        if os.path.exists('.note_catalog'):
+            os.remove('.note_catalog')
+
+        if os.path.exists('.key'):
+            os.remove('.key')
+
+        for path in ('.permissions.lock', '.note_catalog.lock'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class TestOutbox(unittest.TestCase):
+    # start a minimal local SMTP server and point the outbox at it
+    def setUp(self):
+        import socketserver
+        import threading
+        import email_server
+
+        received = self.received = []
+        connections = self.connections = []
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write((line + '\r\n').encode())
+
+            def handle(self):
+                connections.append(1)
+                self.reply('220 localhost')
+                while True:
+                    line = self.rfile.readline().decode().strip()
+                    if not line or line.upper() == 'QUIT':
+                        self.reply('221 bye')
+                        return
+                    if line.upper() == 'DATA':
+                        self.reply('354 go ahead')
+                        body = []
+                        while True:
+                            data = self.rfile.readline().decode().rstrip('\r\n')
+                            if data == '.':
+                                break
+                            body.append(data)
+                        received.append('\n'.join(body))
+                    self.reply('250 ok')
+
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.config = dict(email_server.config)
+        email_server.config.update(host='127.0.0.1', port=self.server.server_address[1],
+                                   ssl=False, password='')
+        self.outbox = email_server.Outbox('.test_outbox')
+
+    # test that queued emails are sent over a single reused connection
+    def testDrainOutbox(self):
+        for i in range(3):
+            self.outbox.queue('user%d@test.com' % i)
+        self.outbox.send_due()
+        self.outbox.disconnect()
+
+        self.assertEqual(len(self.received), 3)
+        self.assertEqual(self.outbox.connections, 1)
+        self.assertEqual(self.outbox.pending(), [])
+
+    # test that an unreachable server leaves the email queued for a retry
+    def testRetryLater(self):
+        import email_server
+
+        self.outbox.queue('user@test.com', start=False)
+        email_server.config['port'] = 1
+        self.assertGreater(self.outbox.send_due(), 0)
+        self.assertEqual(len(self.outbox.pending()), 1)
+
+    def tearDown(self):
+        import email_server
+
+        email_server.config.clear()
+        email_server.config.update(self.config)
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree('.test_outbox')
@@ -30,6 +30,7 @@ class TestIO(unittest.TestCase):
         self.mainWindow.saveEvent()
         self.mainWindow.centralWidget.textBox.setText('Hello!')
         self.mainWindow.saveWindow.saveFile('test/hello.txt')
+        save_worker.pool.waitForDone()
         f = open('test/hello.txt', 'rb')
         self.assertEqual(
             self.mainWindow.centralWidget.textBox.toHtml(), decrypt_file(f.read()))
@@ -48,6 +49,52 @@ class TestIO(unittest.TestCase):
         self.assertEqual(
             self.mainWindow.centralWidget.textBox.toHtml(), goodbyeText)
 
+    # Test if saving the open file again skips the permissions lookup
+    def testRepeatSaveSkipsPermissions(self):
+        import permissions
+
+        self.mainWindow.currentFile = 'test/repeat.txt'
+        self.mainWindow.saveEvent()
+        save_worker.pool.waitForDone()
+        reads = permissions.counters['reads']
+        self.mainWindow.saveEvent()
+        save_worker.pool.waitForDone()
+        self.assertEqual(permissions.counters['reads'], reads)
+        self.assertTrue(check_permission('guest', 'test/repeat.txt'))
+
+    # Test if a background save reports back to the status bar
+    def testSaveFinished(self):
+        self.mainWindow.currentFile = 'test/status.txt'
+        self.mainWindow.saveEvent()
+        save_worker.pool.waitForDone()
+        QApplication.processEvents()
+        self.assertEqual(self.mainWindow.statusBar().currentMessage(), 'File saved.')
+
+    # Test if the open window lists only permitted notes and reuses decrypted notes
+    def testOpenWindowListing(self):
+        from open_window import documentCache
+        from encrypt_file import write_note
+
+        write_note('users/guest/listed.txt', '<p>listed</p>')
+        write_note('users/guest/hidden.txt', '<p>hidden</p>')
+        add_permission('guest', 'users/guest/listed.txt')
+
+        try:
+            self.mainWindow.openEvent(False)
+            model = self.mainWindow.openWindow.fileModel
+            folder = model.findItems('guest')[0]
+            model.expandEvent(folder.index())
+            names = [folder.child(i).text() for i in range(folder.rowCount())]
+            self.assertEqual(names, ['listed.txt'])
+
+            hits = documentCache.hits
+            self.mainWindow.openWindow.openFile('users/guest/listed.txt')
+            self.mainWindow.openWindow.openFile('users/guest/listed.txt')
+            self.assertEqual(documentCache.hits, hits + 1)
+        finally:
+            os.remove('users/guest/listed.txt')
+            os.remove('users/guest/hidden.txt')
+
     # Test if note group folder was successfully created
     def testCreateGroup(self):
         self.mainWindow.createGroupEvent()
@@ -75,4 +122,366 @@ class TestIO(unittest.TestCase):
     # Clean up the test files
     def tearDown(self):
         shutil.rmtree('test')
+        if os.path.exists('.permissions'):
+            os.remove('.permissions')
+
+        if os.path.exists('.note_catalog'):
+            os.remove('.note_catalog')
+
+        for path in ('.permissions.lock', '.note_catalog.lock'):
+            if os.path.exists(path):
+                os.remove(path)
         return
+
+
+class TestKeyManager(unittest.TestCase):
+    """Unit tests for the shared key cache"""
+
+    # Test that the key is read once and reread after it is replaced
+    def testKeyRotation(self):
+        from encrypt_file import KeyManager, generate_key
+
+        manager = KeyManager('.test_key')
+        fern = manager.fernet(create=True)
+        self.assertIs(manager.fernet(), fern)
+        self.assertEqual(manager.loads, 1)
+
+        os.remove('.test_key')
+        generate_key('.test_key')
+        self.assertIsNot(manager.fernet(), fern)
+        self.assertEqual(manager.loads, 2)
+
+    # Test that rotating the key only rewraps envelope notes' headers,
+    # re-encrypts older files and the metadata, and picks up a note an
+    # interrupted rotation already rewrapped
+    def testRotateKey(self):
+        import rotate_key
+        import permissions
+        import image_store
+        from encrypt_file import (write_note, read_note, generate_key, make_ciphers,
+                                  key_manager, unwrap_key, SLOTS_OFFSET, SLOT_SIZE)
+
+        os.makedirs('test/rotate')
+        write_note('test/rotate/a.txt', 'a' * 200000)
+        f = open('test/rotate/a.txt', 'rb')
+        before = f.read()
+        f.close()
+        f = open('test/rotate/b.txt', 'wb')
+        f.write(encrypt_file('b'))
+        f.close()
+        f = open('test/rotate/c.txt', 'wb')
+        f.write(key_manager.fernet().encrypt(b'c'))
+        f.close()
+        permissions.add_permission('first', 'test/rotate/a.txt')
+        image = 'users/first/images/' + '0' * 64 + '.png'
+        image_store.note_saved('test/rotate/a.txt', '<img src="%s" />' % image)
+
+        oldKey = rotate_key.read_key('.key')
+        generate_key(rotate_key.NEW_KEY_FILE)
+        newKey = rotate_key.read_key(rotate_key.NEW_KEY_FILE)
+        rotate_key.rotate_file('test/rotate/a.txt', None, oldKey, newKey)
+
+        stats = rotate_key.rotate(workers=2, directory='test/rotate')
+        self.assertEqual((stats['rotated'], stats['already'], stats['failed']), (2, 1, []))
+        self.assertEqual(rotate_key.read_key('.key'), newKey)
+        self.assertFalse(os.path.exists(rotate_key.JOURNAL_FILE))
+
+        self.assertEqual(read_note('test/rotate/a.txt'), 'a' * 200000)
+        self.assertEqual(read_note('test/rotate/b.txt'), 'b')
+        self.assertEqual(read_note('test/rotate/c.txt'), 'c')
+        self.assertTrue(permissions.check_permission('first', 'test/rotate/a.txt'))
+        self.assertEqual(image_store.image_refs(), {image: 1})
+
+        # only the key slots changed, and the old key no longer opens either
+        f = open('test/rotate/a.txt', 'rb')
+        after = f.read()
+        f.close()
+        end = SLOTS_OFFSET + 2 * SLOT_SIZE
+        self.assertEqual(after[:SLOTS_OFFSET] + after[end:], before[:SLOTS_OFFSET] + before[end:])
+        slots = after[SLOTS_OFFSET:SLOTS_OFFSET + SLOT_SIZE], after[SLOTS_OFFSET + SLOT_SIZE:end]
+        self.assertEqual(unwrap_key(make_ciphers(oldKey)[2], slots, after[:SLOTS_OFFSET]),
+                         (None, None))
+
+    # Test that rotating the key with the SQLite store in use re-encrypts
+    # the usernames kept for listing who holds a note
+    def testRotateKeyWithDatabase(self):
+        import rotate_key
+        import permissions
+        import metadata_db
+
+        os.makedirs('test/rotate')
+        permissions.add_permission('first', 'test/rotate/a.txt')
+        self.assertTrue(metadata_db.migrate())
+
+        stats = rotate_key.rotate(workers=1, directory='test/rotate')
+        self.assertEqual(stats['failed'], [])
+
+        metadata_db._names.clear()
+        self.assertEqual(permissions.users_with_access('test/rotate/a.txt'), {'first'})
+
+    def tearDown(self):
+        import metadata_db
+        metadata_db.close()
+
+        if os.path.exists('.test_key'):
+            os.remove('.test_key')
+
+        if os.path.exists('test/rotate'):
+            shutil.rmtree('test/rotate')
+
+        for path in ('.permissions', '.note_catalog', '.image_refs', '.permissions.lock',
+                     '.note_catalog.lock', '.image_refs.lock', '.notes.db', '.notes.db-wal',
+                     '.notes.db-shm', '.permissions.migrated', '.note_accounts.lock', '.account_key'):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class TestNoteStream(unittest.TestCase):
+    """Unit tests for the streamed note format"""
+
+    def setUp(self):
+        if not os.path.exists('test'):
+            os.makedirs('test')
+
+    # Test that a note spanning many chunks round trips, including multi-byte
+    # characters split across chunk boundaries
+    def testRoundTrip(self):
+        from encrypt_file import write_note, read_note, CHUNK_SIZE
+
+        text = ('<p>café ✓</p>' * CHUNK_SIZE)[:3 * CHUNK_SIZE + 7]
+        write_note('test/big.txt', text)
+        self.assertEqual(read_note('test/big.txt'), text)
+
+        f = open('test/big.txt', 'rb')
+        self.assertEqual(decrypt_file(f.read()), text)
+        f.close()
+
+    # Test that a note missing its last chunk is rejected
+    def testTruncated(self):
+        import base64
+        from encrypt_file import write_note, read_note, CHUNK_SIZE, SLOTS_OFFSET, SLOT_SIZE
+
+        # random text, so the note still spans several chunks once compressed
+        write_note('test/cut.txt', base64.b64encode(os.urandom(2 * CHUNK_SIZE)).decode())
+        f = open('test/cut.txt', 'rb+')
+        data = f.read()
+        f.truncate(len(data) - (CHUNK_SIZE + 20))
+        f.close()
+
+        with self.assertRaises(Exception):
+            read_note('test/cut.txt')
+
+        # cut right after the header, before any frame
+        f = open('test/cut.txt', 'rb+')
+        f.truncate(SLOTS_OFFSET + 2 * SLOT_SIZE + 8)
+        f.close()
+
+        with self.assertRaises(ValueError):
+            read_note('test/cut.txt')
+
+    # Test that notes are compressed with each codec, and that notes saved
+    # before compression still read
+    def testCompression(self):
+        from encrypt_file import (write_note, read_note, encrypt_stream, text_chunks,
+                                  set_compression, compression)
+
+        html = '<p style=" margin-top:0px; margin-bottom:0px;">a line</p>\n' * 5000
+        f = open('test/plain.txt', 'wb')
+        encrypt_stream(text_chunks(html), f)
+        f.close()
+        self.assertEqual(read_note('test/plain.txt'), html)
+        plain = os.path.getsize('test/plain.txt')
+
+        default = dict(compression)
+        try:
+            for codec in ('zlib', 'lzma', 'none'):
+                set_compression(codec, 1)
+                write_note('test/packed.txt', html)
+                self.assertEqual(read_note('test/packed.txt'), html)
+                if codec == 'none':
+                    self.assertLess(os.path.getsize('test/packed.txt'), plain + 100)
+                else:
+                    self.assertLess(os.path.getsize('test/packed.txt'), plain / 10)
+        finally:
+            set_compression(default['codec'], default['level'])
+
+    # Test that notes written by encrypt_file can still be read
+    def testLegacyNote(self):
+        from encrypt_file import read_note
+
+        f = open('test/old.txt', 'wb')
+        f.write(encrypt_file('<p>old</p>'))
+        f.close()
+        self.assertEqual(read_note('test/old.txt'), '<p>old</p>')
+
+    def tearDown(self):
+        shutil.rmtree('test')
+        if os.path.exists('.key'):
+            os.remove('.key')
+
+
+class TestDurableWrite(unittest.TestCase):
+    """Unit tests for atomic writes and group commit"""
+
+    def setUp(self):
+        if not os.path.exists('test'):
+            os.makedirs('test')
+
+    # Test that a failed write leaves the old file and no temporary files
+    def testAtomicWrite(self):
+        import durable
+
+        durable.atomic_write('test/a.txt', b'old')
+        with self.assertRaises(RuntimeError):
+            with durable.atomic_open('test/a.txt') as f:
+                f.write(b'partial')
+                raise RuntimeError()
+
+        f = open('test/a.txt', 'rb')
+        self.assertEqual(f.read(), b'old')
+        f.close()
+        self.assertEqual(os.listdir('test'), ['a.txt'])
+
+    # Test that rapid saves of one file are coalesced into a single commit
+    def testGroupCommit(self):
+        import durable
+
+        durable.set_group_commit(60)
+        try:
+            coalesced = durable.stats['coalesced']
+            for i in range(5):
+                durable.atomic_write('test/b.txt', str(i).encode(), group=True)
+            self.assertEqual(durable.stats['coalesced'] - coalesced, 4)
+            self.assertFalse(os.path.exists('test/b.txt'))
+
+            durable.wait('test/b.txt')
+            f = open('test/b.txt', 'rb')
+            self.assertEqual(f.read(), b'4')
+            f.close()
+        finally:
+            durable.set_group_commit(0)
+
+    # Test that reading a file waits for a flush that is renaming it right now
+    def testWaitForFlush(self):
+        import threading
+        import durable
+
+        durable.set_group_commit(60)
+        fsync = durable.fsync
+        try:
+            durable.atomic_write('test/c.txt', b'new', group=True)
+
+            started = threading.Event()
+            finish = threading.Event()
+
+            def slow_fsync(f):
+                started.set()
+                finish.wait()
+                fsync(f)
+
+            durable.fsync = slow_fsync
+            flusher = threading.Thread(target=durable.flush)
+            flusher.start()
+            started.wait()
+            durable.fsync = fsync
+
+            threading.Timer(0.2, finish.set).start()
+            durable.wait('test/c.txt')
+            f = open('test/c.txt', 'rb')
+            self.assertEqual(f.read(), b'new')
+            f.close()
+            flusher.join()
+        finally:
+            durable.fsync = fsync
+            durable.set_group_commit(0)
+
+    def tearDown(self):
+        shutil.rmtree('test')
+
+
+class TestImageStore(unittest.TestCase):
+    """Unit tests for the deduplicated image store"""
+
+    def setUp(self):
+        os.makedirs('test/a')
+        os.makedirs('test/b')
+
+    # Test that the same image inserted again, under any name, is stored
+    # once, that different images with one name are both kept, and that an
+    # image no saved note uses is swept
+    def testDeduplicate(self):
+        import image_store
+
+        for path, data in (('test/a/shot.png', b'first'), ('test/b/shot.png', b'second'),
+                           ('test/a/copy.png', b'first')):
+            f = open(path, 'wb')
+            f.write(data)
+            f.close()
+
+        first = image_store.add_image('test_images', 'test/a/shot.png')
+        self.assertEqual(image_store.add_image('test_images', 'test/a/shot.png'), first)
+        self.assertEqual(image_store.add_image('test_images', 'test/a/copy.png'), first)
+        second = image_store.add_image('test_images', 'test/b/shot.png')
+        self.assertNotEqual(second, first)
+
+        f = open(second, 'rb')
+        self.assertEqual(f.read(), b'second')
+        f.close()
+
+        html = '<p><img src="%s" /><img src="%s" /></p>'
+        image_store.note_saved('users/test_images/a.txt', html % (first, second))
+        image_store.note_saved('users/test_images/b.txt', html % (first, first))
+        self.assertEqual(image_store.image_refs(), {first: 2, second: 1})
+
+        # saves only count references, a later sweep removes what is unused
+        image_store.note_saved('users/test_images/a.txt', '<p>no images</p>')
+        image_store.note_saved('users/test_images/b.txt', '<p>no images</p>')
+        self.assertEqual(image_store.image_refs(), {})
+        self.assertTrue(os.path.exists(first))
+        image_store._inserted.clear()
+        self.assertEqual(image_store.sweep(grace=0, users=['test_images']), 2)
+        self.assertFalse(os.path.exists(first))
+
+    # Test that an image is kept while an unsaved note uses it, after an
+    # undo puts it back, and while it was inserted this session
+    def testSweep(self):
+        import image_store
+
+        f = open('test/a/shot.png', 'wb')
+        f.write(b'image')
+        f.close()
+
+        note = '<p><img src="%s" /></p>'
+        image = image_store.add_image('test_images', 'test/a/shot.png')
+        image_store.note_saved('users/test_images/a.txt', note % image)
+
+        # inserted into unsaved note b, then removed from a
+        self.assertEqual(image_store.add_image('test_images', 'test/a/shot.png'), image)
+        image_store.note_saved('users/test_images/a.txt', '<p></p>')
+        self.assertEqual(image_store.sweep(grace=0, users=['test_images']), 0)
+        image_store.note_saved('users/test_images/b.txt', note % image)
+        self.assertTrue(os.path.exists(image))
+        self.assertEqual(image_store.image_refs(), {image: 1})
+
+        # removed from b and saved, then undone and saved again
+        image_store.note_saved('users/test_images/b.txt', '<p></p>')
+        image_store.note_saved('users/test_images/b.txt', note % image)
+        self.assertTrue(os.path.exists(image))
+
+        # a referenced image survives a sweep in a later session, an
+        # unreferenced one survives the grace period only
+        image_store._inserted.clear()
+        self.assertEqual(image_store.sweep(grace=0, users=['test_images']), 0)
+        image_store.note_saved('users/test_images/b.txt', '<p></p>')
+        self.assertEqual(image_store.sweep(users=['test_images']), 0)
+        self.assertEqual(image_store.sweep(grace=0, users=['test_images']), 1)
+        self.assertFalse(os.path.exists(image))
+
+    def tearDown(self):
+        shutil.rmtree('test')
+        if os.path.exists('users/test_images'):
+            shutil.rmtree('users/test_images')
+
+        for path in ('.image_refs', '.image_refs.lock', '.note_catalog', '.note_catalog.lock'):
+            if os.path.exists(path):
+                os.remove(path)